@@ -0,0 +1,760 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright © 2017 John Jackson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# Used to benchmark the pyscripts tasks
+#
+# Usage: python benchmark.py [<benchmark> ...] [options]
+#
+# The 'tasks' benchmark times every task on generated inputs of increasing size, flags tasks
+# whose time grows faster than the size of their input, and compares the results with a
+# baseline saved by an earlier run (see --help).
+#
+
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+sys.dont_write_bytecode = True
+import pyscripts
+# Timings are of the tasks themselves, not of cached results, nor of recording metrics
+os.environ.pop(pyscripts.CACHE_ENVIRONMENT, None)
+os.environ.pop(pyscripts.METRICS_ENVIRONMENT, None)
+
+PYTHON_SCRIPT_SOURCE = 'pyscripts.py'
+PYTHON_CLIENT_SOURCE = 'pyscripts_client.py'
+
+def timed(function, repeat=5):
+    """Returns the best wall time of several calls of function, in seconds."""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def report(name, seconds, extra=''):
+    print "  %-40s %10.2f ms %s" % (name, seconds * 1000, extra)
+
+def run_command(command):
+    subprocess.check_call(command, stdout=open(os.devnull, 'w'))
+
+#
+# Benchmarks
+#
+
+def bench_server(options, commands=20):
+    """Per-command latency of starting pyscripts, against forwarding to a running server."""
+    print "Per-command latency (mean of %d commands)" % commands
+    direct = [sys.executable, PYTHON_SCRIPT_SOURCE, 'bold', 'some text']
+    client = [sys.executable, '-S', PYTHON_CLIENT_SOURCE, PYTHON_SCRIPT_SOURCE, 'bold', 'some text']
+
+    start = time.time()
+    for i in range(commands):
+        run_command(direct)
+    report('python pyscripts.py', (time.time() - start) / commands)
+
+    address = pyscripts.server_address(PYTHON_SCRIPT_SOURCE)
+    server = subprocess.Popen([sys.executable, PYTHON_SCRIPT_SOURCE, '--serve', '60'])
+    try:
+        while not os.path.exists(address):
+            time.sleep(0.01)
+        start = time.time()
+        for i in range(commands):
+            run_command(client)
+        report('python -S pyscripts_client.py (server)', (time.time() - start) / commands)
+
+        # Concurrent clients, as when several commands are fired in quick succession
+        start = time.time()
+        clients = [subprocess.Popen(client, stdout=open(os.devnull, 'w')) for i in range(commands)]
+        for process in clients:
+            process.wait()
+        report('concurrent clients (server)', (time.time() - start) / commands)
+    finally:
+        server.terminate()
+        server.wait()
+        if os.path.exists(address):
+            os.unlink(address)
+
+def bench_fragments(options, fragments=50):
+    """Time to run a task on many fragments, as the matches of a search, with a process each
+    against one process reading them all as a fragment stream."""
+    print "Fragments (%d matches, 'case_upper')" % fragments
+    texts = [u"match %d, caf\xe9" % i for i in range(fragments)]
+    start = time.time()
+    for text in texts:
+        run_command([sys.executable, PYTHON_SCRIPT_SOURCE, 'case_upper', text.encode('utf-8')])
+    report('a process each', time.time() - start)
+    stream = u''.join(u"%d case_upper\n%s" % (len(text), text) for text in texts).encode('utf-8')
+
+    def run_stream():
+        process = subprocess.Popen([sys.executable, PYTHON_SCRIPT_SOURCE, '--fragments'], stdin=subprocess.PIPE,
+            stdout=open(os.devnull, 'w'))
+        process.communicate(stream)
+        if process.returncode != 0:
+            raise Exception("'--fragments' exited with %d" % process.returncode)
+    report('one fragment stream', timed(run_stream, 3))
+
+def bench_startup(options, runs=20):
+    """Cold-start time of a command run from source and from the zip archive build.py installs,
+    against python doing nothing; fails if the archive imports more than build.STARTUP_MODULES,
+    or starts more slowly than the source."""
+    import shutil
+    import tempfile
+    import build
+    print "Cold start (best of %d commands)" % runs
+    directory = tempfile.mkdtemp()
+    try:
+        zipapp = os.path.join(directory, build.PYTHON_ZIPAPP)
+        build.build_zipapp(zipapp, PYTHON_SCRIPT_SOURCE)
+        bare = build.startup_time(['-c', 'pass'], runs)
+        report('python -c pass', bare)
+        for name, script in [['python pyscripts.py', PYTHON_SCRIPT_SOURCE], ['python ' + build.PYTHON_ZIPAPP, zipapp]]:
+            seconds = build.startup_time([script, 'test', 'x'], runs)
+            report(name, seconds, "(%.1f ms over python)" % ((seconds - bare) * 1000))
+        try:
+            build.check_startup(zipapp)
+        except Exception, e:
+            print "  Regression: %s" % e
+            return False
+    finally:
+        shutil.rmtree(directory)
+
+def bench_transport(options, sizes=(100 * 1024, 10 * 1024 * 1024)):
+    """Time for a whole-document task through the file transport, against reading the file once."""
+    import tempfile
+    print "File transport ('case_lower')"
+    directory = tempfile.mkdtemp()
+    try:
+        input_path = os.path.join(directory, 'input.txt')
+        output_path = os.path.join(directory, 'output.txt')
+        for size in sizes:
+            with open(input_path, 'wb') as f:
+                f.write('Some Text, \xe2\x80\x9cquoted\xe2\x80\x9d\n' * (size // 30 + 1))
+            label = "%d KB" % (size // 1024)
+            report("read file, %s" % label, timed(lambda: open(input_path, 'rb').read().decode('utf-8')))
+            report("--input/--output, %s" % label, timed(lambda: pyscripts.write_output(output_path,
+                pyscripts.Tasks().run_task('case_lower', pyscripts.read_input(input_path)))))
+            report("subprocess --input/--output, %s" % label, timed(lambda: run_command([sys.executable,
+                PYTHON_SCRIPT_SOURCE, '--input', input_path, '--output', output_path, 'case_lower']), 3))
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+def make_table(rows):
+    """Returns an unformatted Markdown table with the given number of body rows."""
+    lines = [u'Name|Amount|Notes', u':---|---:|:---:']
+    for i in xrange(rows):
+        lines.append(u'item %d| %d |%s' % (i, i * 37 % 1000, u'\u540d\u524d' if i % 7 == 0 else u'n/a'))
+    return u'\n'.join(lines) + u'\n'
+
+def bench_table(options, sizes=(1000, 100000, 1000000)):
+    """Time to format Markdown tables of increasing numbers of rows."""
+    print "Build Table Markdown"
+    tasks = pyscripts.Tasks()
+    for rows in sizes:
+        txt = make_table(rows)
+        seconds = timed(lambda: tasks.task_build_table_markdown(txt), 3 if rows < 1000000 else 1)
+        report("%d rows" % rows, seconds, "(%.2f us/row)" % (seconds * 1e6 / rows))
+
+# The character-mapping tasks as they were before Translation, for comparison
+
+def legacy_replace_with_hyphens(txt):
+    return txt.lower().replace(' ', '-').replace('_', '-')
+
+def legacy_escape_backslashes(txt):
+    return txt.replace('\\', '\\\\')
+
+def legacy_swap_quotes(txt):
+    new_txt = ''
+    for i in txt:
+        if i == '\'':
+            new_txt += '"'
+        elif i == '"':
+            new_txt += '\''
+        else:
+            new_txt += i
+    return new_txt
+
+def bench_table_columns(options, rows=100000):
+    """Time to sort, filter and rearrange a Markdown table held column by column, against
+    formatting it."""
+    print "Table columns (%d rows)" % rows
+    tasks = pyscripts.Tasks(cache=False)
+    txt = make_table(rows)
+    report('build_table_markdown', timed(lambda: tasks.run_task('build_table_markdown', txt), 3))
+    for task in ['sort_table', 'sort_table:2', 'sort_table:-3,2', 'filter_table:3!=n/a', 'remove_duplicate_table_rows',
+            'drop_table_columns:3', 'reorder_table_columns:3,1']:
+        report(task, timed(lambda: tasks.run_task(task, txt), 3))
+    table = pyscripts.Columns(txt)
+    report('sort, keys found', timed(lambda: table.sort([(1, False)]), 3))
+
+def bench_document_tables(options, tables=4, rows=50000):
+    """Time to format every table in a document of prose and large tables, here and with a
+    pool of processes."""
+    print "Document tables (%d tables of %d rows, among prose)" % (tables, rows)
+    tasks = pyscripts.Tasks(cache=False)
+    prose = u'A paragraph of prose | with a pipe in it, which is not a table.\n\n' * 1000
+    pipe = u'|a|b|c|\n|---|:-:|---:|\n' + u'|one|two|three|\n' * rows
+    grid = u'+---+---+\n|a|b|\n+===+===+\n' + u'|one|two|\n+---+---+\n' * (rows // 2)
+    txt = prose + u''.join((pipe if i % 2 else grid) + u'\n' + prose for i in range(tables))
+    report('format_tables, 1 job', timed(lambda: pyscripts.format_tables(txt, jobs=1), 3))
+    report('format_tables, pool of 4', timed(lambda: pyscripts.format_tables(txt, jobs=4), 3))
+    report('format_tables, prose only', timed(lambda: tasks.run_task('format_tables', prose * 10), 3))
+
+def bench_translation(options, size=10 * 1024 * 1024, legacy_swap_size=20 * 1024):
+    """Time for the character-mapping tasks, against the implementations they replaced."""
+    print "Character translations (%d KB)" % (size // 1024)
+    line = u'It\'s a "quoted" phrase with_underscores, spaces and \\ back\u2010slashes.\n'
+    txt = line * (size // len(line))
+    tasks = pyscripts.Tasks()
+    for name, legacy in [['replace_with_hyphens', legacy_replace_with_hyphens],
+            ['escape_backslashes', legacy_escape_backslashes]]:
+        report("%s (legacy)" % name, timed(lambda: legacy(txt), 3))
+        report(name, timed(lambda: tasks.run_task(name, txt), 3))
+    # The legacy quote swap is quadratic, so is only run on a small text
+    small_txt = line * (legacy_swap_size // len(line))
+    seconds = timed(lambda: legacy_swap_quotes(small_txt), 1)
+    report("swap_quotes (legacy, %d KB)" % (legacy_swap_size // 1024), seconds)
+    report("swap_quotes", timed(lambda: tasks.task_swap_quotes(txt), 3))
+
+#
+# Task Scaling Benchmark
+#
+
+# Sizes of the generated inputs, in characters
+TASK_SIZES = [10 ** i for i in range(2, 9)]
+
+# Tasks with side effects, or needing a glossary, which are not run
+SKIPPED_TASKS = ['glossary', 'glossary_link', 'search_with_duckduckgo']
+
+# Tasks given an input other than prose
+TASK_INPUTS = {
+    'build_table_markdown': 'markdown_table',
+    'build_table_rst': 'rst_table',
+    'css': 'css',
+    'drop_table_columns': 'markdown_table',
+    'filter_table': 'markdown_table',
+    'format_tables': 'document_tables',
+    'normalize_headings': 'rst_headings',
+    'over_and_underlines': 'rst_headings',
+    'remove_duplicate_table_rows': 'markdown_table',
+    'reorder_table_columns': 'markdown_table',
+    'table_of_contents': 'markdown_headings',
+    'sort_table': 'markdown_table',
+    'sort_table_descending': 'markdown_table',
+    'underline': 'rst_headings',
+    'wrap': 'bullet_list',
+}
+
+# Options given to tasks needing one
+TASK_OPTIONS = {
+    'drop_table_columns': '2',
+    'filter_table': '3!=n/a',
+    'reorder_table_columns': '3,1',
+}
+
+# Blocks repeated to make each kind of input
+INPUT_BLOCKS = {
+    'prose': u'It\'s a "quoted" phrase with_underscores, hyphen-ated words and a \\ back\u2010slash.\n'
+        u'  Indented caf\xe9 line with \u540d\u524d and *emphasis*.\n\n',
+    'markdown_table': u'item one| 37 |\u540d\u524d\n:---|---:|:---:\nitem two  |1000| n/a |\n',
+    'rst_table': u'| Name | Value |\n|---|---|\n| alpha |  1 |\n| beta | 22 |\n',
+    'css': u'/* Section */\nbody { margin: 0; padding: 0 }\na:hover {color: #fff}\n.menu\n{\n    display: block;\n}\n',
+    'bullet_list': u'- A bullet item that\ncontinues on a second line\n    * a nested item\n    that continues\nA paragraph.\n',
+    'markdown_headings': u'# Title\n\nSome text.\n\n## Section *one*\n\n### Caf\xe9 [\u540d\u524d](http://example.com) ##\n\n',
+    'rst_headings': u'Section Title\n-----\n\nBody text for the section.\n\n=====\nChapter\n=====\n\n',
+    'document_tables': u'A paragraph | with a pipe.\n\n|a|b|\n|---|---|\n|one|two|\n\n+---+---+\n|a|b|\n+===+===+\n'
+        u'|one|two|\n+---+---+\n\n=====  ==\nA      B\n=====  ==\none    \u540d\u524d\n=====  ==\n\n',
+}
+
+def make_input(kind, size):
+    """Returns generated text of a kind, size characters long."""
+    block = INPUT_BLOCKS[kind]
+    return (block * (size // len(block) + 1))[:size]
+
+def task_names():
+    """Returns the names of the tasks of pyscripts.Tasks, without aliases."""
+    names = []
+    functions = set()
+    for attribute in sorted(dir(pyscripts.Tasks)):
+        if not attribute.startswith('task_') or attribute == 'task_':
+            continue
+        name = attribute[len('task_'):]
+        function = getattr(pyscripts.Tasks, attribute).im_func
+        if name in SKIPPED_TASKS or function in functions:
+            continue
+        functions.add(function)
+        names.append(name)
+    return names
+
+def measure(task, txt, time_limit, repeat=3):
+    """Runs a task in forked processes, returning its best wall time and its peak memory use.
+
+    Returns (seconds, peak KB above the starting memory use), or a message if the task failed
+    or took longer than time_limit seconds. Runs taking over a second are not repeated.
+    """
+    import resource
+    import signal
+
+    def run(function):
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # Nothing may escape from the child, which would otherwise carry on benchmarking
+            try:
+                os.close(read_end)
+                signal.alarm(int(math.ceil(time_limit)))
+                start = time.time()
+                function()
+                os.write(write_end, repr(time.time() - start))
+            except BaseException, e:
+                os.write(write_end, "error: %s" % e)
+            finally:
+                os._exit(0)
+        os.close(write_end)
+        chunks = []
+        while True:
+            chunk = os.read(read_end, 4096)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        os.close(read_end)
+        pid, status, usage = os.wait4(pid, 0)
+        output = ''.join(chunks)
+        if os.WIFSIGNALED(status):
+            return "over the %ss time limit" % time_limit, 0
+        if output.startswith('error'):
+            return output, 0
+        # ru_maxrss is in KB on Linux and in bytes on macOS
+        peak = usage.ru_maxrss // 1024 if sys.platform == 'darwin' else usage.ru_maxrss
+        return float(output), peak
+
+    tasks = pyscripts.Tasks()
+    idle_seconds, idle_peak = run(lambda: None)
+    best = None
+    for i in range(repeat):
+        seconds, peak = run(lambda: tasks.run_task(task, txt))
+        if isinstance(seconds, str):
+            return seconds
+        if best is None or seconds < best[0]:
+            best = seconds, max(peak - idle_peak, 0)
+        if seconds > 1:
+            break
+    return best
+
+def scaling_exponent(points):
+    """Returns the slope of log(time) against log(size): 1 is linear, 2 quadratic.
+
+    Times under a millisecond are mostly overhead and are ignored.
+    """
+    points = [(math.log(size), math.log(seconds)) for size, seconds in points if seconds >= 0.001]
+    if len(points) < 2:
+        return None
+    mean_x = sum(x for x, y in points) / len(points)
+    mean_y = sum(y for x, y in points) / len(points)
+    variance = sum((x - mean_x) ** 2 for x, y in points)
+    return sum((x - mean_x) * (y - mean_y) for x, y in points) / variance
+
+def compare_baseline(results, baseline, threshold, noise=0.005):
+    """Returns descriptions of the task timings more than threshold times their baseline."""
+    regressions = []
+    for task, result in sorted(results.items()):
+        for size, timing in sorted(result['timings'].items(), key=lambda item: int(item[0])):
+            old_timing = baseline.get('tasks', {}).get(task, {}).get('timings', {}).get(size)
+            if not old_timing or timing['seconds'] < noise:
+                continue
+            ratio = timing['seconds'] / max(old_timing['seconds'], 1e-9)
+            if ratio > threshold:
+                regressions.append("%s, %s chars: %.2f ms against %.2f ms (x%.2f)" % (task, size,
+                    timing['seconds'] * 1000, old_timing['seconds'] * 1000, ratio))
+    return regressions
+
+def bench_tasks(options):
+    """Times every task on inputs of increasing size, checking scaling and the baseline."""
+    sizes = [size for size in TASK_SIZES if size <= options.max_size]
+    names = [name for name in task_names() if not options.task or name in options.task]
+    print "Tasks (sizes %s chars)" % ', '.join(str(size) for size in sizes)
+    results = {}
+    for name in names:
+        kind = TASK_INPUTS.get(name, 'prose')
+        timings = {}
+        for size in sizes:
+            txt = make_input(kind, size)
+            task = "%s:%s" % (name, TASK_OPTIONS[name]) if name in TASK_OPTIONS else name
+            measurement = measure(task, txt, options.time_limit)
+            del txt
+            if isinstance(measurement, str):
+                print "  %-24s %10d chars   %s" % (name, size, measurement)
+                break
+            seconds, peak = measurement
+            timings[str(size)] = {'seconds': seconds, 'peak_kb': peak}
+            print "  %-24s %10d chars %10.2f ms %10d KB" % (name, size, seconds * 1000, peak)
+            if seconds > options.time_limit / 10.0:
+                # The next size would take about ten times as long
+                break
+        exponent = scaling_exponent([(int(size), timing['seconds']) for size, timing in timings.items()])
+        results[name] = {'input': kind, 'timings': timings, 'exponent': exponent}
+        if exponent is not None and exponent > options.exponent_limit:
+            print "  %-24s super-linear: time grows as size^%.2f" % (name, exponent)
+
+    failed = False
+    if options.baseline and os.path.exists(options.baseline):
+        with open(options.baseline) as f:
+            regressions = compare_baseline(results, json.load(f), options.threshold)
+        print "Compared with baseline '%s': %d regressions" % (options.baseline, len(regressions))
+        for regression in regressions:
+            print "  %s" % regression
+        failed = bool(regressions)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump({'version': pyscripts.VERSION, 'python': sys.version.split()[0], 'tasks': results},
+                f, indent=1, sort_keys=True)
+        print "Saved results to '%s'" % options.save
+    return not failed
+
+def bench_css(options, sizes=(1024 * 1024, 4 * 1024 * 1024)):
+    """Time to reformat minified stylesheets, with every rule on one line."""
+    print "CSS (minified)"
+    block = (u'/* c */.nav>li a:hover,.nav>li a:focus{color:#fff;background:url("i{;}.png")}'
+        u'@media (min-width:768px){.col-1{width:8.3%;float:left}.row::after{content:"";clear:both}}')
+    tasks = pyscripts.Tasks()
+    for size in sizes:
+        txt = block * (size // len(block))
+        seconds = timed(lambda: tasks.task_css(txt), 3)
+        report("%d KB on one line" % (size // 1024), seconds, "(%.1f MB/s)" % (size / seconds / (1024 * 1024)))
+
+def bench_build(options, compile_seconds=0.05):
+    """Time for full and incremental builds, using a stand-in compiler so it runs without macOS.
+
+    The stand-in sleeps for compile_seconds per script, roughly the cost of osacompile, to show
+    the effect of compiling scripts in parallel.
+    """
+    import shutil
+    import tempfile
+    print "Build (stand-in compiler taking %d ms per script)" % (compile_seconds * 1000)
+    directory = tempfile.mkdtemp()
+    try:
+        for name in ['build.py', PYTHON_SCRIPT_SOURCE, PYTHON_CLIENT_SOURCE]:
+            shutil.copy(name, directory)
+        compiler = "--compiler=sh -c 'sleep %s; cat > \"$0\"' %%(output)s" % compile_seconds
+
+        def run_build(*arguments):
+            subprocess.check_call([sys.executable, 'build.py', compiler] + list(arguments), cwd=directory,
+                stdout=open(os.devnull, 'w'))
+
+        report('full build, 1 job', timed(lambda: run_build('--force', '--jobs=1'), 1))
+        report('full build, 8 jobs', timed(lambda: run_build('--force', '--jobs=8'), 1))
+        report('unchanged build', timed(lambda: run_build(), 3))
+        with open(os.path.join(directory, PYTHON_SCRIPT_SOURCE), 'a') as f:
+            f.write('\n')
+        report('build after changing pyscripts.py', timed(lambda: run_build(), 1))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_wrap(options, sizes=(1024 * 1024, 10 * 1024 * 1024)):
+    """Time to fill paragraphs and nested list items, including lines of single long words."""
+    print "Wrap"
+    block = (u'A paragraph of prose, long enough to be filled across several lines, with caf\xe9 and '
+        u'\u540d\u524d among its words, written without any care for where its lines break. ' * 3 + u'\n\n'
+        u'- A bullet item\nthat continues\n    * and a nested item with a http://example.com/a/very/long/url/'
+        u'that/is/wider/than/the/width/of/any/line/at/all\n\n')
+    tasks = pyscripts.Tasks()
+    for size in sizes:
+        txt = block * (size // len(block))
+        seconds = timed(lambda: tasks.task_wrap(txt), 3 if size < 10 * 1024 * 1024 else 1)
+        report("%d KB" % (size // 1024), seconds, "(%.1f MB/s)" % (size / seconds / (1024 * 1024)))
+    # A paragraph many lines long, whose breaks are found together
+    txt = u' '.join([u'word', u'longer-words', u'a'] * (sizes[-1] // 22))
+    seconds = timed(lambda: tasks.task_wrap(txt), 1)
+    report("one %d KB paragraph" % (len(txt) // 1024), seconds, "(%.1f MB/s)" % (len(txt) / seconds / (1024 * 1024)))
+
+def bench_headings(options, sizes=(1000, 10000, 100000)):
+    """Time to normalize the headings of RST documents, and to make the table of contents of
+    Markdown documents, with increasing numbers of headings."""
+    print "Normalize Headings"
+    block = (u'=====\nChapter %d\n=====\n\nSome text.\n\nSection\n---\n\nMore text, and\na paragraph.\n\n'
+        u'Subsection \u540d\u524d\n~~~~~~~~~~~~~~~~~~~~~~~~~\n\n    literal::\n\n')
+    tasks = pyscripts.Tasks()
+    for headings in sizes:
+        txt = u''.join([block % i for i in xrange(headings // 3)])
+        seconds = timed(lambda: tasks.task_normalize_headings(txt), 3)
+        report("%d headings" % headings, seconds, "(%.2f us/heading)" % (seconds * 1e6 / headings))
+    print "Table of Contents"
+    block = (u'# Chapter %d\n\nSome text.\n\n## Getting Started\n\nMore text, and\na paragraph.\n\n'
+        u'### Caf\xe9 [\u540d\u524d](http://example.com) ##\n\n```\n# literal\n```\n\n')
+    for headings in sizes:
+        txt = u''.join([block % i for i in xrange(headings // 3)])
+        seconds = timed(lambda: tasks.task_table_of_contents(txt), 3)
+        report("%d headings" % headings, seconds, "(%.2f us/heading)" % (seconds * 1e6 / headings))
+
+def bench_glossary(options, terms=5000, size=1024 * 1024):
+    """Time to compile a glossary, to load it compiled, and to find its terms in a document."""
+    import random
+    import shutil
+    import tempfile
+    print "Glossary (%d terms)" % terms
+    directory = tempfile.mkdtemp()
+    cache_directory = pyscripts.GLOSSARY_CACHE_DIRECTORY
+    try:
+        pyscripts.GLOSSARY_CACHE_DIRECTORY = directory
+        words = [u'alpha', u'beta', u'gamma', u'delta', u'caf\xe9', u'node', u'tree', u'graph', u'edge', u'path']
+        generator = random.Random(0)
+        entries = set()
+        while len(entries) < terms:
+            entries.add(u' '.join(generator.choice(words) + str(generator.randint(0, 99))
+                for i in range(generator.randint(1, 3))))
+        path = os.path.join(directory, 'glossary.txt')
+        with open(path, 'wb') as f:
+            f.write(u''.join(u"%s\thttp://example.com/%d\n" % (entry, i) for i, entry in enumerate(entries)).encode('utf-8'))
+
+        def load():
+            pyscripts._GLOSSARIES.clear()
+            return pyscripts.load_glossary(path)
+
+        def compile_glossary():
+            for name in os.listdir(directory):
+                if name.endswith('.glossary'):
+                    os.unlink(os.path.join(directory, name))
+            load()
+
+        report('compile', timed(compile_glossary, 3))
+        report('load compiled', timed(load, 3))
+        glossary = load()
+        txt = u' '.join(generator.choice(words) + str(generator.randint(0, 120)) for i in xrange(size // 7))
+        seconds = timed(lambda: glossary.find(txt), 3)
+        report("find in %d KB" % (len(txt) // 1024), seconds, "(%.1f MB/s, %d occurrences)" % (
+            len(txt) / seconds / (1024 * 1024), len(glossary.find(txt))))
+    finally:
+        pyscripts.GLOSSARY_CACHE_DIRECTORY = cache_directory
+        shutil.rmtree(directory)
+
+def bench_cache(options, size=1024 * 1024, entries=200):
+    """Time to run a task with a cold result cache, a warm one and none, and to store results
+    in a full cache."""
+    import shutil
+    import tempfile
+    print "Result cache (%d KB input)" % (size // 1024)
+    txt = (u'A line of prose, to be filled with the others in its paragraph\n' * 4 + u'\n') * (size // 325)
+    directory = tempfile.mkdtemp()
+    try:
+        report('wrap, no cache', timed(lambda: pyscripts.Tasks(cache=False).run_task('wrap', txt), 3))
+
+        def cold():
+            shutil.rmtree(directory)
+            pyscripts.Tasks(cache=pyscripts.ResultCache(directory)).run_task('wrap', txt)
+
+        report('wrap, cache miss', timed(cold, 3))
+        tasks = pyscripts.Tasks(cache=pyscripts.ResultCache(directory))
+        report('wrap, cache hit', timed(lambda: tasks.run_task('wrap', txt)))
+        # Small results, so that every store past the limit evicts
+        small = txt[:16 * 1024]
+        cache = pyscripts.ResultCache(directory, max_bytes=len(small) * entries)
+        seconds = timed(lambda: [cache.put(cache.key('wrap', "%d%s" % (i, small[:32])), small)
+            for i in xrange(entries * 2)], 1)
+        report("store %d results in a full cache" % (entries * 2), seconds, "(%d evictions)" % (
+            cache.statistics()['evictions']))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_metrics(options, runs=1000):
+    """Time to run a small task with and without recording metrics, and to report on the log."""
+    import tempfile
+    print "Metrics (%d runs of 'bold')" % runs
+    directory = tempfile.mkdtemp()
+    try:
+        log = pyscripts.MetricsLog(os.path.join(directory, 'metrics.log'))
+        for name, tasks in [['without metrics', pyscripts.Tasks(cache=False, metrics=False)],
+                ['with metrics', pyscripts.Tasks(cache=False, metrics=log)]]:
+            seconds = timed(lambda: [tasks.run_task('bold', u'some text') for i in xrange(runs)], 3)
+            report(name, seconds / runs, "(per run)")
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            seconds = timed(lambda: pyscripts.metrics_report([log.path]), 3)
+        finally:
+            sys.stdout = stdout
+        report("report (%d records)" % len(list(log.records())), seconds)
+    finally:
+        for name in os.listdir(directory):
+            os.unlink(os.path.join(directory, name))
+        os.rmdir(directory)
+
+def bench_watch(options, tables=5000):
+    """Time for the watcher to format a file after one table in it is edited, against
+    formatting every table in it."""
+    import shutil
+    import tempfile
+    print "Watch (%d tables)" % tables
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'tables.md')
+        table = u'Heading %d\n==========\n\n|a|b|c|\n|---|:-:|---:|\n|one|two|three|\n|four|five|six|\n\n'
+        txt = u''.join(table % i for i in xrange(tables))
+        lines = pyscripts.split_lines(txt)
+        with open(path, 'wb') as f:
+            f.write(txt.encode('utf-8'))
+        watcher = pyscripts.Watcher([directory])
+        edited = list(lines)
+        edited[len(lines) // 2 + 5] = u'|an edited cell|b|c|'
+        edited_txt = pyscripts.join_lines(edited, txt)
+
+        def edit():
+            with open(path, 'wb') as f:
+                f.write(edited_txt.encode('utf-8'))
+            watcher.snapshot(path, None, lines)
+            watcher.update(path)
+
+        report('format the edited table', timed(edit, 3))
+        report('format every table', timed(lambda: pyscripts.format_blocks(edited, [(0, len(edited))]), 3))
+    finally:
+        shutil.rmtree(directory)
+
+def bench_edits(options, size=5 * 1024 * 1024):
+    """Time to find the edits made by tasks changing a little, and a lot, of a large text, with
+    the size of the edit script against that of the result."""
+    print "Edits (%d KB input)" % (size // 1024)
+    tasks = pyscripts.Tasks(cache=False)
+    line = u'| a cell | another cell | a third cell |\n'
+    table = u'| a | b | c |\n| --- | --- | --- |\n' + line * (size // len(line))
+    table = tasks.run_task('build_table_markdown', table)
+    txt = table.replace(line, u'|a cell|another|a third cell|\n', 1)
+    cases = [
+        ['one row of a table', 'build_table_markdown', txt],
+        ['every line', 'shift_right', txt],
+        ['a formatted table', 'build_table_markdown', table],
+    ]
+    for name, task, parameter in cases:
+        new_txt = tasks.run_task(task, parameter)
+        seconds = timed(lambda: pyscripts.format_edits(pyscripts.diff_edits(parameter, new_txt), new_txt), 3)
+        edits = pyscripts.diff_edits(parameter, new_txt)
+        script = pyscripts.format_edits(edits, new_txt)
+        report("diff %s (%s)" % (name, task), seconds, "(%d edits, %d KB script, %d KB result)" % (len(edits),
+            len(script.encode('utf-8')) // 1024, len(new_txt.encode('utf-8')) // 1024))
+
+# The line tasks as they were before the line engine, for comparison
+
+def legacy_line_task(function):
+    def task(txt):
+        return pyscripts.add_ending('\n'.join([function(line) for line in txt.splitlines()]), txt)
+    return task
+
+def legacy_rst_comment(txt):
+    commented = False
+    new_lines = []
+    lines = txt.splitlines()
+    for line in lines:
+        if lines[0].startswith('..'):
+            commented = True
+        if commented:
+            if line.startswith('.. '):
+                new_lines.append(line[3:])
+            else:
+                new_lines.append(line)
+        else:
+            new_lines.append('.. ' + line)
+    return pyscripts.add_ending('\n'.join(new_lines), txt)
+
+LEGACY_LINE_TASKS = [
+    ['shift_left', legacy_line_task(lambda line: line[1:] if line.startswith(' ') else line)],
+    ['shift_right', legacy_line_task(lambda line: " %s" % line)],
+    ['delete_left', legacy_line_task(lambda line: line[1:])],
+    ['rst_comment', legacy_rst_comment],
+]
+
+def bench_lines(options, lines=1000000):
+    """Time for the line tasks on texts of a million lines, with each kind of line terminator,
+    against the implementations they replaced."""
+    print "Line tasks (%d lines)" % lines
+    tasks = pyscripts.Tasks()
+    line = u'  A line of text, indented, with caf\xe9 in it'
+    for ending in [u'\n', u'\r\n']:
+        txt = (line + ending) * lines
+        for name, legacy in LEGACY_LINE_TASKS:
+            if ending == u'\n':
+                report("%s (legacy)" % name, timed(lambda: legacy(txt), 3))
+            report("%s (%r)" % (name, str(ending)), timed(lambda: tasks.run_task(name, txt), 3))
+        report("shift_left|shift_right (%r)" % str(ending), timed(lambda: tasks.run_task('shift_left|shift_right', txt), 3))
+    # Removing comment markers from a text with a few comments
+    txt = (u'.. A comment\n' + (line + u'\n') * 99) * (lines // 100)
+    report('rst_comment, uncommenting (legacy)', timed(lambda: legacy_rst_comment(txt), 3))
+    report('rst_comment, uncommenting', timed(lambda: tasks.run_task('rst_comment', txt), 3))
+    # Filling paragraphs takes far longer than finding their lines
+    txt = (u'A line of prose, to be filled with the others in its paragraph\n' * 4 + u'\n') * (lines // 50)
+    report("wrap (%d lines)" % (lines // 10), timed(lambda: tasks.run_task('wrap', txt), 1))
+
+BENCHMARKS = [
+    ['tasks', bench_tasks],
+    ['startup', bench_startup],
+    ['server', bench_server],
+    ['fragments', bench_fragments],
+    ['transport', bench_transport],
+    ['table', bench_table],
+    ['table_columns', bench_table_columns],
+    ['document_tables', bench_document_tables],
+    ['translation', bench_translation],
+    ['css', bench_css],
+    ['lines', bench_lines],
+    ['wrap', bench_wrap],
+    ['headings', bench_headings],
+    ['glossary', bench_glossary],
+    ['cache', bench_cache],
+    ['metrics', bench_metrics],
+    ['watch', bench_watch],
+    ['edits', bench_edits],
+    ['build', bench_build],
+]
+
+#
+# Main function
+#
+
+def main():
+    """ Main program entry point
+    """
+
+    import argparse
+    parser = argparse.ArgumentParser(prog='benchmark.py')
+    parser.add_argument('names', nargs='*', metavar='benchmark',
+        help="benchmarks to run, from %s (default: all)" % ', '.join(name for name, function in BENCHMARKS))
+    parser.add_argument('--task', action='append', help='only time this task (may be repeated)')
+    parser.add_argument('--max-size', type=int, default=10 ** 7, help='largest input, in characters')
+    parser.add_argument('--time-limit', type=float, default=20.0, help='seconds allowed for one run of a task')
+    parser.add_argument('--exponent-limit', type=float, default=1.3,
+        help='scaling exponent above which a task is flagged as super-linear')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25,
+        help='ratio to the baseline time above which a timing is a regression')
+    parser.add_argument('--save', help='file to save the JSON results to, for use as a baseline')
+    options = parser.parse_args()
+
+    passed = True
+    for name, function in BENCHMARKS:
+        if not options.names or name in options.names:
+            if function(options) is False:
+                passed = False
+    if not passed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
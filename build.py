@@ -19,9 +19,15 @@
 # Used to build BBEdit AppleScripts
 #
 
+import hashlib
+import json
 import os
+import shlex
+import shutil
 import subprocess
 import sys
+import time
+import zipfile
 sys.dont_write_bytecode = True
 # Avoids creating a .pyc file when importing from another file:
 from pyscripts import VERSION as PYTHON_SCRIPT_VERSION
@@ -37,6 +43,25 @@ PYTHON_SCRIPT_SOURCE = 'pyscripts.py'
 PYTHON_SCRIPT_SOURCE_NAME = PYTHON_SCRIPT_SOURCE[:-3]
 PYTHON_SCRIPT_NAME = "%s-v%s" % (PYTHON_SCRIPT_SOURCE_NAME, PYTHON_SCRIPT_VERSION)
 PYTHON_SCRIPT = "%s.py" % PYTHON_SCRIPT_NAME
+PYTHON_ZIPAPP = "%s.pyz" % PYTHON_SCRIPT_NAME
+
+# How pyscripts is installed: 'zipapp', a zip archive of pyscripts and its bytecode that python
+# runs as a script, so that each command loads the bytecode rather than compiling pyscripts;
+# or 'source', pyscripts itself
+PACKAGES = ('zipapp', 'source')
+DEFAULT_PACKAGE = 'zipapp'
+
+# Modules a command may import besides those python imports on starting (and those it imports
+# to run a zip archive). Modules imported when pyscripts is loaded slow every command, so any
+# others fail the build; import them in the functions using them
+STARTUP_MODULES = set(['array', 'encodings.utf_8', 're', 'sre_compile', 'sre_constants', 'sre_parse',
+    'time', 'unicodedata', 'imp', 'pkgutil', 'runpy', 'zlib'])
+# Runs of a command timed to find how long it takes to start
+STARTUP_RUNS = 5
+
+# Started by each AppleScript; forwards the command to a pyscripts server when one is running
+PYTHON_CLIENT_SOURCE = 'pyscripts_client.py'
+PYTHON_CLIENT = "%s-v%s.py" % (PYTHON_CLIENT_SOURCE[:-3], PYTHON_SCRIPT_VERSION)
 
 PACKAGE = "%s.bbpackage" % PYTHON_SCRIPT_NAME
 
@@ -45,6 +70,19 @@ SCRIPTS_README = "READ_ME_%s.md" % PYTHON_SCRIPT_NAME
 
 INSTALL_SCRIPT = 'install.sh'
 
+# Folder in TARGET_DIR that is built and then zipped
+APP_SCRIPTS = "%s-pyscripts-v%s" % (APPLICATION, PYTHON_SCRIPT_VERSION)
+ZIPPED_FILE = "%s.zip" % APP_SCRIPTS
+APP_SCRIPTS_DIR = "%s/%s" % (TARGET_DIR, APP_SCRIPTS)
+SCRIPTS_DIR = "%s/%s/Contents/%s" % (APP_SCRIPTS_DIR, PACKAGE, SCRIPTS_DIRECTORY)
+RESOURCES_DIR = "%s/%s/Contents/%s" % (APP_SCRIPTS_DIR, PACKAGE, SCRIPTS_RESOURCES_DIRECTORY)
+
+# Timestamp of the files in the ZIP, unless SOURCE_DATE_EPOCH is set
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# Digests of the inputs of each file built, in TARGET_DIR
+BUILD_MANIFEST = '.build-manifest.json'
+
 README_TEMPLATE = """<!-- -*- coding: utf-8; mode: markdown; version: 1; -*- -->
 
 About the %(application)s pyscripts (%(python_script)s)
@@ -89,6 +127,7 @@ end tell
 APPLESCRIPT_TEMPLATE_WITH_SELECTION = """
 tell application "Finder" to set cPath to container of container of (path to me) as Unicode text
 set rPath to (quoted form of POSIX path of (cPath & "Resources:%(script)s"))
+set clientPath to (quoted form of POSIX path of (cPath & "Resources:%(client)s"))
 
 tell application "%(application)s"
     activate
@@ -107,7 +146,7 @@ tell application "%(application)s"
 
     copy selection
 
-    set command to "python " & rPath & " '%(command)s' " & quoted form of (text of (get the clipboard))
+    set command to "python -S " & clientPath & " " & rPath & " '%(command)s' " & quoted form of (text of (get the clipboard))
     set command to command as «class utf8»
     set the clipboard to (do shell script command)
 
@@ -123,6 +162,7 @@ end tell
 APPLESCRIPT_TEMPLATE_NO_SELECTION_REQUIRED = """
 tell application "Finder" to set cPath to container of container of (path to me) as Unicode text
 set rPath to (quoted form of POSIX path of (cPath & "Resources:%(script)s"))
+set clientPath to (quoted form of POSIX path of (cPath & "Resources:%(client)s"))
 
 tell application "%(application)s"
     activate
@@ -135,7 +175,7 @@ tell application "%(application)s"
         end if
     end tell
 
-    set command to "python " & rPath & " '%(command)s'"
+    set command to "python -S " & clientPath & " " & rPath & " '%(command)s'"
     set command to command as «class utf8»
     set the clipboard to (do shell script command)
 
@@ -148,6 +188,242 @@ tell application "%(application)s"
 end tell
 """
 
+# Passes the selection to pyscripts through temporary files rather than as an argument, so
+# that there is no limit on its size and it does not have to be quoted by the shell
+APPLESCRIPT_TEMPLATE_FILE_TRANSPORT = """
+tell application "Finder" to set cPath to container of container of (path to me) as Unicode text
+set rPath to (quoted form of POSIX path of (cPath & "Resources:%(script)s"))
+set inPath to (POSIX path of (path to temporary items)) & "pyscripts-input.txt"
+set outPath to (POSIX path of (path to temporary items)) & "pyscripts-output.txt"
+
+tell application "%(application)s"
+    activate
+    set oldClip to the contents of (get the clipboard)
+
+    tell application "%(application)s"
+        if not (exists text window 1) then
+            display alert "The script '%(script)s' requires an open text window."
+            return
+        end if
+        if length of selection of text window 1 is 0 then
+            display alert "The command '%(command)s' of script '%(script)s' requires a selection in the text window."
+            return
+        end if
+    end tell
+
+    copy selection
+
+    tell current application
+        set inFile to open for access (POSIX file inPath) with write permission
+        set eof of inFile to 0
+        write (text of (get the clipboard)) to inFile as «class utf8»
+        close access inFile
+    end tell
+
+    set command to "python " & rPath & " --input " & quoted form of inPath & " --output " & quoted form of outPath & " '%(command)s'"
+    set command to command as «class utf8»
+    do shell script command
+
+    tell current application
+        try
+            set newText to read (POSIX file outPath) as «class utf8»
+        on error
+            -- reading an empty file fails
+            set newText to ""
+        end try
+    end tell
+    set the clipboard to newText
+
+    set firstCharacter to characterOffset of selection of text window 1
+    set lastCharacter to (length of (get the clipboard)) + firstCharacter
+    paste
+    select (characters (firstCharacter) thru (lastCharacter - 1)) of text of the front window
+
+    set the clipboard to oldClip
+end tell
+"""
+
+# Passes the selection to pyscripts through a temporary file, as the file transport does, but
+# replaces only the parts of the selection that the task changed, rather than pasting the
+# whole result, from the edits pyscripts writes (see pyscripts.format_edits)
+APPLESCRIPT_TEMPLATE_EDITS_TRANSPORT = """
+tell application "Finder" to set cPath to container of container of (path to me) as Unicode text
+set rPath to (quoted form of POSIX path of (cPath & "Resources:%(script)s"))
+set inPath to (POSIX path of (path to temporary items)) & "pyscripts-input.txt"
+set outPath to (POSIX path of (path to temporary items)) & "pyscripts-edits.txt"
+
+tell application "%(application)s"
+    activate
+    set oldClip to the contents of (get the clipboard)
+
+    tell application "%(application)s"
+        if not (exists text window 1) then
+            display alert "The script '%(script)s' requires an open text window."
+            return
+        end if
+        if length of selection of text window 1 is 0 then
+            display alert "The command '%(command)s' of script '%(script)s' requires a selection in the text window."
+            return
+        end if
+    end tell
+
+    copy selection
+
+    tell current application
+        set inFile to open for access (POSIX file inPath) with write permission
+        set eof of inFile to 0
+        write (text of (get the clipboard)) to inFile as «class utf8»
+        close access inFile
+    end tell
+    set the clipboard to oldClip
+
+    set command to "python " & rPath & " --edits --input " & quoted form of inPath & " --output " & quoted form of outPath & " '%(command)s'"
+    set command to command as «class utf8»
+    do shell script command
+
+    tell current application
+        set edits to read (POSIX file outPath) as «class utf8»
+    end tell
+
+    -- The first line gives the number of edits and the length of the result, each following
+    -- line the offset, length and replacement length of an edit, and then come the replacements
+    set editCount to (word 1 of paragraph 1 of edits) as integer
+    set newLength to (word 2 of paragraph 1 of edits) as integer
+    set replacementStart to (length of paragraph 1 of edits) + 2
+    repeat with i from 1 to editCount
+        set replacementStart to replacementStart + (length of paragraph (i + 1) of edits) + 1
+    end repeat
+    set editList to {}
+    repeat with i from 1 to editCount
+        set editFields to words of paragraph (i + 1) of edits
+        set replacementLength to (item 3 of editFields) as integer
+        if replacementLength is 0 then
+            set replacement to ""
+        else
+            set replacement to text replacementStart thru (replacementStart + replacementLength - 1) of edits
+        end if
+        set replacementStart to replacementStart + replacementLength
+        set end of editList to {(item 1 of editFields) as integer, (item 2 of editFields) as integer, replacement}
+    end repeat
+
+    -- Edits are made from the last, so that the offsets of those before it still hold
+    set firstCharacter to characterOffset of selection of text window 1
+    repeat with i from editCount to 1 by -1
+        set {editOffset, editLength, replacement} to item i of editList
+        set editStart to firstCharacter + editOffset
+        if editLength > 0 then
+            select (characters (editStart) thru (editStart + editLength - 1)) of text window 1
+        else if editStart > 1 then
+            select insertion point after character (editStart - 1) of text window 1
+        else
+            select insertion point before character 1 of text window 1
+        end if
+        set selection of text window 1 to replacement
+    end repeat
+    if newLength > 0 then
+        select (characters (firstCharacter) thru (firstCharacter + newLength - 1)) of text window 1
+    end if
+end tell
+"""
+
+# Runs a task on every match of a grep pattern in the front window: the matches are collected
+# and passed to pyscripts in one fragment stream, and replaced by the results, from the last
+# (see pyscripts.read_fragments)
+APPLESCRIPT_TEMPLATE_MATCHES = """
+tell application "Finder" to set cPath to container of container of (path to me) as Unicode text
+set rPath to (quoted form of POSIX path of (cPath & "Resources:%(script)s"))
+set inPath to (POSIX path of (path to temporary items)) & "pyscripts-fragments.txt"
+set outPath to (POSIX path of (path to temporary items)) & "pyscripts-results.txt"
+
+tell application "%(application)s"
+    activate
+
+    if not (exists text window 1) then
+        display alert "The script '%(script)s' requires an open text window."
+        return
+    end if
+
+    set searchPattern to text returned of (display dialog "Run '%(command)s' on every match of the grep pattern:" default answer "")
+    if searchPattern is "" then return
+
+    set matchList to {}
+    set searchOptions to {search mode:grep, starting at top:true, wrap around:false}
+    repeat
+        set searchResult to find searchPattern searching in text 1 of text window 1 options searchOptions with selecting match
+        if not (found of searchResult) or (found text of searchResult) is "" then exit repeat
+        set end of matchList to {characterOffset of found object of searchResult, found text of searchResult}
+        set searchOptions to {search mode:grep, starting at top:false, wrap around:false}
+    end repeat
+    if (count of matchList) is 0 then
+        display alert "No matches of '" & searchPattern & "' were found."
+        return
+    end if
+
+    -- Each fragment is a line giving the length of its text and the task, followed by the text
+    set fragments to ""
+    repeat with matchItem in matchList
+        set fragments to fragments & ((length of (item 2 of matchItem)) as text) & " %(command)s" & linefeed & (item 2 of matchItem)
+    end repeat
+    tell current application
+        set inFile to open for access (POSIX file inPath) with write permission
+        set eof of inFile to 0
+        write fragments to inFile as «class utf8»
+        close access inFile
+    end tell
+
+    set command to "python " & rPath & " --fragments --input " & quoted form of inPath & " --output " & quoted form of outPath
+    set command to command as «class utf8»
+    do shell script command
+
+    tell current application
+        set results to read (POSIX file outPath) as «class utf8»
+    end tell
+
+    -- Each result is a line giving its length and status (OK or ERROR), followed by the text
+    set resultList to {}
+    set resultStart to 1
+    repeat with i from 1 to count of matchList
+        set headerLength to (offset of linefeed in (text resultStart thru -1 of results)) - 1
+        set headerLine to text resultStart thru (resultStart + headerLength - 1) of results
+        set resultLength to (word 1 of headerLine) as integer
+        set resultStart to resultStart + headerLength + 1
+        if resultLength is 0 then
+            set resultText to ""
+        else
+            set resultText to text resultStart thru (resultStart + resultLength - 1) of results
+        end if
+        set resultStart to resultStart + resultLength
+        if word 2 of headerLine is not "OK" then
+            display alert resultText
+            return
+        end if
+        set end of resultList to resultText
+    end repeat
+
+    -- Matches are replaced from the last, so that the offsets of those before it still hold
+    repeat with i from (count of matchList) to 1 by -1
+        set {matchOffset, matchText} to item i of matchList
+        select (characters (matchOffset) thru (matchOffset + (length of matchText) - 1)) of text window 1
+        set selection of text window 1 to item i of resultList
+    end repeat
+end tell
+"""
+
+# How scripts requiring a selection pass it to pyscripts, and have it replaced: 'argv', 'file'
+# or 'edits'
+TRANSPORTS = ('argv', 'file', 'edits')
+
+# Commands compiling an AppleScript read from stdin into %(output)s; 'source' writes the
+# source unchanged, so that the build can be run and tested without macOS
+COMPILERS = {
+    'osacompile': 'osacompile -o %(output)s',
+    'source': None,
+}
+DEFAULT_COMPILER = 'osacompile'
+
+# Number of scripts compiled at once
+COMPILE_JOBS = 8
+
 INSTALL_SCRIPT_TEMPLATE = """#!/bin/bash
 mkdir -p ~/Library/Mobile\ Documents/com~apple~CloudDocs/Application\ Support/%(application)s/Packages/
 rm -f
@@ -168,12 +444,17 @@ APPLESCRIPTS = [
     ['Double Quotes', 'Surrounds the selection in double-quotes ("")'],
     ['Emphasize', 'Surrounds the selection with asterisks (*)'],
     ['Escape Backslashes', 'Escapes any backslashes in the selection'],
-    ['Glossary'],
+    ['Format Tables', 'Formats (pretty-prints) every Markdown and RST table in the selection (select all for the whole document), leaving the text around them as it is'],
+    ['Glossary', """Appends a list of the glossary terms used in the selection, with their definitions and the lines they are used on.
+The glossary is ~/.pyscripts/glossary.txt (or the file named by PYSCRIPTS_GLOSSARY), with one term per line, each optionally followed by a tab and its definition."""],
+    ['Glossary Link', 'Makes each use of a glossary term defined by a URL a Markdown link to it'],
     ['Insert Today\'s Date', 'Inserts today\'s date at the insertion point or replaces selection', 'optional'],
     ['Literal', 'Surrounds the selection in double back-ticks (``)'],
     ['Markdown Literal', 'Surrounds the selection in single back-ticks (`)'],
+    ['Normalize Headings', 'Makes the over- and underlines of every heading in the selection (select all for the whole document) the length of its title, checking that heading levels are consistent'],
     ['Over and Underlines',"""Inserts lines of characters (first character of second line, same length) before and after the first line.
 If there are more than three lines, tries to determine if first two or three lines are an existing title or not."""],
+    ['Remove Duplicate Table Rows', 'Removes the rows of a Markdown table repeating an earlier row, and formats it'],
     ['Replace Hyphens', 'Replaces hyphens (-) with underscores (_)'],
     ['Replace Spaces', 'Replaces spaces ( ) with hyphens (-)'],
     ['Replace with Hyphens', 'Replaces spaces ( ) and underscores (_) with hyphens (-)'],
@@ -182,129 +463,426 @@ If there are more than three lines, tries to determine if first two or three lin
     ['Shift Left', 'Deletes the left-most character of each line, if a space character'],
     ['Shift Right', 'Adds a leading space character to each line'],
     ['Single Quotes', 'Surrounds the selection in single-quotes (\')'],
+    ['Sort Table', 'Sorts the rows of a Markdown table by its first column, numbers by value and text in natural order, and formats it'],
+    ['Sort Table Descending', 'Sorts the rows of a Markdown table by its first column, in descending order, and formats it'],
     ['Strip', 'Removes the leading and trailing characters if they match'],
     ['Swap Quotes', 'Swaps single-quotes for double-quotes and vice-versa'],
+    ['Table of Contents', 'Inserts a nested list of links to the headings of the selection (select all for the whole document), or refreshes the one between its <!-- toc --> and <!-- tocstop --> markers (.. toc and .. tocstop in RST); Markdown links use GitHub anchors'],
     ['Underline', 'Inserts a line of characters (first character of second line, same length) after the first line'],
-    ['Wrap', 'Wraps and indents lines if first character of a line is a hyphen or asterisk'],
+    ['Wrap', 'Fills paragraphs and list items to 80 columns in lines of even length, indenting continued lines under their bullet'],
+]
+
+# Commands running several tasks in one call of pyscripts, with adjacent line-by-line tasks
+# fused into one pass over the lines
+# Script name, pipeline of tasks, help text
+COMPOSITE_APPLESCRIPTS = [
+    ['Quoted Slug', 'replace_with_hyphens|double_quotes',
+        'Changes the selection to lowercase, replaces spaces ( ) and underscores (_) with hyphens (-) and surrounds it in double-quotes ("")'],
+    ['Shift Right Four', 'shift_right|shift_right|shift_right|shift_right', 'Adds four leading space characters to each line'],
 ]
 
-def shell(command):
-    if command.count('\n') > 0:
-        print "command: %s..." % command[:command.index('\n')]
+# Commands running a task on every match of a grep pattern in one call of pyscripts
+# Script name, task, help text
+MATCHES_APPLESCRIPTS = [
+    ['Bold Matches', 'bold', 'Surrounds every match of a grep pattern with double-asterisks (**)'],
+    ['Case Lower Matches', 'case_lower', 'Changes every match of a grep pattern to lowercase'],
+    ['Case Upper Matches', 'case_upper', 'Changes every match of a grep pattern to uppercase'],
+    ['Markdown Literal Matches', 'markdown_literal', 'Surrounds every match of a grep pattern in single back-ticks (`)'],
+]
+
+def write_file(path, text, mode=0644):
+    """Writes a built file, ending it with a return as the shell heredocs used to."""
+    with open(path, 'wb') as f:
+        f.write(text)
+        f.write('\n')
+    os.chmod(path, mode)
+
+def make_directories(path):
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+def zip_info(name, mode, date_time):
+    info = zipfile.ZipInfo(name, date_time)
+    info.create_system = 3
+    info.external_attr = (mode & 0xFFFF) << 16
+    return info
+
+def zip_date_time():
+    """Returns the timestamp of files in ZIP archives: SOURCE_DATE_EPOCH, or ZIP_DATE_TIME."""
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    date_time = time.gmtime(int(epoch))[:6] if epoch else ZIP_DATE_TIME
+    # ZIP timestamps are to the even second
+    return date_time[:5] + (date_time[5] - date_time[5] % 2,)
+
+def build_zipapp(zipapp_path, source):
+    """Builds a zip archive running a script, as __main__, with its bytecode, reproducibly.
+
+    The bytecode is stamped with the time of the script in the archive, so that python loads
+    it rather than compiling the script; a python with different bytecode compiles the script.
+    """
+    import imp
+    import marshal
+    import struct
+    with open(source, 'rb') as f:
+        text = f.read()
+    date_time = zip_date_time()
+    # zipimport compares the time with that of the script in local time, as here
+    mtime = int(time.mktime(date_time + (0, 0, -1)))
+    bytecode = imp.get_magic() + struct.pack('<I', mtime) + marshal.dumps(compile(text, '__main__.py', 'exec'))
+    with zipfile.ZipFile(zipapp_path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as archive:
+        for name, data in [['__main__.py', text], ['__main__.pyc', bytecode]]:
+            info = zip_info(name, 0100644, date_time)
+            info.compress_type = zipfile.ZIP_DEFLATED
+            archive.writestr(info, data)
+    os.chmod(zipapp_path + '.tmp', 0755)
+    os.rename(zipapp_path + '.tmp', zipapp_path)
+
+def startup_modules(arguments):
+    """Returns the names of the modules python imports running with arguments."""
+    process = subprocess.Popen([sys.executable, '-v'] + arguments, stdout=open(os.devnull, 'w'),
+        stderr=subprocess.PIPE)
+    trace = process.communicate()[1]
+    return set(line.split()[1] for line in trace.splitlines() if line.startswith('import '))
+
+def startup_time(arguments, runs=STARTUP_RUNS):
+    """Returns the least time python takes to run with arguments, in seconds."""
+    best = None
+    for i in range(runs):
+        start = time.time()
+        subprocess.check_call([sys.executable] + arguments, stdout=open(os.devnull, 'w'))
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def check_startup(script, source=PYTHON_SCRIPT_SOURCE):
+    """Raises an exception if a command run by an installed script imports modules beyond
+    STARTUP_MODULES, or starts more slowly than one run by source, if given; otherwise returns
+    the times both take to start, in seconds (None for no source), and the number of processes
+    run to find them."""
+    command = ['test', 'x']
+    modules = startup_modules([script] + command) - startup_modules(['-c', 'pass']) - STARTUP_MODULES
+    if modules:
+        raise Exception("'%s' imports %s on starting; import %s where used, or add %s to STARTUP_MODULES" % (
+            script, ', '.join(sorted(modules)), 'them' if len(modules) > 1 else 'it',
+            'them' if len(modules) > 1 else 'it'))
+    script_time = startup_time([script] + command)
+    # Two runs listing the modules imported, and STARTUP_RUNS timed runs of each command
+    if source is None:
+        return script_time, None, 2 + STARTUP_RUNS
+    source_time = startup_time([source] + command)
+    if script_time > source_time:
+        raise Exception("'%s' starts more slowly than '%s' (%.1f ms against %.1f ms)" % (script, source,
+            script_time * 1000, source_time * 1000))
+    return script_time, source_time, 2 + 2 * STARTUP_RUNS
+
+def build_zip(zipped_path, directory):
+    """Zips a directory, with its own name as the top folder, reproducibly.
+
+    Entries are added in sorted order, with the timestamp given by SOURCE_DATE_EPOCH (or
+    1980-01-01), so that building the same files always gives the same archive. The archive is
+    written to a temporary file and renamed into place.
+    """
+    date_time = zip_date_time()
+    parent = os.path.dirname(directory)
+    with zipfile.ZipFile(zipped_path + '.tmp', 'w', zipfile.ZIP_DEFLATED) as archive:
+        for path, directories, names in os.walk(directory):
+            directories.sort()
+            if path != directory:
+                archive.writestr(zip_info(os.path.relpath(path, parent) + '/', 040755, date_time), '')
+            for name in sorted(names):
+                if name == '.DS_Store':
+                    continue
+                file_path = os.path.join(path, name)
+                info = zip_info(os.path.relpath(file_path, parent), os.stat(file_path).st_mode, date_time)
+                info.compress_type = zipfile.ZIP_DEFLATED
+                with open(file_path, 'rb') as f:
+                    archive.writestr(info, f.read())
+    os.rename(zipped_path + '.tmp', zipped_path)
+
+class CompileError(Exception):
+    """A script that could not be compiled, with the compiler's exit status and output."""
+
+    def __init__(self, script_name, returncode, output):
+        Exception.__init__(self, script_name, returncode, output)
+        self.script_name = script_name
+        self.returncode = returncode
+        self.output = output
+
+    def __str__(self):
+        if self.returncode is None:
+            return "'%s': %s" % (self.script_name, self.output.strip())
+        return "'%s': exit status %s: %s" % (self.script_name, self.returncode, self.output.strip())
+
+def content_hash(*parts):
+    """Returns a digest of the given strings (and of the build parameters they include)."""
+    digest = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, unicode):
+            part = part.encode('utf-8')
+        digest.update("%d:%s" % (len(part), part))
+    return digest.hexdigest()
+
+def file_hash(path):
+    with open(path, 'rb') as f:
+        return content_hash(f.read())
+
+
+class BuildManifest(object):
+    """Records a digest of the inputs of each file built, so that unchanged files are not rebuilt.
+
+    The manifest is a JSON object, mapping each file's path to its digest, kept in TARGET_DIR.
+    """
+
+    def __init__(self, path, force=False):
+        self.path = path
+        self.entries = {}
+        self.outputs = set()
+        self.run = 0
+        self.skipped = 0
+        if not force and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.entries = json.load(f)
+            except ValueError:
+                print "Ignoring unreadable manifest '%s'" % path
+
+    def is_current(self, output, digest):
+        """Returns True, counting a skipped step, if output exists and was built from digest."""
+        key = manifest_key(output)
+        self.outputs.add(key)
+        if self.entries.get(key) == digest and os.path.exists(output):
+            self.skipped += 1
+            return True
+        return False
+
+    def record(self, output, digest):
+        output = manifest_key(output)
+        self.outputs.add(output)
+        self.entries[output] = digest
+        self.run += 1
+
+    def prune(self, directory):
+        """Removes files in a directory that were not built by this build, returning how many."""
+        removed = 0
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if manifest_key(path) not in self.outputs and os.path.isfile(path):
+                print "Removing stale '%s'" % path
+                os.unlink(path)
+                self.entries.pop(manifest_key(path), None)
+                removed += 1
+        return removed
+
+    def save(self):
+        for output in list(self.entries):
+            if output not in self.outputs:
+                del self.entries[output]
+        # Written to a temporary file first, so that an interrupted build leaves a readable manifest
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.rename(self.path + '.tmp', self.path)
+
+def manifest_key(path):
+    """Returns a path as unicode, as the manifest's JSON keys are read back; the file system
+    is always given the path as built, in bytes."""
+    return path.decode('utf-8') if isinstance(path, str) else path
+
+def render_script(command, no_selection_required=False, transport='argv', pipeline=None, script=PYTHON_SCRIPT,
+        matches=False):
+    if pipeline:
+        command_cleaned = pipeline
     else:
-        print "command: %s" % command
-    try:
-        output = ''
-        output = subprocess.check_output(command, shell=True, stderr=subprocess.STDOUT,)
-    except:
-        print "command: %s" % command
-        raise Exception('shell', 'output: %s' % output)
-    return output
-
-def build_script(command, no_selection_required=False):
-    command_cleaned = command.replace('-', '_').replace(' ', '_').replace('\'', '').lower()
-    if no_selection_required:
+        command_cleaned = command.replace('-', '_').replace(' ', '_').replace('\'', '').lower()
+    if matches:
+        tmp = APPLESCRIPT_TEMPLATE_MATCHES % {'application': APPLICATION, 'command': command_cleaned,
+            'script': script}
+    elif no_selection_required:
         tmp = APPLESCRIPT_TEMPLATE_NO_SELECTION_REQUIRED % {'application': APPLICATION, 'command': command_cleaned,
-            'script': PYTHON_SCRIPT}
+            'script': script, 'client': PYTHON_CLIENT}
+    elif transport == 'file':
+        tmp = APPLESCRIPT_TEMPLATE_FILE_TRANSPORT % {'application': APPLICATION, 'command': command_cleaned,
+            'script': script}
+    elif transport == 'edits':
+        tmp = APPLESCRIPT_TEMPLATE_EDITS_TRANSPORT % {'application': APPLICATION, 'command': command_cleaned,
+            'script': script}
     else:
         tmp = APPLESCRIPT_TEMPLATE_WITH_SELECTION % {'application': APPLICATION, 'command': command_cleaned,
-            'script': PYTHON_SCRIPT}
-
-    osacompile = """cat <<EOF | osacompile -o "%(target)s/%(application)s/%(package)s/Contents/%(scripts_directory)s/%(command)s.scpt"
-%(tmp)s
-EOF
-""" % {'application': APPLICATION, 'command': command, 'package': PACKAGE,
-            'scripts_directory': SCRIPTS_DIRECTORY, 'target': TARGET_DIR, 'tmp': tmp}
+            'script': script, 'client': PYTHON_CLIENT}
+    return tmp
 
-    shell(osacompile)
-
-def build_documentation_script():
-    command = DOCUMENTATION_COMMAND
-    tmp = README_APPLESCRIPT_TEMPLATE % {'application': APPLICATION,
+def render_documentation_script():
+    return README_APPLESCRIPT_TEMPLATE % {'application': APPLICATION,
         'scripts_resources_directory': SCRIPTS_RESOURCES_DIRECTORY, 'scripts_readme': SCRIPTS_README}
 
-    osacompile = """cat <<EOF | osacompile -o "%(target)s/%(application)s/%(package)s/Contents/%(scripts_directory)s/%(command)s.scpt"
-%(tmp)s
-EOF
-""" % {'application': APPLICATION, 'command': command, 'package': PACKAGE,
-            'scripts_directory': SCRIPTS_DIRECTORY, 'target': TARGET_DIR, 'tmp': tmp}
-
-    shell(osacompile)
-
-def build():
-    print "Building AppleScripts for %(python_script)s, v%(version)s" % {'python_script': PYTHON_SCRIPT, 'version': PYTHON_SCRIPT_VERSION}
-
-    print 'Creating target directories (removing any existing directories)'
-    shell("rm -rf %s" % TARGET_DIR)
-    shell("mkdir -p '%s/%s/%s/Contents/%s'" % (TARGET_DIR, APPLICATION, PACKAGE, SCRIPTS_DIRECTORY))
-    shell("mkdir -p '%s/%s/%s/Contents/%s'" % (TARGET_DIR, APPLICATION, PACKAGE, SCRIPTS_RESOURCES_DIRECTORY))
+def script_path(command):
+    return "%(scripts_dir)s/%(command)s.scpt" % {'scripts_dir': SCRIPTS_DIR, 'command': command}
+
+def compile_script(command, tmp, compiler=DEFAULT_COMPILER):
+    """Compiles an AppleScript's source, passed on stdin, with a compiler from COMPILERS or a
+    command including %(output)s; raises CompileError if the compiler fails."""
+    output = script_path(command)
+    if compiler == 'source':
+        with open(output, 'wb') as f:
+            f.write(tmp)
+        return
+    arguments = [argument % {'output': output} for argument in shlex.split(COMPILERS.get(compiler, compiler))]
+    try:
+        process = subprocess.Popen(arguments, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    except OSError, e:
+        raise CompileError(command, None, str(e))
+    compiler_output = process.communicate(tmp)[0]
+    if process.returncode != 0:
+        raise CompileError(command, process.returncode, compiler_output)
+
+def compile_scripts(scripts, compiler=DEFAULT_COMPILER, jobs=None):
+    """Compiles [script name, source] pairs in parallel, generating [script name, error] pairs
+    as each finishes; the error is None if the script compiled."""
+    from multiprocessing.pool import ThreadPool
+
+    def compile_one(script):
+        try:
+            compile_script(script[0], script[1], compiler)
+            return script[0], None
+        except CompileError, e:
+            return script[0], e
+
+    if not scripts:
+        return
+    pool = ThreadPool(min(jobs or COMPILE_JOBS, len(scripts)))
+    try:
+        for result in pool.imap_unordered(compile_one, scripts):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def build(transport='argv', force=False, compiler=DEFAULT_COMPILER, jobs=None, package=DEFAULT_PACKAGE):
+    start = time.time()
+    python_script = PYTHON_ZIPAPP if package == 'zipapp' else PYTHON_SCRIPT
+    print "Building AppleScripts for %(python_script)s, v%(version)s" % {'python_script': python_script, 'version': PYTHON_SCRIPT_VERSION}
+    print "Passing selections by '%s', compiling with '%s'" % (transport, compiler)
+
+    if force:
+        print 'Creating target directories (removing any existing directories)'
+        if os.path.exists(TARGET_DIR):
+            shutil.rmtree(TARGET_DIR)
+    else:
+        print 'Creating target directories'
+    make_directories(SCRIPTS_DIR)
+    make_directories(RESOURCES_DIR)
+    manifest = BuildManifest(os.path.join(TARGET_DIR, BUILD_MANIFEST), force)
+    # Parameters that change the output of every step
+    parameters = [BUILD_VERSION, str(PYTHON_SCRIPT_VERSION), transport, package]
 
     print 'Creating AppleScripts and creating README'
     readme_text = README_TEMPLATE
-    for script in APPLESCRIPTS:
-        script_name = script[0]
-        if len(script) > 1 and script[1]:
-            script_help_text = script[1]
-        else:
+    scripts = [script + [None] * (3 - len(script)) + [None, False] for script in APPLESCRIPTS]
+    scripts += [[script_name, script_help_text, None, pipeline, False]
+        for script_name, pipeline, script_help_text in COMPOSITE_APPLESCRIPTS]
+    scripts += [[script_name, script_help_text, None, task, True]
+        for script_name, task, script_help_text in MATCHES_APPLESCRIPTS]
+    scripts_to_compile = []
+    for script_name, script_help_text, optional, pipeline, matches in scripts:
+        if not script_help_text:
             script_help_text = 'No description available.'
-        script_help_text = script_help_text.replace('`', '\`')
-        no_selection_required = bool(len(script) > 2)
-        print "Script '%s'" % script_name
-        build_script(script_name, no_selection_required)
+        no_selection_required = bool(optional)
+        scripts_to_compile.append([script_name,
+            render_script(script_name, no_selection_required, transport, pipeline, python_script, matches)])
 
         readme_text += "\n- **%s**\n\n" % script_name
         lines = script_help_text.splitlines()
         for line in lines:
             readme_text += "  %s\n" % line
         readme_text += '\n'
-    print "Script '%s'" % DOCUMENTATION_COMMAND
-    build_documentation_script()
+    scripts_to_compile.append([DOCUMENTATION_COMMAND, render_documentation_script()])
+    digests = {}
+    for script_name, tmp in scripts_to_compile:
+        digest = content_hash(tmp, compiler, *parameters)
+        if not manifest.is_current(script_path(script_name), digest):
+            digests[script_name] = digest
+    errors = []
+    for script_name, error in compile_scripts([script for script in scripts_to_compile if script[0] in digests],
+            compiler, jobs):
+        if error:
+            print "Script '%s' failed" % script_name
+            errors.append(error)
+        else:
+            print "Script '%s'" % script_name
+            manifest.record(script_path(script_name), digests[script_name])
+    if errors:
+        # Keep the scripts that did compile
+        manifest.save()
+        raise Exception("%d scripts failed to compile:\n  %s" % (len(errors),
+            '\n  '.join(str(error) for error in sorted(errors, key=lambda error: error.script_name))))
 
     print 'Copying script library'
-    shell("cp %(python_script_source)s '%(target_dir)s/%(app)s/%(package)s/Contents/Resources/%(python_script)s'" %
-        {'app': APPLICATION, 'package': PACKAGE,
-         'python_script_source': PYTHON_SCRIPT_SOURCE, 'python_script': PYTHON_SCRIPT, 'target_dir': TARGET_DIR})
+    python_script_path = "%s/%s" % (RESOURCES_DIR, python_script)
+    python_script_changed = False
+    startup_processes = 0
+    for source, name in [[PYTHON_SCRIPT_SOURCE, python_script], [PYTHON_CLIENT_SOURCE, PYTHON_CLIENT]]:
+        path = "%s/%s" % (RESOURCES_DIR, name)
+        # The bytecode depends on the python building it
+        digest = content_hash(file_hash(source), package, sys.version) if name == python_script else file_hash(source)
+        if not manifest.is_current(path, digest):
+            if name == PYTHON_ZIPAPP:
+                build_zipapp(path, source)
+            else:
+                shutil.copy(source, path)
+            manifest.record(path, digest)
+            python_script_changed = python_script_changed or name == python_script
+
+    if python_script_changed:
+        print 'Checking startup'
+        try:
+            # Installed as source, pyscripts is not compared with itself
+            script_time, source_time, startup_processes = check_startup(python_script_path,
+                PYTHON_SCRIPT_SOURCE if package != 'source' else None)
+        except Exception:
+            # Checked again by the next build
+            manifest.entries.pop(manifest_key(python_script_path), None)
+            manifest.save()
+            raise
+        print "Commands start in %.1f ms%s" % (script_time * 1000,
+            " (%.1f ms from source)" % (source_time * 1000) if source_time else '')
 
     print 'Writing README'
     app_readme_text = (readme_text % {'application': APPLICATION, 'install_script': INSTALL_SCRIPT, 'package': PACKAGE,
         'python_script': PYTHON_SCRIPT_NAME})
-    app_readme_filepath = ("%(target_dir)s/%(application)s/%(package)s/Contents/Resources/%(readme_file)s" %
-        {'application': APPLICATION, 'package': PACKAGE, 'readme_file': SCRIPTS_README, 'target_dir': TARGET_DIR})
-    write_readme = """cat <<EOF > "%(app_readme_filepath)s"
-%(app_readme_text)s
-EOF
-""" % {'app_readme_filepath': app_readme_filepath, 'app_readme_text': app_readme_text}
-
-    shell(write_readme)
-
-    print 'Copying README'
-    shell("cp %(app_readme_filepath)s %(target_dir)s/%(application)s/%(readme_file)s" %
-        {'application': APPLICATION, 'app_readme_filepath': app_readme_filepath, 'readme_file': SCRIPTS_README,
-            'target_dir': TARGET_DIR})
+    app_readme_filepath = "%s/%s" % (RESOURCES_DIR, SCRIPTS_README)
+    digest = content_hash(app_readme_text, *parameters)
+    # Also written beside the package, to be read before installing it
+    for readme_path in [app_readme_filepath, "%s/%s" % (APP_SCRIPTS_DIR, SCRIPTS_README)]:
+        if not manifest.is_current(readme_path, digest):
+            write_file(readme_path, app_readme_text)
+            manifest.record(readme_path, digest)
 
     print 'Writing install script'
     install_script_text = INSTALL_SCRIPT_TEMPLATE % {'application': APPLICATION, 'package': PACKAGE}
-    install_script_path = ("%(target_dir)s/%(application)s/%(install_script)s" %
-        {'target_dir': TARGET_DIR, 'application': APPLICATION, 'install_script': INSTALL_SCRIPT})
-    write_install = """cat <<EOF > "%(install_script_path)s"
-%(install_script_text)s
-EOF
-""" % {'install_script_path': install_script_path, 'install_script_text': install_script_text}
+    install_script_path = "%s/%s" % (APP_SCRIPTS_DIR, INSTALL_SCRIPT)
+    digest = content_hash(install_script_text, *parameters)
+    if not manifest.is_current(install_script_path, digest):
+        write_file(install_script_path, install_script_text, 0755)
+        manifest.record(install_script_path, digest)
 
-    shell(write_install)
-    shell("chmod +x %(install_script_path)s" % {'install_script_path': install_script_path})
+    pruned = manifest.prune(SCRIPTS_DIR) + manifest.prune(RESOURCES_DIR)
 
     print 'Building ZIP'
-#     app_scripts = "%s-pyscripts" % APPLICATION
-#     zipped_file = "%s-pyscripts-v%s.zip" % (APPLICATION, PYTHON_SCRIPT_VERSION)
-    app_scripts = "%s-pyscripts-v%s" % (APPLICATION, PYTHON_SCRIPT_VERSION)
-    zipped_file = "%s.zip" % app_scripts
-    shell("mv %(target_dir)s/%(app)s %(target_dir)s/%(app_scripts)s" %
-        {'app': APPLICATION, 'app_scripts': app_scripts, 'target_dir': TARGET_DIR})
-    shell("cd %(target_dir)s; zip -qr %(zipped_file)s %(app_scripts)s/* --exclude *.DS_Store*" %
-        {'app_scripts': app_scripts, 'target_dir': TARGET_DIR, 'zipped_file': zipped_file})
-
-    print 'Completed building'
+    zipped_path = "%s/%s" % (TARGET_DIR, ZIPPED_FILE)
+    # The archive depends on everything built before it, and on any files removed from it
+    digest = content_hash(*[manifest.entries[output] for output in sorted(manifest.outputs)])
+    if pruned:
+        manifest.entries.pop(manifest_key(zipped_path), None)
+    if not manifest.is_current(zipped_path, digest):
+        build_zip(zipped_path, APP_SCRIPTS_DIR)
+        manifest.record(zipped_path, digest)
+    manifest.save()
+
+    # The compiler, and python checking how commands start, are run as separate processes
+    subprocesses = (len(digests) if compiler != 'source' else 0) + startup_processes
+    print "Completed building in %.2fs: %d steps run, %d skipped as unchanged, %d stale files removed, " \
+        "%d subprocesses" % (time.time() - start, manifest.run, manifest.skipped, pruned, subprocesses)
 
 def startup_checks():
     if sys.version_info < (2, 7):
@@ -316,11 +894,45 @@ def startup_checks():
 
 def main():
     """ Main program entry point
+
+    Usage: python build.py [--transport=argv|file|edits] [--package=zipapp|source] [--force]
+        [--compiler=<compiler>] [--jobs=<n>]
+
+    --force rebuilds everything, rather than only what has changed since the last build.
+    --compiler is one of COMPILERS ('source' builds without macOS), or a command reading the
+    script from stdin and writing %(output)s.
+    --package is how pyscripts is installed (see PACKAGES); the build fails if commands run by
+    it import more than STARTUP_MODULES, or start more slowly than pyscripts itself.
     """
 
     try:
         startup_checks()
-        build()
+        transport = 'argv'
+        force = False
+        compiler = DEFAULT_COMPILER
+        jobs = None
+        package = DEFAULT_PACKAGE
+        for argument in sys.argv[1:]:
+            if argument.startswith('--transport='):
+                transport = argument[len('--transport='):]
+            elif argument == '--force':
+                force = True
+            elif argument.startswith('--compiler='):
+                compiler = argument[len('--compiler='):]
+                if compiler not in COMPILERS and '%(output)s' not in compiler:
+                    raise Exception("unknown compiler '%s'; use one of %s, or a command including %%(output)s"
+                        % (compiler, ', '.join(sorted(COMPILERS))))
+            elif argument.startswith('--jobs='):
+                jobs = int(argument[len('--jobs='):])
+            elif argument.startswith('--package='):
+                package = argument[len('--package='):]
+            else:
+                raise Exception("unknown argument '%s'" % argument)
+        if transport not in TRANSPORTS:
+            raise Exception("unknown transport '%s'; use one of %s" % (transport, ', '.join(TRANSPORTS)))
+        if package not in PACKAGES:
+            raise Exception("unknown package '%s'; use one of %s" % (package, ', '.join(PACKAGES)))
+        build(transport, force, compiler, jobs, package)
     except Exception, e:
         sys.stderr.write("Error: %s\n" % e)
         sys.exit(1)
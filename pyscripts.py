@@ -3,40 +3,1668 @@
 
 # Python script implementing a collection of useful text handling functions
 
-import codecs
 import os
-import subprocess
+import re
 import sys
 import time
+import unicodedata
+from array import array
 
 VERSION = 0.6
 
+# Seconds the pyscripts server waits for a request before shutting down
+SERVER_IDLE_TIMEOUT = 15 * 60
+
+# Input files at least this size are memory-mapped rather than read
+MMAP_THRESHOLD = 1024 * 1024
+
+# If set, each task run is profiled, and the profile written to the directory it names
+# ('1' for the default directory)
+PROFILE_ENVIRONMENT = 'PYSCRIPTS_PROFILE'
+PROFILE_DIRECTORY = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'pyscripts-profiles')
+
+# Seconds between scans of the files watched by --watch, and that a changed file must stay
+# unchanged before it is formatted
+WATCH_INTERVAL = 1.0
+WATCH_DEBOUNCE = 0.5
+WATCH_NAMES = ['*.md', '*.markdown', '*.rst', '*.txt']
+
+# If set, the results of tasks are cached in the directory it names ('1' for the default
+# directory), up to CACHE_MAX_BYTES; texts shorter than CACHE_MIN_SIZE are not worth caching
+CACHE_ENVIRONMENT = 'PYSCRIPTS_CACHE'
+CACHE_DIRECTORY = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'pyscripts-cache')
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MIN_SIZE = 1024
+
+# If set, the task, input size and phase timings of each run are appended to the log it names
+# ('1' for the default log), which is rotated when it grows beyond METRICS_MAX_BYTES
+METRICS_ENVIRONMENT = 'PYSCRIPTS_METRICS'
+METRICS_FILE = os.path.join(os.path.expanduser('~'), '.pyscripts', 'metrics.log')
+METRICS_MAX_BYTES = 1024 * 1024
+
+class LazyPattern(object):
+    """A regular expression compiled when first used, so that running one task does not compile
+    the expressions of every other.
+
+    Each attribute of the compiled expression (match, sub and so on) is copied to the instance
+    when first looked up, so that later lookups are as fast as on the compiled expression.
+    """
+
+    def __init__(self, pattern, flags=0):
+        self.pattern = pattern
+        self.flags = flags
+
+    def __getattr__(self, name):
+        value = getattr(re.compile(self.pattern, self.flags), name)
+        setattr(self, name, value)
+        return value
+
 def join_lines(new_lines, txt):
-    """Joins lines, adding a trailing return if the original text had one."""
-    return add_ending('\n'.join(new_lines), txt)
+    """Joins lines with the original text's line terminator, adding a trailing one if the
+    original text had one."""
+    return add_ending(line_ending(txt).join(new_lines), txt)
 
 def add_ending(new_txt, txt):
-    """Adds a trailing return if the original text had one."""
-    if txt.endswith('\n'):
+    """Adds a trailing line terminator if the original text had one."""
+    if txt.endswith('\r\n'):
+        new_txt = "%s\r\n" % new_txt
+    elif txt.endswith('\n'):
         new_txt = "%s\n" % new_txt
-    if txt.endswith('\r'):
+    elif txt.endswith('\r'):
         new_txt = "%s\r" % new_txt
     return new_txt
 
+#
+# Line Methods
+#
+# Lines end with '\n', '\r\n' or '\r', and each keeps its own terminator; the last line may have
+# none. Text whose lines all end alike (most text) is split and joined by str methods;
+# otherwise its lines are found with one regular expression scan.
+#
+
+_LINE = LazyPattern(u'([^\\r\\n]*)(\\r\\n|\\r|\\n|\\Z)')
+_LINE_ENDING = LazyPattern(u'\\r\\n|\\r|\\n')
+
+def line_ending(txt):
+    """Returns the terminator of the first line of txt, or '\\n' if it has none."""
+    match = _LINE_ENDING.search(txt)
+    return match.group() if match else u'\n'
+
+def common_line_ending(txt):
+    """Returns the terminator of every line of txt ('\\n' if it has none), or None if its lines
+    end differently."""
+    if u'\r' not in txt:
+        return u'\n'
+    if u'\n' not in txt:
+        return u'\r'
+    crlf = txt.count(u'\r\n')
+    return u'\r\n' if crlf == txt.count(u'\r') == txt.count(u'\n') else None
+
+def split_lines(txt):
+    """Returns the lines of txt without their terminators (like splitlines, but breaking lines
+    only at line terminators)."""
+    ending = common_line_ending(txt)
+    lines = txt.split(ending) if ending else _LINE_ENDING.split(txt)
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+def map_lines(txt, *functions):
+    """Returns txt with each function applied in turn to each line, keeping each line's terminator.
+
+    The result is the same as mapping each function over the lines in turn: in particular, an
+    unterminated last line emptied by one function is gone, so is not passed to the others.
+    """
+    ending = common_line_ending(txt)
+    if ending:
+        lines = txt.split(ending)
+        last = lines.pop()
+        for function in functions:
+            lines = map(function, lines)
+        lines.append(_map_last_line(last, functions))
+        return ending.join(lines)
+    parts = []
+    append = parts.append
+    for line, ending in _LINE.findall(txt):
+        if ending:
+            for function in functions:
+                line = function(line)
+            append(line)
+            append(ending)
+        else:
+            append(_map_last_line(line, functions))
+    return u''.join(parts)
+
+def _map_last_line(line, functions):
+    # An unterminated last line, which is no line once empty
+    for function in functions:
+        if not line:
+            break
+        line = function(line)
+    return line
+
+
+class LineSubstitution(object):
+    """A regular expression substitution made in each line of a text, keeping each line's
+    terminator.
+
+    The pattern, compiled with re.MULTILINE, must not match line terminators. The substitution
+    is made in the whole text at once; a pattern anchored with ^ is matched after each '\n'
+    instead, as the regular expression engine finds a '\n' much faster than it does a ^. This
+    beats applying a function to each line when the pattern matches few lines.
+    """
+
+    def __init__(self, pattern, replacement):
+        self.pattern = LazyPattern(pattern, re.MULTILINE)
+        self.replacement = replacement
+        self.line_starts = None
+        if pattern.startswith(u'^'):
+            # Without a group, a literal prefix is found by a fast search
+            self.line_starts = LazyPattern((u"\\n(?:%s)" if u'|' in pattern else u"\\n%s") % pattern[1:],
+                re.MULTILINE)
+
+    def line(self, line):
+        """Returns a line with the substitution made."""
+        return self.pattern.sub(self.replacement, line)
+
+    def __call__(self, txt):
+        ending = common_line_ending(txt)
+        if ending is None:
+            return map_lines(txt, self.line)
+        if ending != u'\n':
+            return self(txt.replace(ending, u'\n')).replace(u'\n', ending)
+        if not txt:
+            return txt
+        last = u''
+        if txt.endswith(u'\n') and self.pattern.match(u'') is not None:
+            # Not matching the empty string after the last terminator
+            txt = txt[:-1]
+            last = u'\n'
+        if self.line_starts:
+            return self.line_starts.sub(u'\n' + self.replacement, u'\n' + txt)[1:] + last
+        return self.pattern.sub(self.replacement, txt) + last
+
+#
+# Task Builders
+#
+# Tasks built from a function of a line (or of text that leaves line breaks alone) record the
+# function as 'line_function', so that a pipeline can run several of them in one pass.
+#
+
+def line_task(function):
+    """Returns a task method applying a function to each line of its text."""
+    def task(self, txt):
+        return map_lines(txt, function)
+    task.line_function = function
+    return task
+
+def substitution_task(pattern, replacement):
+    """Returns a task method making a LineSubstitution in each line of its text."""
+    substitution = LineSubstitution(pattern, replacement)
+    def task(self, txt):
+        return substitution(txt)
+    task.line_function = substitution.line
+    return task
+
+def uncached(method):
+    """Marks a task method whose result depends on more than its text, so is not cached."""
+    method.uncached = True
+    return method
+
+def text_task(function):
+    """Returns a task method applying a function, which leaves line breaks unchanged, to its text."""
+    def task(self, txt):
+        return function(txt)
+    task.line_function = function
+    task.text_function = True
+    return task
+
+def fuse_tasks(methods):
+    """Returns the stages of a pipeline of task methods, fusing adjacent line tasks.
+
+    A run of tasks with line functions becomes one stage splitting the text into lines once, if
+    it includes a task that works on lines; a run of only text functions is left as it is.
+    """
+    stages = []
+    run = []
+    for method in methods + [None]:
+        if method is not None and getattr(method, 'line_function', None):
+            run.append(method)
+            continue
+        if len(run) > 1 and not all(getattr(task, 'text_function', False) for task in run):
+            stages.append(fused_stage([task.line_function for task in run]))
+        else:
+            stages.extend(run)
+        run = []
+        if method is not None:
+            stages.append(method)
+    return stages
+
+def fused_stage(functions):
+    """Returns a stage applying several line functions, in turn, to each line of its text."""
+    def stage(txt):
+        return map_lines(txt, *functions)
+    return stage
+
+#
+# Translation Methods
+#
+
+# Above this many characters a mapping is applied with unicode.translate rather than by
+# replacing each character in turn
+TRANSLATION_SPLIT_LIMIT = 8
+
+
+class Translation(object):
+    """A character mapping, in the form taken by unicode.translate, compiled for repeated use.
+
+    Replacements may be several characters long (or None, to delete). The text is optionally
+    lowercased first. Small mappings are applied using the string methods implemented in C:
+    with a chain of replace() calls where no replacement contains a character still to be
+    mapped, otherwise by splitting on a mapped character, translating the pieces with the rest
+    of the mapping and joining them with its replacement, so that no character is translated
+    twice. Both are linear in the length of the text.
+    """
+
+    def __init__(self, mapping, lower=False):
+        self.lower = lower
+        self.items = []
+        for key, value in sorted(mapping.items()):
+            char = unichr(key) if isinstance(key, int) else unicode(key)
+            if len(char) != 1:
+                raise Exception("Error: translation key '%s' is not a single character." % key)
+            self.items.append((char, unicode(value) if value is not None else u''))
+        # chainable[i] is True if the items from i on can be applied by successive replace()s
+        self.chainable = [True] * (len(self.items) + 1)
+        for i in range(len(self.items) - 1, -1, -1):
+            self.chainable[i] = self.chainable[i + 1] and not any(char in self.items[i][1]
+                for char, value in self.items[i + 1:])
+        if len(self.items) > TRANSLATION_SPLIT_LIMIT:
+            self.table = dict((ord(char), value) for char, value in self.items)
+            self.apply = self._translate
+        else:
+            self.apply = self._split
+
+    def __call__(self, txt):
+        if self.lower:
+            txt = txt.lower()
+        return self.apply(txt)
+
+    def _translate(self, txt):
+        return txt.translate(self.table)
+
+    def _split(self, txt, depth=0):
+        if self.chainable[depth]:
+            for char, value in self.items[depth:]:
+                txt = txt.replace(char, value)
+            return txt
+        char, value = self.items[depth]
+        if self.chainable[depth + 1] and depth + 2 == len(self.items):
+            # The common case (such as swapping two characters) without a call per piece
+            next_char, next_value = self.items[depth + 1]
+            return value.join([piece.replace(next_char, next_value) for piece in txt.split(char)])
+        return value.join([self._split(piece, depth + 1) for piece in txt.split(char)])
+
+def translation_task(mapping, lower=False):
+    """Returns a task method applying a character mapping, compiled once, to its text."""
+    return text_task(Translation(mapping, lower))
+
+ESCAPE_BACKSLASHES = Translation({u'\\': u'\\\\'})
+
+#
+# Table Methods
+#
+
+# Widths of distinct non-ASCII cells, bounded so that huge tables don't grow it without limit
+_TEXT_WIDTHS = {}
+TEXT_WIDTHS_LIMIT = 100000
+_NON_ASCII = LazyPattern(u'[^\x00-\x7f]')
+
+def text_width(text):
+    """Returns the number of columns text occupies in a monospaced font.
+
+    East Asian wide and full-width characters take two columns and combining characters none.
+    """
+    if _NON_ASCII.search(text) is None:
+        return len(text)
+    width = _TEXT_WIDTHS.get(text)
+    if width is None:
+        width = 0
+        for c in text:
+            if unicodedata.combining(c):
+                continue
+            width += 2 if unicodedata.east_asian_width(c) in ('W', 'F') else 1
+        if len(_TEXT_WIDTHS) < TEXT_WIDTHS_LIMIT:
+            _TEXT_WIDTHS[text] = width
+    return width
+
+# Kinds of table cell; the separator kinds give the justification of their column
+CELL_TEXT = 0
+CELL_RULE = 1
+CELL_RULE_LEFT = 2
+CELL_RULE_RIGHT = 3
+CELL_RULE_CENTER = 4
+
+
+class Table(object):
+    """A table written with pipe-separated fields, tokenized once for formatting.
+
+    Cells are kept in flat arrays (text, kind and width) with the end of each row recorded,
+    and the width and justification of each column are found while tokenizing.
+    """
+
+    def __init__(self, txt):
+        self.cells = []
+        self.kinds = array('b')
+        self.cell_widths = array('l')
+        self.row_ends = array('l')
+        self.widths = []
+        self.justs = []
+        for line in txt.splitlines():
+            self._add_row(line)
+
+    def _add_row(self, line):
+        line_fields = line.split(u'|')
+        start = 1 if line_fields[0] == u'' else 0
+        end = len(line_fields) - 1 if len(line_fields) > start and line_fields[-1] == u'' else len(line_fields)
+        widths = self.widths
+        if len(widths) < end - start:
+            widths += [3] * (end - start - len(widths))
+            self.justs += [CELL_RULE] * (end - start - len(self.justs))
+        for f in range(end - start):
+            line_field = line_fields[start + f].strip()
+            if line_field.startswith(u':---') and line_field.endswith(u'---:'):
+                kind = CELL_RULE_CENTER
+            elif line_field.startswith(u':---'):
+                kind = CELL_RULE_LEFT
+            elif line_field.endswith(u'---:'):
+                kind = CELL_RULE_RIGHT
+            elif line_field.startswith(u'---'):
+                kind = CELL_RULE
+            else:
+                kind = CELL_TEXT
+            width = text_width(line_field)
+            if kind != CELL_TEXT:
+                self.justs[f] = kind
+            elif width > widths[f] and not (line_field.startswith(u'--')
+                    or line_field.startswith(u':-') or line_field.endswith(u'-:')):
+                widths[f] = width
+            self.cells.append(line_field)
+            self.kinds.append(kind)
+            self.cell_widths.append(width)
+        self.row_ends.append(len(self.cells))
+
+    def lines(self):
+        """Generates the formatted lines of the table."""
+        cells = self.cells
+        kinds = self.kinds
+        cell_widths = self.cell_widths
+        widths = self.widths
+        justs = self.justs
+        start = 0
+        for end in self.row_ends:
+            line_fields = []
+            for i in xrange(start, end):
+                f = i - start
+                width = widths[f]
+                kind = kinds[i]
+                if kind == CELL_RULE_CENTER:
+                    line_fields.append(u":%s:" % (u'-' * (width - 2)))
+                elif kind == CELL_RULE_LEFT:
+                    line_fields.append(u":%s" % (u'-' * (width - 1)))
+                elif kind == CELL_RULE_RIGHT:
+                    line_fields.append(u"%s:" % (u'-' * (width - 1)))
+                elif kind == CELL_RULE:
+                    line_fields.append(u'-' * width)
+                else:
+                    space = width - cell_widths[i]
+                    if space <= 0:
+                        line_fields.append(cells[i])
+                    elif justs[f] == CELL_RULE_CENTER:
+                        line_fields.append(u"%s%s%s" % (u' ' * (space // 2), cells[i], u' ' * (space - space // 2)))
+                    elif justs[f] == CELL_RULE_RIGHT:
+                        line_fields.append(u' ' * space + cells[i])
+                    else:
+                        line_fields.append(cells[i] + u' ' * space)
+            start = end
+            yield u"| %s |" % u' | '.join(line_fields)
+
+# A number in a cell, once any thousands separators and percent sign are removed
+_NUMBER = LazyPattern(u'[-+]?(?:\\d+\\.?\\d*|\\.\\d+)(?:[eE][-+]?\\d+)?$')
+_DIGITS = LazyPattern(u'(\\d+)')
+
+def sort_key(text):
+    """Returns the key ordering a cell: numbers by value, then text in natural order (runs of
+    digits by value, ignoring case), then empty cells."""
+    if not text:
+        return (2,)
+    number = text.replace(u',', u'').rstrip(u'%')
+    if _NUMBER.match(number):
+        return (0, float(number))
+    # The runs of digits are every other piece
+    pieces = _DIGITS.split(text.lower())
+    pieces[1::2] = map(int, pieces[1::2])
+    return (1, tuple(pieces))
+
+
+class Columns(object):
+    """A table written with pipe-separated fields, held column by column to sort, filter and
+    rearrange.
+
+    The table is tokenized by Table, skipping blank lines, and its cells moved into a list of texts
+    and an array of widths for each column, rows missing cells given empty ones. The rule row is
+    the first matching _TABLE_RULE, as for format_tables. Header rows (those before the rule row)
+    and body rows are numbered together, and the body is an array of its row numbers,
+    in order, so that sorting and filtering move only numbers; the columns shown are a list of
+    column numbers. The sort keys of a column are found when it is first sorted by, and kept as
+    the rank of each row. Rendering reuses the widths found while tokenizing.
+    """
+
+    def __init__(self, txt):
+        table = Table(u'')
+        lines = [line for line in txt.splitlines() if line.strip()]
+        for line in lines:
+            table._add_row(line)
+        count = len(table.widths)
+        if not count:
+            raise Exception("Error: the selection is not a table.")
+        self.widths = table.widths
+        self.justs = table.justs
+        # Whether there is a rule row, and the number of header rows before it
+        self.rule = False
+        self.head = 0
+        cells = table.cells
+        cell_widths = table.cell_widths
+        rows = []
+        rows_widths = []
+        start = 0
+        for line, end in zip(lines, table.row_ends):
+            line = line.strip()
+            if not self.rule and _TABLE_RULE.match(line):
+                self.rule = True
+                self.head = len(rows)
+                # The justification of each column, from the colons around its dashes
+                for f, field in enumerate(line[1:-1].split(u'|')):
+                    field = field.strip()
+                    left = field.startswith(u':')
+                    right = field.endswith(u':')
+                    self.justs[f] = (CELL_RULE_CENTER if left and right else CELL_RULE_LEFT if left
+                        else CELL_RULE_RIGHT if right else CELL_RULE)
+            else:
+                row = cells[start:end]
+                row_widths = cell_widths[start:end]
+                if end - start < count:
+                    row += [u''] * (count - end + start)
+                    row_widths.extend([0] * (count - end + start))
+                rows.append(row)
+                rows_widths.append(row_widths)
+            start = end
+        self.texts = map(list, zip(*rows)) if rows else [[] for c in xrange(count)]
+        self.cell_widths = [array('l', column) for column in zip(*rows_widths)] if rows else [array('l') for c in xrange(count)]
+        self.rows = array('l', xrange(self.head, len(rows)))
+        self.order = range(count)
+        # Whether rows have been removed, so that the widths of columns must be found again
+        self.removed = False
+        self._ranks = {}
+
+    def column(self, number):
+        """Returns the column shown as number (from 1, as a string)."""
+        try:
+            index = int(number) - 1
+        except ValueError:
+            index = -1
+        if not 0 <= index < len(self.order):
+            raise Exception("Error: the table has no column '%s'." % number)
+        return self.order[index]
+
+    def columns(self, numbers):
+        """Returns the columns shown as numbers, separated by commas."""
+        return [self.column(number) for number in numbers.split(u',')]
+
+    def ranks(self, c):
+        """Returns an array of the rank of each row in the order of column c."""
+        ranks = self._ranks.get(c)
+        if ranks is None:
+            texts = self.texts[c]
+            # Each distinct text is keyed once; texts with equal keys have equal ranks
+            rank = {}
+            r = -1
+            previous = None
+            for key, text in sorted((sort_key(text), text) for text in set(texts)):
+                if key != previous:
+                    r += 1
+                    previous = key
+                rank[text] = r
+            ranks = self._ranks[c] = array('l', map(rank.__getitem__, texts))
+        return ranks
+
+    def sort(self, keys):
+        """Sorts the body rows, keeping the order of equal rows, by (column, descending) keys, the
+        first the most significant."""
+        rows = list(self.rows)
+        for c, descending in reversed(keys):
+            rows.sort(key=self.ranks(c).__getitem__, reverse=descending)
+        self.rows = array('l', rows)
+
+    def filter(self, c, text, keep=True):
+        """Keeps the body rows with text in column c, or if keep is False, those without."""
+        texts = self.texts[c]
+        self.rows = array('l', [r for r in self.rows if (text in texts[r]) == keep])
+        self.removed = True
+
+    def dedupe(self):
+        """Removes the body rows repeating an earlier row in the columns shown."""
+        shown = zip(*[self.texts[c] for c in self.order])
+        seen = set()
+        rows = array('l')
+        for r in self.rows:
+            if shown[r] not in seen:
+                seen.add(shown[r])
+                rows.append(r)
+        self.rows = rows
+        self.removed = True
+
+    def drop(self, columns):
+        """Stops showing columns."""
+        self.order = [c for c in self.order if c not in columns]
+        if not self.order:
+            raise Exception("Error: cannot drop every column of the table.")
+
+    def reorder(self, columns):
+        """Shows columns first, in the order given, and then the others, in their order."""
+        self.order = columns + [c for c in self.order if c not in columns]
+
+    def width(self, c):
+        """Returns the width of column c, found again from the widths of its cells if rows have
+        been removed."""
+        if not self.removed:
+            return self.widths[c]
+        texts = self.texts[c]
+        cell_widths = self.cell_widths[c]
+        width = 3
+        for r in range(self.head) + list(self.rows):
+            text = texts[r]
+            if cell_widths[r] > width and not (text.startswith(u'--') or text.startswith(u':-') or text.endswith(u'-:')):
+                width = cell_widths[r]
+        return width
+
+    def lines(self):
+        """Generates the formatted lines of the table, formatted by Table from the cells as they
+        are, without measuring them again."""
+        from itertools import chain
+        order = self.order
+        count = len(order)
+        numbers = range(self.head) + list(self.rows)
+        table = Table(u'')
+        table.cells = list(chain.from_iterable(zip(*[map(self.texts[c].__getitem__, numbers) for c in order])))
+        table.cell_widths = array('l', chain.from_iterable(zip(*[map(self.cell_widths[c].__getitem__, numbers)
+            for c in order])))
+        table.kinds = array('b', [CELL_TEXT]) * len(table.cells)
+        if self.rule:
+            position = self.head * count
+            table.cells[position:position] = [u''] * count
+            table.cell_widths[position:position] = array('l', [0] * count)
+            table.kinds[position:position] = array('b', [self.justs[c] for c in order])
+        table.row_ends = array('l', xrange(count, len(table.cells) + 1, count))
+        table.widths = [self.width(c) for c in order]
+        table.justs = [self.justs[c] for c in order]
+        return table.lines()
+
+
+#
+# Document Table Methods
+#
+# The tables in a whole document are found in one scan of its lines: Markdown pipe tables (with
+# a rule row), and RST grid and simple tables. Each is formatted on its own, keeping its number
+# of lines; a table that cannot be (one with cells spanning columns, say) is left as it is.
+#
+
+# Kinds of table
+TABLE_PIPE = 0
+TABLE_GRID = 1
+TABLE_SIMPLE = 2
+
+# The rule row of a Markdown pipe table
+_TABLE_RULE = LazyPattern(u'\\|(?:[ \\t]*:?-+:?[ \\t]*\\|)+[ \\t]*$')
+# A border of an RST grid table, and of an RST simple table of two or more columns
+_GRID_BORDER = LazyPattern(u'([ \\t]*)\\+(?:[-=]+\\+)+[ \\t]*$')
+_SIMPLE_BORDER = LazyPattern(u'([ \\t]*)=+(?: +=+)+[ \\t]*$')
+_SIMPLE_COLUMN = LazyPattern(u'=+')
+# The underline of a heading spanning columns of an RST simple table
+_SIMPLE_SPAN = LazyPattern(u'[ \\t]*-+(?: +-+)*[ \\t]*$')
+# Tables of at least this many lines are formatted by a pool of processes, when there are several
+TABLE_POOL_MIN_LINES = 5000
+
+def table_blocks(lines):
+    """Generates the (start, end, kind) of each table in lines, in order, outside fenced code
+    blocks."""
+    count = len(lines)
+    fence = None
+    i = 0
+    while i < count:
+        line = lines[i]
+        stripped = line.lstrip()
+        if fence:
+            if stripped.startswith(fence):
+                fence = None
+        elif line.startswith(u'|'):
+            end = i + 1
+            while end < count and lines[end].startswith(u'|'):
+                end += 1
+            if any(_TABLE_RULE.match(row) for row in lines[i:end]):
+                yield i, end, TABLE_PIPE
+            i = end
+            continue
+        elif stripped.startswith(u'+') and _GRID_BORDER.match(line):
+            end = _grid_table_end(lines, i)
+            if end:
+                yield i, end, TABLE_GRID
+                i = end
+                continue
+        elif stripped.startswith(u'=') and _SIMPLE_BORDER.match(line):
+            end = _simple_table_end(lines, i)
+            if end:
+                yield i, end, TABLE_SIMPLE
+                i = end
+                continue
+        elif stripped.startswith(_FENCES):
+            fence = stripped[:3]
+        i += 1
+
+def _grid_table_end(lines, start):
+    # The end of the grid table whose top border is lines[start], after its last border
+    indent = _GRID_BORDER.match(lines[start]).group(1)
+    first = len(indent)
+    end = start
+    i = start + 1
+    while i < len(lines) and lines[i].startswith(indent) and lines[i][first:first + 1] in (u'+', u'|'):
+        if _GRID_BORDER.match(lines[i]):
+            end = i
+        i += 1
+    return end + 1 if end > start else None
+
+def _simple_table_end(lines, start):
+    # The end of the simple table whose top border is lines[start]: after a border followed by a
+    # blank line, or its third border
+    border = lines[start].rstrip()
+    indent = _SIMPLE_BORDER.match(border).group(1)
+    borders = 1
+    i = start + 1
+    while i < len(lines):
+        line = lines[i]
+        if line.rstrip() == border:
+            borders += 1
+            if borders == 3 or i + 1 == len(lines) or not lines[i + 1].strip():
+                return i + 1
+        elif line.strip() and not line.startswith(indent):
+            return None
+        i += 1
+    return None
+
+def format_grid_table(lines):
+    """Returns the lines of an RST grid table with each column as wide as its widest text, or
+    None if any of its cells span columns or rows."""
+    indent = _GRID_BORDER.match(lines[0]).group(1)
+    rows = []
+    for line in lines:
+        line = line.strip()
+        if line.startswith(u'+'):
+            cells = line[1:-1].split(u'+')
+            if not all(cell and cell == cell[0] * len(cell) for cell in cells):
+                return None
+        else:
+            cells = [cell[1:] if cell.startswith(u' ') else cell for cell in line[1:-1].split(u'|')]
+            cells = [cell.rstrip() for cell in cells]
+        if rows and len(cells) != len(rows[0]) or not line.endswith(line[0]):
+            return None
+        rows.append(cells)
+    widths = [1] * len(rows[0])
+    for line, cells in zip(lines, rows):
+        if not line.lstrip().startswith(u'+'):
+            for c, cell in enumerate(cells):
+                widths[c] = max(widths[c], text_width(cell))
+    new_lines = []
+    for line, cells in zip(lines, rows):
+        if line.lstrip().startswith(u'+'):
+            new_lines.append(u"%s+%s+" % (indent, u'+'.join(cell[0] * (width + 2) for cell, width in zip(cells, widths))))
+        else:
+            new_lines.append(u"%s|%s|" % (indent, u'|'.join(u" %s%s " % (cell, u' ' * (width - text_width(cell)))
+                for cell, width in zip(cells, widths))))
+    return new_lines
+
+def format_simple_table(lines):
+    """Returns the lines of an RST simple table with each column as wide as its widest text, two
+    spaces apart, or None if any of its text crosses the gap between columns, or spans them."""
+    border = lines[0].rstrip()
+    columns = [(match.start(), match.end()) for match in _SIMPLE_COLUMN.finditer(border)]
+    indent = border[:columns[0][0]]
+    rows = []
+    for line in lines:
+        if line.rstrip() == border or not line.strip():
+            rows.append(None)
+            continue
+        if _SIMPLE_SPAN.match(line) or line[:columns[0][0]].strip():
+            return None
+        cells = []
+        for c, (start, end) in enumerate(columns):
+            if c + 1 < len(columns):
+                if line[end:columns[c + 1][0]].strip():
+                    return None
+                cells.append(line[start:end].strip())
+            else:
+                cells.append(line[start:].strip())
+        rows.append(cells)
+    widths = [1] * len(columns)
+    for cells in rows:
+        if cells:
+            for c, cell in enumerate(cells):
+                widths[c] = max(widths[c], text_width(cell))
+    new_border = indent + u'  '.join(u'=' * width for width in widths)
+    new_lines = []
+    for line, cells in zip(lines, rows):
+        if cells:
+            new_lines.append((indent + u'  '.join(cell + u' ' * (width - text_width(cell))
+                for cell, width in zip(cells, widths))).rstrip())
+        else:
+            new_lines.append(new_border if line.strip() else line)
+    return new_lines
+
+def format_table_block(job):
+    """Returns the formatted lines of a (kind, lines) table, or None if it cannot be formatted."""
+    kind, lines = job
+    if kind == TABLE_PIPE:
+        return list(Table(u'\n'.join(lines)).lines())
+    if kind == TABLE_GRID:
+        return format_grid_table(lines)
+    return format_simple_table(lines)
+
+def format_tables(txt, jobs=None):
+    """Returns txt with every table in it formatted, and the text between them copied through.
+
+    If there are several tables of TABLE_POOL_MIN_LINES lines or more, a pool of jobs processes
+    (by default, one for each CPU) formats them while the others are formatted here.
+    """
+    ending = common_line_ending(txt)
+    if ending:
+        lines = txt.split(ending)
+        endings = None
+    else:
+        pairs = _LINE.findall(txt)
+        lines = [pair[0] for pair in pairs]
+        endings = [pair[1] for pair in pairs]
+    blocks = list(table_blocks(lines))
+    if not blocks:
+        return txt
+
+    def endings_length(start, end):
+        # The length of the terminators of lines start to end - 1
+        if endings is None:
+            return len(ending) * max(min(end, len(lines) - 1) - start, 0)
+        return sum(map(len, endings[start:end]))
+
+    large = [block for block in blocks if block[1] - block[0] >= TABLE_POOL_MIN_LINES]
+    results = {}
+    pool = None
+    if len(large) > 1 and jobs != 1:
+        import multiprocessing
+        processes = min(jobs or multiprocessing.cpu_count(), len(large))
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+    if pool is not None:
+        for start, end, kind in large:
+            results[start] = pool.apply_async(format_table_block, [(kind, lines[start:end])])
+    try:
+        parts = []
+        # The offset in txt of the start of a line, and of the end of the text copied
+        position = 0
+        line = 0
+        copied = 0
+        for start, end, kind in blocks:
+            start_position = position + sum(map(len, lines[line:start])) + endings_length(line, start)
+            length = sum(map(len, lines[start:end])) + endings_length(start, end - 1)
+            parts.append(txt[copied:start_position])
+            result = results.get(start)
+            new_lines = result.get() if result is not None else format_table_block((kind, lines[start:end]))
+            if new_lines is None or new_lines == lines[start:end]:
+                parts.append(txt[start_position:start_position + length])
+            elif endings is None:
+                parts.append(ending.join(new_lines))
+            else:
+                parts.append(u''.join(new_line + line_ending for new_line, line_ending in zip(new_lines[:-1],
+                    endings[start:end - 1])) + new_lines[-1])
+            copied = start_position + length
+            # The start of the last line of the table
+            position = copied - len(lines[end - 1])
+            line = end - 1
+        parts.append(txt[copied:])
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return u''.join(parts)
+
+#
+# Reflow Methods
+#
+
+# Column to which task_wrap fills paragraphs
+WRAP_WIDTH = 80
+
+# Cost of each column a line runs past the width; far above any raggedness, so that a line only
+# runs over when it holds a single word too wide for it
+_OVERFULL_COST = 10 ** 10
+
+# The marker starting a list item: a bullet, or a number or # followed by . or )
+_LIST_ITEM = LazyPattern(u'(\\s*)([-*+\u2022]|\\d+[.)]|#[.)])(?: +|$)')
+# Lines that make their paragraph be left as it is: table rows, block quotes, headings and their
+# adornments, directives, comments and field lists
+_VERBATIM_LINE = LazyPattern(u'\\s*(?:[|>]|\\+[-=]|#+(?: |$)|\\.\\.(?: |$)|:[^:\\s][^:]*: )'
+    u'|\\s*([!-/:-@[-`{-~])\\1+\\s*$')
+_FENCES = (u'```', u'~~~')
+
+def break_lines(widths, width):
+    """Returns the index of the first word of each line, for words of the given widths filled
+    to width with the least raggedness.
+
+    Raggedness is the sum of the squares of the space left at the end of each line but the last.
+    The least cost of each prefix of the words is found in linear time: the cost of a line is
+    totally monotone, so the minimum of each column of costs is found with SMAWK, over blocks of
+    columns doubling in size until a break is known to be in every later path.
+    """
+    count = len(widths)
+    offsets = [0]
+    for w in widths:
+        offsets.append(offsets[-1] + w)
+    if offsets[-1] + count - 1 <= width:
+        return [0] if count else []
+    minima = [0] + [_OVERFULL_COST ** 2] * count
+    breaks = [0] * (count + 1)
+
+    def cost(i, j):
+        # Words i to j - 1 on a line after the best lines for the words before i
+        w = offsets[j] - offsets[i] + j - i - 1
+        if w > width:
+            return minima[i] + _OVERFULL_COST * (w - width)
+        return minima[i] + (width - w) ** 2
+
+    def smawk(rows, columns):
+        # Reduce the rows to at most one per column, dropping rows with no minimum
+        column_count = len(columns)
+        stack = []
+        for row in rows:
+            while stack:
+                c = columns[len(stack) - 1]
+                if cost(stack[-1], c) < cost(row, c):
+                    break
+                stack.pop()
+            if len(stack) < column_count:
+                stack.append(row)
+        rows = stack
+        if column_count > 1:
+            smawk(rows, columns[1::2])
+        # The minima of the odd columns lie between those of the even columns around them
+        i = j = 0
+        while j < column_count:
+            end = breaks[columns[j + 1]] if j + 1 < column_count else rows[-1]
+            c = cost(rows[i], columns[j])
+            if c < minima[columns[j]]:
+                minima[columns[j]] = c
+                breaks[columns[j]] = rows[i]
+            if rows[i] < end:
+                i += 1
+            else:
+                j += 2
+
+    n = count + 1
+    i = 0
+    offset = 0
+    while True:
+        r = min(n, 2 ** (i + 1))
+        edge = 2 ** i + offset
+        smawk(range(offset, edge), range(edge, r + offset))
+        x = minima[r - 1 + offset]
+        for j in xrange(2 ** i, r - 1):
+            if cost(j + offset, r - 1 + offset) <= x:
+                # Every later line break follows j
+                n -= j
+                i = 0
+                offset += j
+                break
+        else:
+            if r == n:
+                break
+            i += 1
+
+    # The last line costs nothing, if it fits
+    last = breaks[count]
+    i = count - 1
+    while i >= 0 and offsets[count] - offsets[i] + count - i - 1 <= width:
+        if minima[i] < minima[last] or offsets[count] - offsets[last] + count - last - 1 > width:
+            last = i
+        i -= 1
+    starts = [last]
+    while starts[-1] > 0:
+        starts.append(breaks[starts[-1]])
+    starts.reverse()
+    return starts if count else []
+
+def fill(words, first_prefix, prefix, width=WRAP_WIDTH):
+    """Returns the lines of words filled to width, the first after first_prefix and the rest
+    after prefix (the same width)."""
+    if not words:
+        return [first_prefix.rstrip()]
+    if _NON_ASCII.search(u''.join(words)) is None:
+        widths = map(len, words)
+    else:
+        widths = [text_width(word) for word in words]
+    starts = break_lines(widths, max(width - text_width(prefix), 1))
+    ends = starts[1:] + [len(words)]
+    return [(prefix if n else first_prefix) + u' '.join(words[starts[n]:ends[n]]) for n in xrange(len(starts))]
+
+def fill_paragraph(lines, width=WRAP_WIDTH):
+    """Returns the lines of a paragraph filled to width.
+
+    Each list item is filled with a hanging indent under its marker, and keeps the indent of its
+    marker, so nested items keep their level. A line indented further than the item before it
+    starts a paragraph of its own (an RST definition, say); other lines continue the item.
+    Paragraphs including tables, block quotes, headings or directives are returned unchanged.
+    """
+    for line in lines:
+        if _VERBATIM_LINE.match(line):
+            return lines
+    new_lines = []
+    words = None
+    for line in lines:
+        match = _LIST_ITEM.match(line)
+        indent = len(line) - len(line.lstrip())
+        if match is None and words is not None and indent <= len(prefix):
+            words.extend(line.split())
+            continue
+        if words is not None:
+            new_lines.extend(fill(words, first_prefix, prefix, width))
+        if match:
+            first_prefix = u"%s%s " % (match.group(1), match.group(2))
+            prefix = u' ' * len(first_prefix)
+            words = line[match.end():].split()
+        else:
+            first_prefix = prefix = line[:indent]
+            words = line.split()
+    new_lines.extend(fill(words, first_prefix, prefix, width))
+    return new_lines
+
+def reflow(lines, width=WRAP_WIDTH):
+    """Generates lines with each paragraph filled to width, reading one paragraph at a time.
+
+    Paragraphs are separated by blank lines, and end after a line ending with two spaces (a hard
+    line break, which is kept). Fenced code blocks, blocks indented by four spaces or a tab after
+    a blank line, and indented blocks following a paragraph ending with '::', are left as they are.
+    """
+    paragraph = []
+    fence = None
+    # Indent of a paragraph introducing a literal block, which goes on while paragraphs are indented further
+    literal = [None]
+    # Whether the paragraph follows a hard line break, rather than a blank line
+    broken = [False]
+
+    def flush():
+        indent = len(paragraph[0]) - len(paragraph[0].lstrip())
+        if literal[0] is not None and indent > literal[0]:
+            return paragraph
+        literal[0] = indent if paragraph[-1].rstrip().endswith(u'::') else None
+        if not broken[0] and paragraph[0].startswith((u'    ', u'\t')):
+            # An indented code block
+            return paragraph
+        new_lines = fill_paragraph(paragraph, width)
+        if paragraph[-1].endswith(u'  ') and not new_lines[-1].endswith(u'  '):
+            new_lines[-1] += paragraph[-1][len(paragraph[-1].rstrip()):]
+        return new_lines
+
+    for line in lines:
+        stripped = line.lstrip()
+        if fence:
+            if stripped.startswith(fence):
+                fence = None
+            yield line
+            continue
+        if stripped and not stripped.startswith(_FENCES):
+            paragraph.append(line)
+            if line.endswith(u'  '):
+                for new_line in flush():
+                    yield new_line
+                paragraph = []
+                broken[0] = True
+            continue
+        if paragraph:
+            for new_line in flush():
+                yield new_line
+            paragraph = []
+        broken[0] = False
+        if stripped:
+            fence = stripped[:3]
+        yield line
+    if paragraph:
+        for new_line in flush():
+            yield new_line
+
+#
+# Heading Methods
+#
+
+# Kinds of heading
+HEADING_UNDERLINE = 0
+HEADING_OVERLINE = 1
+HEADING_ATX = 2
+
+# A line of one punctuation character repeated, as under (and over) a section title
+_ADORNMENT = LazyPattern(u'([!-/:-@[-`{-~])\\1*[ \\t]*$')
+_ATX_HEADING = LazyPattern(u'(#{1,6})(?:[ \\t]|$)')
+# The optional closing #s of a # heading
+_ATX_CLOSING = LazyPattern(u'(?:^|[ \\t]+)#+[ \\t]*$')
+_SETEXT_STYLES = {(HEADING_UNDERLINE, u'='): 1, (HEADING_UNDERLINE, u'-'): 2}
+# The only underlines of a Markdown (setext) heading
+_SETEXT_CHARS = u'=-'
+# Lines ending YAML front matter, which starts with a line of ---
+_FRONT_MATTER_ENDS = (u'---', u'...')
+# Inconsistent headings described in an error
+HEADING_ERRORS_LIMIT = 5
+
+
+def _is_fence(adornment, title):
+    # Whether a line of adornment characters opens a code fence rather than adorning a title: a
+    # line of backticks, or of tildes narrower than the title, as RST adornments are as wide
+    return adornment.startswith(u'```') or (adornment.startswith(u'~~~')
+        and len(adornment.rstrip()) < text_width(title.strip()))
+
+
+class Headings(object):
+    """An index of the section headings of an RST or Markdown document, found in one pass.
+
+    Each heading is recorded in flat arrays: its kind (underlined, over- and underlined, or a
+    Markdown # heading), adornment character (or #s), level and first line. The level of an
+    adorned heading is given by the order in which its style first appears, as in RST; that of
+    a # heading by its #s (and of = and - underlines in a document whose first heading is a #
+    heading, 1 and 2). Once a # heading is found, the document is taken to be Markdown, where
+    only = and - underline a title, and there are no overlines. Lines opening code fences
+    are not adornments. In RST, a heading more than one level below the heading before it is
+    recorded in 'errors'; Markdown levels are written out, and may skip.
+    """
+
+    def __init__(self, lines):
+        self.source_lines = lines
+        self.kinds = array('b')
+        self.chars = []
+        self.levels = array('l')
+        self.starts = array('l')
+        self.errors = []
+        self.styles = {}
+        self.markdown = False
+        count = len(lines)
+        i = 0
+        fence = None
+        if count and lines[0].rstrip() == u'---':
+            # Skip front matter
+            i = 1
+            while i < count and lines[i].rstrip() not in _FRONT_MATTER_ENDS:
+                i += 1
+            i += 1
+        # Whether the line before is blank (or ends a heading), so a title may start here
+        after_break = True
+        while i < count:
+            line = lines[i]
+            stripped = line.strip()
+            if fence:
+                if stripped.startswith(fence):
+                    fence = None
+            elif stripped.startswith(_FENCES):
+                fence = stripped[:3]
+            elif not stripped:
+                after_break = True
+                i += 1
+                continue
+            elif (after_break and not self.markdown and i + 2 < count
+                    and self._is_overline(line, lines[i + 1], lines[i + 2])):
+                self._add(HEADING_OVERLINE, line[0], i, lines[i + 1])
+                i += 3
+                continue
+            elif (after_break and i + 1 < count and self._is_underline(line, lines[i + 1])
+                    and (not self.markdown or lines[i + 1][0] in _SETEXT_CHARS)):
+                self._add(HEADING_UNDERLINE, lines[i + 1][0], i, line)
+                i += 2
+                continue
+            else:
+                match = _ATX_HEADING.match(line)
+                if match and after_break:
+                    self._add(HEADING_ATX, match.group(1), i, line)
+                    i += 1
+                    continue
+            after_break = False
+            i += 1
+
+    @staticmethod
+    def _is_overline(line, title, underline):
+        # The over- and underline may differ in length, but not in character
+        return (_ADORNMENT.match(line) is not None and _ADORNMENT.match(underline) is not None
+            and not _is_fence(line, title) and not _is_fence(underline, title)
+            and underline[0] == line[0] and title.strip() != u'' and _ADORNMENT.match(title) is None)
+
+    @staticmethod
+    def _is_underline(title, line):
+        match = _ADORNMENT.match(line)
+        if match is None or _is_fence(line, title) or title[0].isspace() or _ADORNMENT.match(title):
+            return False
+        return len(line.rstrip()) >= min(3, text_width(title.rstrip()))
+
+    def _add(self, kind, char, start, title):
+        if kind == HEADING_ATX:
+            level = len(char)
+            self.markdown = True
+            if not self.styles:
+                # A Markdown document, where = and - underlines are the first two levels
+                self.styles.update(_SETEXT_STYLES)
+        else:
+            level = self.styles.setdefault((kind, char), len(self.styles) + 1)
+        previous = self.levels[-1] if self.levels else 0
+        if level > previous + 1 and not self.markdown:
+            self.errors.append(u"line %d ('%s') is level %d after level %d" % (start + 1, title.strip(), level,
+                previous))
+        self.kinds.append(kind)
+        self.chars.append(char)
+        self.levels.append(level)
+        self.starts.append(start)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def heading_lines(self, h):
+        """Returns the lines of heading h with its adornment the length of its title."""
+        lines = self.source_lines
+        start = self.starts[h]
+        kind = self.kinds[h]
+        if kind == HEADING_OVERLINE:
+            title = lines[start + 1].rstrip()
+            # Inset titles are inset at both ends
+            adornment = self.chars[h] * (text_width(title) + len(title) - len(title.lstrip()))
+            return [adornment, title, adornment]
+        if kind == HEADING_UNDERLINE:
+            title = lines[start].rstrip()
+            return [title, self.chars[h] * text_width(title)]
+        return [lines[start]]
+
+    def lines(self):
+        """Generates the lines of the document with the adornment of each heading the length of
+        its title."""
+        lines = self.source_lines
+        i = 0
+        for h, start in enumerate(self.starts):
+            for line in lines[i:start]:
+                yield line
+            heading_lines = self.heading_lines(h)
+            for line in heading_lines:
+                yield line
+            i = start + len(heading_lines)
+        for line in lines[i:]:
+            yield line
+
+    def fenced(self, h):
+        """Returns whether any line of heading h opens a code fence."""
+        start = self.starts[h]
+        title = self.title(h)
+        count = 3 if self.kinds[h] == HEADING_OVERLINE else 2 if self.kinds[h] == HEADING_UNDERLINE else 1
+        return any(_is_fence(line.lstrip(), title) for line in self.source_lines[start:start + count])
+
+    def title(self, h):
+        """Returns the title of heading h, without its adornment or #s."""
+        start = self.starts[h]
+        kind = self.kinds[h]
+        if kind == HEADING_OVERLINE:
+            return self.source_lines[start + 1].strip()
+        if kind == HEADING_UNDERLINE:
+            return self.source_lines[start].strip()
+        return _ATX_CLOSING.sub(u'', self.source_lines[start][len(self.chars[h]):].strip())
+
+#
+# Contents Methods
+#
+# A table of contents is a nested list of links to the headings of a document: to the anchors
+# GitHub gives them in Markdown, and to the sections themselves in RST. It is kept between two
+# marker comments, so that it can be refreshed; without them it is inserted before the first
+# heading, or if that is the title (the only heading of its level), before the second, and the
+# title left out. A document is taken to be Markdown if it has # headings, or the Markdown
+# markers.
+#
+
+# The markers around a table of contents in Markdown, and in RST
+CONTENTS_MARKERS = {True: (u'<!-- toc -->', u'<!-- tocstop -->'), False: (u'.. toc', u'.. tocstop')}
+# A Markdown link or image, whose text alone is kept in a slug
+_MARKDOWN_LINK = LazyPattern(u'!?\\[([^\\]]*)\\]\\([^)]*\\)')
+
+
+class _SlugCharacters(dict):
+    # The translation table of slugs, filled in as characters are first met: letters, marks,
+    # numbers, underscores and hyphens are kept, spaces made hyphens, and the rest removed
+    def __missing__(self, code):
+        category = unicodedata.category(unichr(code))
+        value = code if category[0] in 'LMN' or category == 'Pc' else None
+        self[code] = value
+        return value
+
+_SLUG_CHARACTERS = _SlugCharacters({ord(u' '): u'-', ord(u'-'): ord(u'-')})
+
+def slugify(title):
+    """Returns the anchor GitHub gives a heading title, before it is made unique: its text,
+    normalized (NFC) and lowercased, with punctuation and symbols removed and spaces made
+    hyphens."""
+    title = _MARKDOWN_LINK.sub(u'\\1', title)
+    return unicodedata.normalize('NFC', title).lower().translate(_SLUG_CHARACTERS)
+
+
+class Slugger(object):
+    """Makes the slugs of the headings of a document unique, as GitHub does: a repeated slug is
+    given the suffix -1, -2 and so on, skipping those already taken. The number of repeats of
+    each slug is kept, so that a suffix is found without trying those before it."""
+
+    def __init__(self):
+        self.occurrences = {}
+
+    def slug(self, title):
+        original = slug = slugify(title)
+        occurrences = self.occurrences
+        while slug in occurrences:
+            occurrences[original] += 1
+            slug = u"%s-%d" % (original, occurrences[original])
+        occurrences[slug] = 0
+        return slug
+
+def contents_lines(headings, markdown, first=0):
+    """Returns the lines of a nested list of links to the headings from first on; each is
+    indented one level deeper at most than the one before."""
+    levels = headings.levels[first:]
+    if not levels:
+        return []
+    base = min(levels)
+    slugger = Slugger()
+    # The slugs of headings before first are taken all the same
+    for h in xrange(first):
+        slugger.slug(headings.title(h))
+    lines = []
+    depth = 0
+    for h in xrange(first, len(headings)):
+        if headings.fenced(h):
+            # Not a heading, but the line before a code fence
+            continue
+        new_depth = min(headings.levels[h] - base, depth + 1) if lines else 0
+        title = headings.title(h)
+        if markdown:
+            lines.append(u"%s- [%s](#%s)" % (u'  ' * new_depth, _MARKDOWN_LINK.sub(u'\\1', title), slugger.slug(title)))
+        else:
+            if lines and new_depth != depth:
+                # Nested RST lists are set off by blank lines
+                lines.append(u'')
+            lines.append(u"%s- `%s`_" % (u'  ' * new_depth, title))
+        depth = new_depth
+    return lines
+
+def table_of_contents(lines):
+    """Returns the lines of a document with its table of contents inserted, or refreshed."""
+    headings = Headings(lines)
+    markdown = any(kind == HEADING_ATX for kind in headings.kinds) or CONTENTS_MARKERS[True][0] in lines
+    start_marker, end_marker = CONTENTS_MARKERS[markdown]
+    start = end = None
+    for i, line in enumerate(lines):
+        stripped = line.strip()
+        if stripped == start_marker and start is None:
+            start = i
+        elif stripped == end_marker and start is not None:
+            end = i
+            break
+    levels = headings.levels
+    first = 1 if len(levels) > 1 and levels.count(levels[0]) == 1 and (start is None or start > headings.starts[0]) else 0
+    contents = contents_lines(headings, markdown, first)
+    if start is not None and end is not None:
+        return lines[:start + 1] + [u''] + contents + [u''] + lines[end:]
+    if not contents:
+        return lines
+    position = headings.starts[first]
+    block = [start_marker, u''] + contents + [u'', end_marker, u'']
+    if position and lines[position - 1].strip():
+        block.insert(0, u'')
+    return lines[:position] + block + lines[position:]
+
+#
+# Glossary Methods
+#
+
+# The glossary: a UTF-8 file of one term per line, each optionally followed by a tab and its
+# definition (a URL, for Glossary Link); blank lines and lines starting with # are ignored
+GLOSSARY_ENVIRONMENT = 'PYSCRIPTS_GLOSSARY'
+GLOSSARY_FILE = os.path.join(os.path.expanduser('~'), '.pyscripts', 'glossary.txt')
+# Compiled glossaries, named by the digest of their file
+GLOSSARY_CACHE_DIRECTORY = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'pyscripts-glossaries')
+_URL = LazyPattern(u'[a-z][a-z0-9+.-]*://\\S+$')
+
+# Glossaries loaded by this process (the server's), by digest
+_GLOSSARIES = {}
+
+
+class Glossary(object):
+    """Terms and their definitions, compiled into an Aho-Corasick automaton that finds every
+    occurrence of every term in one pass over a text.
+
+    The automaton is kept in flat lists indexed by state: the transitions from each state, its
+    failure state, the term it completes (or -1) and the nearest state on its failure chain
+    that completes a term. Terms are matched ignoring case, as whole words; of overlapping
+    occurrences, the one starting first (and then the longest) is taken.
+    """
+
+    def __init__(self, entries):
+        self.terms = []
+        self.definitions = []
+        self.transitions = [{}]
+        self.failures = array('l', [0])
+        self.outputs = array('l', [-1])
+        self.suffixes = array('l', [0])
+        transitions = self.transitions
+        for term, definition in entries:
+            state = 0
+            for c in term.lower():
+                next_state = transitions[state].get(c)
+                if next_state is None:
+                    next_state = len(transitions)
+                    transitions[state][c] = next_state
+                    transitions.append({})
+                    self.failures.append(0)
+                    self.outputs.append(-1)
+                    self.suffixes.append(0)
+                state = next_state
+            if state and self.outputs[state] == -1:
+                self.outputs[state] = len(self.terms)
+                self.terms.append(term)
+                self.definitions.append(definition)
+        self._link()
+
+    def _link(self):
+        # Find the failure state of each state breadth first, from those of shorter prefixes
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        suffixes = self.suffixes
+        queue = list(transitions[0].values())
+        for state in queue:
+            for c, next_state in transitions[state].iteritems():
+                failure = failures[state]
+                while failure and c not in transitions[failure]:
+                    failure = failures[failure]
+                failure = transitions[failure].get(c, 0)
+                failures[next_state] = failure
+                suffixes[next_state] = failure if outputs[failure] != -1 else suffixes[failure]
+                queue.append(next_state)
+
+    def dumps(self):
+        """Returns the compiled glossary as a string, for loads (with the same version of Python)."""
+        import marshal
+        return marshal.dumps((self.terms, self.definitions, self.transitions, self.failures.tostring(),
+            self.outputs.tostring(), self.suffixes.tostring()))
+
+    @classmethod
+    def loads(cls, data):
+        """Returns the glossary compiled as a string by dumps."""
+        import marshal
+        glossary = cls.__new__(cls)
+        glossary.terms, glossary.definitions, glossary.transitions, failures, outputs, suffixes = marshal.loads(data)
+        glossary.failures = array('l', failures)
+        glossary.outputs = array('l', outputs)
+        glossary.suffixes = array('l', suffixes)
+        return glossary
+
+    @classmethod
+    def parse(cls, text):
+        """Returns the glossary of the text of a glossary file."""
+        entries = []
+        for line in text.splitlines():
+            if not line.strip() or line.startswith(u'#'):
+                continue
+            term, _, definition = line.partition(u'\t')
+            entries.append((term.strip(), definition.strip()))
+        return cls(entries)
+
+    def find(self, txt):
+        """Returns the (start, end, term index) of each occurrence of a term in txt, in order."""
+        transitions = self.transitions
+        failures = self.failures
+        outputs = self.outputs
+        suffixes = self.suffixes
+        terms = self.terms
+        # The end and term of the longest whole-word occurrence starting at each position
+        ends = {}
+        state = 0
+        for i, c in enumerate(txt.lower()):
+            next_state = transitions[state].get(c)
+            while next_state is None and state:
+                state = failures[state]
+                next_state = transitions[state].get(c)
+            state = next_state or 0
+            match = state if outputs[state] != -1 else suffixes[state]
+            while match:
+                term = outputs[match]
+                start = i + 1 - len(terms[term])
+                if self._is_word(txt, start, i + 1):
+                    # Longer occurrences from the same start end later, so are found later
+                    ends[start] = (i + 1, term)
+                match = suffixes[match]
+        occurrences = []
+        last_end = 0
+        for start in sorted(ends):
+            if start >= last_end:
+                end, term = ends[start]
+                occurrences.append((start, end, term))
+                last_end = end
+        return occurrences
+
+    @staticmethod
+    def _is_word(txt, start, end):
+        # Whether an occurrence is not part of a longer word
+        return ((start == 0 or not (txt[start - 1].isalnum() and txt[start].isalnum()))
+            and (end == len(txt) or not (txt[end].isalnum() and txt[end - 1].isalnum())))
+
+def load_glossary(path=None):
+    """Returns the glossary of a file (by default, that named by PYSCRIPTS_GLOSSARY, or
+    GLOSSARY_FILE), compiling it only if it has changed since it was last compiled."""
+    import hashlib
+    path = path or os.environ.get(GLOSSARY_ENVIRONMENT) or GLOSSARY_FILE
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        raise Exception("Error: glossary '%s' could not be read; set %s to its path." % (path, GLOSSARY_ENVIRONMENT))
+    digest = hashlib.sha1("%s\n%s\n%s" % (VERSION, sys.version, data)).hexdigest()
+    glossary = _GLOSSARIES.get(digest)
+    if glossary is not None:
+        return glossary
+    cache_path = os.path.join(GLOSSARY_CACHE_DIRECTORY, "%s.glossary" % digest)
+    try:
+        with open(cache_path, 'rb') as f:
+            glossary = Glossary.loads(f.read())
+    except Exception:
+        glossary = Glossary.parse(data.decode('utf-8'))
+        try:
+            if not os.path.isdir(GLOSSARY_CACHE_DIRECTORY):
+                os.makedirs(GLOSSARY_CACHE_DIRECTORY)
+            write_atomic(cache_path, glossary.dumps())
+        except (IOError, OSError):
+            # The glossary is compiled again next time
+            pass
+    _GLOSSARIES[digest] = glossary
+    return glossary
+
+#
+# CSS Methods
+#
+
+# Comments, strings, unquoted urls, braces and semicolons, and the text between them;
+# unterminated comments, strings and urls run to the end of the text
+_CSS_TOKENS = LazyPattern(r"""
+    (?P<comment>/\*.*?(?:\*/|\Z))
+    | (?P<string>"(?:\\.|[^"\\])*(?:"|\Z) | '(?:\\.|[^'\\])*(?:'|\Z))
+    | (?P<url>[uU][rR][lL]\(\s*(?:\\.|[^)"'\\])*(?:\)|\Z))
+    | (?P<punctuation>[{};])
+    | (?P<text>(?:(?![uU][rR][lL]\()[^{};/"'])+|/|[uU])
+    """, re.DOTALL | re.VERBOSE)
+_WHITESPACE = LazyPattern(r'\s+')
+
+def format_css(txt, indent=u'    '):
+    """Returns the lines of a stylesheet, formatted in one pass over its tokens.
+
+    Each selector (or at-rule) ends its line with a {, each declaration is on its own line,
+    indented by its nesting, and each closing brace is on its own line. Blocks and comments at
+    the top level are followed by a blank line. Whitespace is collapsed outside
+    strings and comments, and any number of rules may share a line.
+    """
+    lines = []
+    pending = []
+    depth = 0
+
+    def flush(ending=u''):
+        text = u''.join(pending).strip()
+        del pending[:]
+        if text or ending == u';':
+            lines.append(indent * depth + text + ending)
+
+    for match in _CSS_TOKENS.finditer(txt):
+        kind = match.lastgroup
+        token = match.group()
+        if kind == 'text':
+            pending.append(_WHITESPACE.sub(u' ', token))
+        elif kind == 'string' or kind == 'url':
+            pending.append(token)
+        elif kind == 'comment':
+            if u''.join(pending).strip():
+                # Within a selector or declaration
+                pending.append(token)
+            else:
+                del pending[:]
+                lines.append(indent * depth + token)
+                if depth == 0:
+                    lines.append(u'')
+        elif token == u'{':
+            flush(u' {')
+            depth += 1
+        elif token == u';':
+            flush(u';')
+        else:
+            flush()
+            depth = max(depth - 1, 0)
+            if lines and not lines[-1]:
+                # No blank line before a closing brace
+                lines.pop()
+            lines.append(indent * depth + u'}')
+            if depth == 0:
+                lines.append(u'')
+    flush()
+    new_lines = []
+    for line in lines:
+        if line or (new_lines and new_lines[-1]):
+            new_lines.append(line)
+    while new_lines and not new_lines[-1]:
+        new_lines.pop()
+    return new_lines
+
 
 class Tasks(object):
 
-    def run_task(self, argument, parameter):
-        """Dispatch method"""
+    def __init__(self, profile=None, cache=None, metrics=None):
+        self.profile = profile
+        # False for no cache, even if PYSCRIPTS_CACHE is set
+        self.cache = cache if cache is not None else open_cache()
+        # False for no metrics, even if PYSCRIPTS_METRICS is set
+        self.metrics = metrics if metrics is not None else open_metrics()
+
+    def run_task(self, argument, parameter, phases=None):
+        """Dispatch method
+
+        The argument names a task, or a pipeline of tasks separated by '|' that are run in turn.
+        If a profile is given, or PYSCRIPTS_PROFILE is set, the dispatch is profiled; if there is
+        a cache, or PYSCRIPTS_CACHE is set, results are looked up in it. If there is a metrics
+        log, or PYSCRIPTS_METRICS is set, the time the task takes is added to phases, for the
+        caller to record with the other phases of the invocation, or if there are no phases,
+        recorded at once.
+        """
+        if not self.metrics:
+            return self.dispatch_task(argument, parameter)
+        start = time.time()
+        new_txt = self.dispatch_task(argument, parameter)
+        if phases is None:
+            self.metrics.record(argument, len(parameter.encode('utf-8')), {'task': time.time() - start}, 'task')
+        else:
+            phases['task'] = time.time() - start
+        return new_txt
+
+    def dispatch_task(self, argument, parameter):
+        """Runs a task or pipeline of tasks, profiled if there is a profile."""
+        profile = self.profile or start_profile(argument, parameter)
+        if profile is None:
+            return self.cached_dispatch(argument, parameter)
+        new_txt = profile.run('dispatch', self.cached_dispatch, argument, parameter)
+        if profile is not self.profile:
+            profile.save()
+        return new_txt
+
+    def cached_dispatch(self, argument, parameter):
+        """Runs a task or pipeline of tasks, looking up its result in the cache, if there is one,
+        when its result depends only on its text."""
+        cache = self.cache
+        if not cache or len(parameter) < CACHE_MIN_SIZE or not self.is_cacheable(argument):
+            return self.dispatch(argument, parameter)
+        key = cache.key(argument, parameter)
+        new_txt = cache.get(key)
+        if new_txt is None:
+            new_txt = self.dispatch(argument, parameter)
+            cache.put(key, new_txt)
+        return new_txt
+
+    def is_cacheable(self, argument):
+        """Returns whether the result of a task or pipeline depends only on its text."""
+        for name in argument.split(u'|'):
+            if getattr(self.get_task(name.strip()), 'uncached', False):
+                return False
+        return True
+
+    def dispatch(self, argument, parameter):
+        """Runs a task or pipeline of tasks."""
+        if u'|' in argument:
+            return self.run_pipeline(argument, parameter)
+        return self.get_task(argument)(parameter)
+
+    def get_task(self, argument):
+        """Returns the method for a task name.
+
+        The name may be followed by ':' and an option, as in 'sort_table:2', for tasks taking
+        one; the function returned passes the option to the method.
+        """
+        name, colon, option = argument.partition(u':')
         # Prefix the method_name with 'task_', replacing hyphens with underscores
-        method_name = 'task_' + str(argument).replace('-', '_').replace(' ', '_').replace('\'', '').lower()
+        method_name = 'task_' + str(name).replace('-', '_').replace(' ', '_').replace('\'', '').lower()
         # Get the method from 'self'.
         method = getattr(self, method_name, '')
-        if method:
-            # Call the method as we return it
-            return method(parameter)
-        else:
-            raise Exception("Error: script task '%s' not found." % argument)
+        if not method:
+            raise Exception("Error: script task '%s' not found." % name)
+        if not colon:
+            return method
+        if method.im_func.func_code.co_argcount < 3:
+            raise Exception("Error: script task '%s' takes no option." % name)
+
+        def task_with_option(txt):
+            return method(txt, option)
+        return task_with_option
+
+    def run_pipeline(self, argument, parameter):
+        """Runs a pipeline of tasks, such as 'case_lower|replace_spaces|double_quotes'.
+
+        Adjacent tasks that work line by line are fused: the text is split into lines once, each
+        line passed through all of them, and the lines joined (and the ending added) once.
+        """
+        txt = parameter
+        for stage in fuse_tasks([self.get_task(name.strip()) for name in argument.split(u'|')]):
+            txt = stage(txt)
+        return txt
 
     def task_bold(self, txt):
         new_txt = txt.strip()
@@ -95,17 +1723,13 @@ class Tasks(object):
 
 #     Changing Text Case
 
-    def task_case_lower(self, txt):
-        return txt.lower()
+    task_case_lower = text_task(lambda txt: txt.lower())
 
-    def task_lowercase(self, txt):
-        return self.task_case_lower(txt)
+    task_lowercase = task_case_lower
 
-    def task_case_upper(self, txt):
-        return txt.upper()
+    task_case_upper = text_task(lambda txt: txt.upper())
 
-    def task_uppercase(self, txt):
-        return self.task_case_upper(txt)
+    task_uppercase = task_case_upper
 
 #     Changing Enclosing Quotes
 
@@ -147,52 +1771,12 @@ class Tasks(object):
             return txt
 
     def task_wrap(self, txt):
-        # Wraps and indents lines if first character of a line is a hyphen
-        # FIXME: handle indented wraps
-        new_txt = txt
-        new_lines = []
-        in_wrap = []
-        lines = txt.splitlines()
-        if len(lines) > 1:
-            in_wrap = False
-            for line in lines:
-                line_clean = line.lstrip()
-                if line_clean.startswith('- ') or line_clean.startswith('* '):
-                    in_wrap = True
-                    diff = len(line) - len(line_clean)
-                elif line and in_wrap:
-                    line = "%s  %s" % (' ' * diff, line_clean)
-                else:
-                    in_wrap = False
-                    diff = 0
-                new_lines.append(line)
-            new_txt = join_lines(new_lines, txt)
-        return new_txt
+        # Fills paragraphs and list items to WRAP_WIDTH, with hanging indents under bullets
+        return join_lines(reflow(split_lines(txt)), txt)
 
     def task_css(self, txt):
         # Format css so that each line ends with a {
-        lines = []
-        for line in txt.splitlines():
-            line_clean = line.rstrip()
-            left_brace = line_clean.find('{')
-            right_brace = line_clean.find('}')
-            if line_clean == '{':
-                lines[-1] += ' {'
-            elif (left_brace != -1) and (right_brace != -1):
-                lines.append(line_clean[:left_brace+1])
-                lines.append(' ' * 4 + line_clean[left_brace+1:right_brace].strip())
-                lines.append('}')
-                lines.append('')
-            else:
-                lines.append(line_clean)
-        new_lines = []
-        for i in range(len(lines)):
-            new_lines.append(lines[i])
-            if lines[i].endswith('*/'):
-                if (i+1 < len(lines)) and lines[i+1]:
-                    # Add an empty line after a comment
-                    new_lines.append('')
-        return join_lines(new_lines, txt)
+        return join_lines(format_css(txt), txt)
 
     # Underline Methods
 
@@ -227,6 +1811,19 @@ class Tasks(object):
                 pass
         return new_txt
 
+    def task_normalize_headings(self, txt):
+        # Makes the over- and underlines of every heading in a document the length of its title,
+        # checking that the heading levels of an RST document are consistent
+        headings = Headings(txt.splitlines())
+        if headings.errors:
+            raise Exception("Error: heading levels are inconsistent: %s%s." % ('; '.join(
+                headings.errors[:HEADING_ERRORS_LIMIT]), '; ...' if len(headings.errors) > HEADING_ERRORS_LIMIT else ''))
+        return join_lines(headings.lines(), txt)
+
+    def task_table_of_contents(self, txt):
+        # Inserts a nested list of links to the headings of a document, or refreshes it
+        return join_lines(table_of_contents(txt.splitlines()), txt)
+
     def task_underline(self, txt):
         lines = txt.splitlines()
         new_txt = txt
@@ -247,159 +1844,148 @@ class Tasks(object):
             end = '\n'
         else:
             end = ''
-        return "%s%s" % (txt.replace('\\', '\\\\'), end)
+        return "%s%s" % (ESCAPE_BACKSLASHES(txt), end)
 
     #
     # Replacement Methods
     #
 
-    def task_replace_with_hyphens(self, txt):
-        return txt.lower().replace(' ', '-').replace('_', '-')
+    task_replace_with_hyphens = translation_task({u' ': u'-', u'_': u'-'}, lower=True)
 
-    def task_replace_hyphens(self, txt):
-        return txt.lower().replace('-', '_')
+    task_replace_hyphens = translation_task({u'-': u'_'}, lower=True)
 
-    def task_replace_spaces(self, txt):
-        return txt.lower().replace(' ', '-')
+    task_replace_spaces = translation_task({u' ': u'-'}, lower=True)
 
-    def task_swap_quotes(self, txt):
-        new_txt = ''
-        for i in txt:
-            if i == '\'':
-                new_txt += '"'
-            elif i == '"':
-                new_txt += '\''
-            else:
-                new_txt += i
-        return new_txt
+    task_swap_quotes = translation_task({u'\'': u'"', u'"': u'\''})
 
     #
     # Misc. Methods
     #
 
+    _comment_rst = line_task(lambda line: '.. ' + line)
+
+    _uncomment_rst = substitution_task(u'^\\.\\. ', u'')
+
     def task_rst_comment(self, txt):
-        commented = False
-        new_lines = []
-        lines = txt.splitlines()
-        for line in lines:
-            if lines[0].startswith('..'):
-                commented = True
-            if commented: # Need to remove comments
-                if line.startswith('.. '):
-                    new_lines.append(line[3:])
-                else:
-                    new_lines.append(line)
-            else: # Need to add comments
-                new_lines.append('.. ' + line)
-        return join_lines(new_lines, txt)
+        # Removes comment markers if the first line has one, otherwise adds them to every line
+        if txt.startswith('..'):
+            return self._uncomment_rst(txt)
+        return self._comment_rst(txt)
 
-    def task_shift_left(self, txt):
-        new_lines = []
-        for line in txt.splitlines():
-            if line.startswith(' '):
-                new_lines.append(line[1:])
-            else:
-                new_lines.append(line)
-        return join_lines(new_lines, txt)
+    task_shift_left = line_task(lambda line: line[1:] if line.startswith(' ') else line)
 
-    def task_shift_right(self, txt):
-        new_lines = []
-        for line in txt.splitlines():
-            new_lines.append(" %s" % line)
-        return join_lines(new_lines, txt)
+    task_shift_right = line_task(lambda line: " %s" % line)
 
-    def task_delete_left(self, txt):
-        new_lines = []
-        for line in txt.splitlines():
-            new_lines.append(line[1:])
+    task_delete_left = line_task(lambda line: line[1:])
+
+    #
+    # Glossary Methods
+    #
+
+    @uncached
+    def task_glossary(self, txt):
+        # Appends an RST definition list of the glossary terms used, with their definitions and
+        # the lines they are used on
+        glossary = load_glossary()
+        newline = u'\n' if u'\n' in txt else u'\r'
+        lines_used = {}
+        line = 1
+        position = 0
+        for start, end, term in glossary.find(txt):
+            line += txt.count(newline, position, start)
+            position = start
+            lines_used.setdefault(term, []).append(line)
+        if not lines_used:
+            return txt
+        new_lines = [txt.rstrip(), u'', u'Glossary', u'--------', u'']
+        for term in sorted(lines_used, key=lambda term: glossary.terms[term].lower()):
+            line_numbers = sorted(set(lines_used[term]))
+            new_lines.append(glossary.terms[term])
+            new_lines.append(u"    %s(line%s %s)" % (glossary.definitions[term] + u' ' if glossary.definitions[term] else u'',
+                u's' if len(line_numbers) > 1 else u'', u', '.join(str(n) for n in line_numbers)))
         return join_lines(new_lines, txt)
 
+    @uncached
+    def task_glossary_link(self, txt):
+        # Makes each use of a glossary term defined by a URL a Markdown link to it
+        glossary = load_glossary()
+        new_txt = []
+        position = 0
+        for start, end, term in glossary.find(txt):
+            url = glossary.definitions[term]
+            if _URL.match(url) and txt[start - 1:start] != u'[':
+                new_txt.append(txt[position:start])
+                new_txt.append(u"[%s](%s)" % (txt[start:end], url))
+                position = end
+        new_txt.append(txt[position:])
+        return u''.join(new_txt)
+
+    @uncached
     def task_search_with_duckduckgo(self, txt):
         os.system("open \"https://duckduckgo.com/?q=%s\"" % txt)
         return txt
 
+    @uncached
     def task_insert_todays_date(self, txt):
         return time.strftime('%x')
 
+    def task_format_tables(self, txt):
+        # Formats every Markdown pipe table and RST grid and simple table in a document, leaving
+        # the text around them as it is
+        return format_tables(txt)
+
     def task_build_table_rst(self, txt):
-        self.fields = []
-        self.fields_just = []
-        new_lines = []
-        for line in txt.splitlines():
-            self._analyze_fields(line)
-        for line in txt.splitlines():
-            new_lines.append(self._build_line(line))
-        return join_lines(new_lines, txt)
+        return join_lines(Table(txt).lines(), txt)
 
     # Build a Markdown Table
 
     def task_build_table_markdown(self, txt):
-        self.fields = []
-        self.fields_just = []
-        new_lines = []
-        for line in txt.splitlines():
-            self._analyze_fields(line)
-        for line in txt.splitlines():
-            new_lines.append(self._build_line(line))
-        return join_lines(new_lines, txt)
+        return join_lines(Table(txt).lines(), txt)
 
-    def _analyze_fields(self, line):
-        line_fields = line.split('|')
-        if line_fields and line_fields[0] == u'':
-            line_fields = line_fields[1:]
-        if line_fields and line_fields[-1] == u'':
-            line_fields = line_fields[:-1]
-        if len(self.fields) < len(line_fields):
-            self.fields += [0] * (len(line_fields) - len(self.fields))
-        if len(self.fields_just) < len(line_fields):
-            self.fields_just += [0] * (len(line_fields) - len(self.fields_just))
-        for f in range(len(line_fields)):
-            line_field = line_fields[f].strip()
-            if line_field.startswith(':---') and line_field.endswith('---:'):
-                # centered justification
-                self.fields_just[f] = 'c'
-            elif line_field.startswith(':---'):
-                # left justification
-                self.fields_just[f] = 'l'
-            elif line_field.endswith('---:'):
-                # right justification
-                self.fields_just[f] = 'r'
-            elif line_field.startswith('---'):
-                # default justification
-                self.fields_just[f] = 0
-            if len(line_field) > self.fields[f] and not (line_field.startswith('--')
-                    or line_field.startswith(':-') or line_field.endswith('-:')):
-                self.fields[f] = len(line_field)
-            if self.fields[f] < 3:
-                self.fields[f] = 3
-
-    def _build_line(self, line):
-        line_fields = line.split('|')
-        if line_fields and line_fields[0] == u'':
-            line_fields = line_fields[1:]
-        if line_fields and line_fields[-1] == u'':
-            line_fields = line_fields[:-1]
-        for f in range(len(line_fields)):
-            line_field = line_fields[f].strip()
-            if line_field.startswith(':---') and line_field.endswith('---:'):
-                line_fields[f] = ":%s:" % ('-' * (self.fields[f] -2))
-            elif line_field.startswith(':---'):
-                line_fields[f] = ":%s" % ('-' * (self.fields[f] -1))
-            elif line_field.endswith('---:'):
-                line_fields[f] = "%s:" % ('-' * (self.fields[f] -1))
-            elif line_field.startswith('---'):
-                line_fields[f] = '-' * self.fields[f]
-            else:
-                if self.fields_just[f] == 'c':
-                    space = self.fields[f] - len(line_field)
-                    space_left = int(space/2) * ' '
-                    space_right = (space - int(space/2)) * ' '
-                    line_fields[f] = "%s%s%s" % (space_left, line_field, space_right)
-                elif self.fields_just[f] == 'r':
-                    line_fields[f] = line_field.rjust(self.fields[f], ' ')
-                else:
-                    line_fields[f] = line_field.ljust(self.fields[f], ' ')
-        return "| %s |" % ' | '.join(line_fields)
+    # Sort, filter and rearrange a Markdown table; options name columns by number, from 1
+
+    def task_sort_table(self, txt, columns=u'1'):
+        # Sorts the rows below the rule row, if any, by columns, such as '2,-1' (by the second column,
+        # then the first descending): numbers by value, then text in natural order
+        table = Columns(txt)
+        table.sort([(table.column(number.strip().lstrip(u'-')), number.strip().startswith(u'-'))
+            for number in columns.split(u',')])
+        return join_lines(table.lines(), txt)
+
+    def task_sort_table_descending(self, txt, columns=u'1'):
+        numbers = [number.strip() for number in columns.split(u',')]
+        return self.task_sort_table(txt, u','.join(number[1:] if number.startswith(u'-') else u'-' + number
+            for number in numbers))
+
+    def task_filter_table(self, txt, condition=None):
+        # Keeps the rows below the rule row, if any, with some text in a column, as in '2=done', or
+        # without it, as in '2!=done'
+        number, equals, text = (condition or u'').partition(u'=')
+        if not equals:
+            raise Exception("Error: script task 'filter_table' needs a condition, as in 'filter_table:2=done'.")
+        table = Columns(txt)
+        table.filter(table.column(number.rstrip(u'!')), text, not number.endswith(u'!'))
+        return join_lines(table.lines(), txt)
+
+    def task_remove_duplicate_table_rows(self, txt):
+        table = Columns(txt)
+        table.dedupe()
+        return join_lines(table.lines(), txt)
+
+    def task_drop_table_columns(self, txt, columns=None):
+        if not columns:
+            raise Exception("Error: script task 'drop_table_columns' needs columns, as in 'drop_table_columns:2,3'.")
+        table = Columns(txt)
+        table.drop(table.columns(columns))
+        return join_lines(table.lines(), txt)
+
+    def task_reorder_table_columns(self, txt, columns=None):
+        # Moves columns to the front, in the order given, as in '3,1'
+        if not columns:
+            raise Exception("Error: script task 'reorder_table_columns' needs columns, as in 'reorder_table_columns:3,1'.")
+        table = Columns(txt)
+        table.reorder(table.columns(columns))
+        return join_lines(table.lines(), txt)
 
     def task_(self, txt):
         return txt
@@ -408,22 +1994,1251 @@ class Tasks(object):
         return txt
 
 
+def render_result(new_txt, parameter):
+    """Returns the text to be written back for a task result, restoring any trailing whitespace."""
+    if not new_txt:
+        return u''
+    if parameter and parameter[-1].isspace():
+        return new_txt + parameter[-1]
+    return new_txt
+
+#
+# Edit Methods
+#
+# A task's result can be written as the edits turning its text into the result, so that only
+# the changed parts of a large selection are replaced. The edit script is a line giving the
+# number of edits and the length of the result; a line for each edit, in order, giving its
+# offset in the text, the length it replaces and the length of its replacement; and then the
+# replacements, one after another.
+#
+
+# Edits beyond which they are merged into one, as each is applied by a separate command
+EDITS_LIMIT = 100
+
+def common_prefix(a, b):
+    """Returns the length of the common prefix of two strings.
+
+    Slices of doubling length are compared until one differs, and the difference found in it by
+    bisection, so that long common prefixes are compared at the speed of string comparison.
+    """
+    limit = min(len(a), len(b))
+    low = 0
+    size = 64
+    while low < limit:
+        high = min(low + size, limit)
+        if a[low:high] != b[low:high]:
+            while high - low > 1:
+                middle = (low + high) // 2
+                if a[low:middle] == b[low:middle]:
+                    low = middle
+                else:
+                    high = middle
+            return low
+        low = high
+        size *= 2
+    return limit
+
+def common_suffix(a, b, limit=None):
+    """Returns the length of the common suffix of two strings, no longer than limit."""
+    length_a = len(a)
+    length_b = len(b)
+    limit = min(length_a, length_b) if limit is None else limit
+    low = 0
+    size = 64
+    while low < limit:
+        high = min(low + size, limit)
+        if a[length_a - high:length_a - low] != b[length_b - high:length_b - low]:
+            while high - low > 1:
+                middle = (low + high) // 2
+                if a[length_a - middle:length_a - low] == b[length_b - middle:length_b - low]:
+                    low = middle
+                else:
+                    high = middle
+            return low
+        low = high
+        size *= 2
+    return limit
+
+def _unique_matches(a, b, a_start, a_end, b_start, b_end):
+    # The lines occurring once in each range, paired, as the longest run in order in both
+    import bisect
+    counts = {}
+    for i in xrange(a_start, a_end):
+        counts[a[i]] = -1 if a[i] in counts else i
+    matches = {}
+    for j in xrange(b_start, b_end):
+        i = counts.get(b[j], -1)
+        if i != -1:
+            matches[b[j]] = -1 if b[j] in matches else (i, j)
+    pairs = sorted(pair for pair in matches.itervalues() if pair != -1)
+    # Patience sorting: the longest increasing subsequence of the lines of b
+    tails = []
+    tail_pairs = []
+    previous = {}
+    for pair in pairs:
+        k = bisect.bisect_left(tails, pair[1])
+        previous[pair] = tail_pairs[k - 1] if k else None
+        if k == len(tails):
+            tails.append(pair[1])
+            tail_pairs.append(pair)
+        else:
+            tails[k] = pair[1]
+            tail_pairs[k] = pair
+    run = []
+    pair = tail_pairs[-1] if tail_pairs else None
+    while pair is not None:
+        run.append(pair)
+        pair = previous[pair]
+    run.reverse()
+    return run
+
+def diff_edits(txt, new_txt, limit=EDITS_LIMIT):
+    """Returns the (offset, length, replacement) edits, in order, turning txt into new_txt.
+
+    The common start and end of the texts are skipped first; the lines between are aligned as
+    in patience diff, on the lines occurring once in each, and each run of differing lines is
+    narrowed to the characters that differ. Texts that are mostly the same, as most results
+    are, are compared in about linear time. More than limit edits are merged into one.
+    """
+    start = common_prefix(txt, new_txt)
+    end = common_suffix(txt, new_txt, min(len(txt), len(new_txt)) - start)
+    if start == len(txt) - end and start == len(new_txt) - end:
+        return []
+    # Whole lines, from the start of the first line changed to the end of the last
+    line_start = max(txt.rfind(u'\n', 0, start), txt.rfind(u'\r', 0, start)) + 1
+    old_end = len(txt) - end
+    for ending in (u'\n', u'\r'):
+        position = txt.find(ending, old_end)
+        if position != -1 and position - old_end < end:
+            end = len(txt) - position - 1
+    a = txt[line_start:len(txt) - end].splitlines(True)
+    b = new_txt[line_start:len(new_txt) - end].splitlines(True)
+    a_offsets = [line_start]
+    for line in a:
+        a_offsets.append(a_offsets[-1] + len(line))
+    b_offsets = [line_start]
+    for line in b:
+        b_offsets.append(b_offsets[-1] + len(line))
+
+    edits = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        a_start, a_end, b_start, b_end = regions.pop()
+        while a_start < a_end and b_start < b_end and a[a_start] == b[b_start]:
+            a_start += 1
+            b_start += 1
+        while a_start < a_end and b_start < b_end and a[a_end - 1] == b[b_end - 1]:
+            a_end -= 1
+            b_end -= 1
+        if a_start == a_end and b_start == b_end:
+            continue
+        matches = _unique_matches(a, b, a_start, a_end, b_start, b_end) if a_start < a_end and b_start < b_end else []
+        if not matches:
+            old = txt[a_offsets[a_start]:a_offsets[a_end]]
+            new = new_txt[b_offsets[b_start]:b_offsets[b_end]]
+            prefix = common_prefix(old, new)
+            suffix = common_suffix(old, new, min(len(old), len(new)) - prefix)
+            edits.append((a_offsets[a_start] + prefix, len(old) - prefix - suffix, new[prefix:len(new) - suffix]))
+            continue
+        # Regions are taken from the end of the stack, so are pushed last first
+        for i, j in reversed(matches):
+            regions.append((i + 1, a_end, j + 1, b_end))
+            a_end = i
+            b_end = j
+        regions.append((a_start, a_end, b_start, b_end))
+    if len(edits) > limit:
+        first = edits[0][0]
+        last = edits[-1][0] + edits[-1][1]
+        edits = [(first, last - first, new_txt[first:len(new_txt) - (len(txt) - last)])]
+    return edits
+
+def apply_edits(txt, edits):
+    """Returns txt with the edits made."""
+    parts = []
+    position = 0
+    for offset, length, replacement in edits:
+        parts.append(txt[position:offset])
+        parts.append(replacement)
+        position = offset + length
+    parts.append(txt[position:])
+    return u''.join(parts)
+
+def format_edits(edits, new_txt):
+    """Returns the edit script of edits giving new_txt."""
+    lines = [u"%d %d" % (len(edits), len(new_txt))]
+    lines.extend(u"%d %d %d" % (offset, length, len(replacement)) for offset, length, replacement in edits)
+    return u"%s\n%s" % (u'\n'.join(lines), u''.join(edit[2] for edit in edits))
+
+def parse_edits(script):
+    """Returns the edits, and the length of the result, of an edit script."""
+    header, _, rest = script.partition(u'\n')
+    count, new_length = map(int, header.split())
+    lines = rest.split(u'\n', count)
+    replacements = lines[count] if count else u''
+    edits = []
+    position = 0
+    for line in lines[:count]:
+        offset, length, replacement_length = map(int, line.split())
+        edits.append((offset, length, replacements[position:position + replacement_length]))
+        position += replacement_length
+    return edits, new_length
+
+#
+# Input and Output Methods
+#
+
+def read_input(path):
+    """Reads and decodes the text for a task from a file path, or stdin if the path is '-'.
+
+    Large files are memory-mapped and decoded straight from the mapping, so that the file
+    contents are only copied once, into the decoded text.
+    """
+    if path == '-':
+        return sys.stdin.read().decode('utf-8')
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < MMAP_THRESHOLD:
+            return f.read().decode('utf-8')
+        import codecs
+        import mmap
+        mapping = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            return codecs.utf_8_decode(mapping, 'strict', True)[0]
+        finally:
+            mapping.close()
+
+def write_output(path, new_txt):
+    """Writes the encoded result of a task to a file path, or stdout if the path is '-'."""
+    data = new_txt.encode('utf-8') if new_txt else ''
+    if path == '-':
+        sys.stdout.write(data)
+        sys.stdout.flush()
+    else:
+        with open(path, 'wb') as f:
+            f.write(data)
+
+def run_with_options(arguments):
+    """Runs a task reading its text from, and writing its result to, the given files.
+
+    Unlike passing the text as an argument, the text is not limited in size by the shell, and
+    the result is written exactly as returned by the task.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='pyscripts.py')
+    parser.add_argument('--input', default='-', help="file with the text for the task ('-' for stdin)")
+    parser.add_argument('--output', default='-', help="file for the result of the task ('-' for stdout)")
+    parser.add_argument('--edits', action='store_true',
+        help='write the edits turning the text into the result, rather than the result')
+    parser.add_argument('task')
+    options = parser.parse_args(arguments)
+    phases = {'startup': process_time()}
+    profile = start_profile(options.task)
+    with profile_phase(profile, 'decode', phases):
+        parameter = read_input(options.input)
+    tasks = Tasks(profile)
+    new_txt = tasks.run_task(options.task.decode('utf-8'), parameter, phases)
+    with profile_phase(profile, 'encode', phases):
+        if options.edits:
+            new_txt = format_edits(diff_edits(parameter, new_txt or u''), new_txt or u'')
+        write_output(options.output, new_txt)
+    if profile:
+        profile.save(parameter)
+    if tasks.metrics:
+        tasks.metrics.record(options.task, os.path.getsize(options.input) if options.input != '-'
+            else len(parameter.encode('utf-8')), phases, 'command')
+
+def read_fragments(stream):
+    """Generates the (task, text) items of a UTF-8 fragment stream as they are read.
+
+    Each item is a line giving the length of its text, in characters, a space and its task,
+    followed by the text. Results are written back in the same form, with a status ('OK' or
+    'ERROR') in place of the task.
+    """
+    import codecs
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    while True:
+        header = stream.readline()
+        if not header:
+            return
+        length, _, task = header.rstrip('\r\n').decode('utf-8').partition(u' ')
+        try:
+            length = int(length)
+        except ValueError:
+            raise Exception("Error: fragment header '%s' does not start with a length." % header.strip())
+        # A character is at least a byte, so reading as many bytes as there are characters
+        # still to come never reads beyond the text, and the next item need not have been
+        # written yet
+        pieces = []
+        count = 0
+        while count < length:
+            data = stream.read(length - count)
+            if not data:
+                raise Exception("Error: fragment stream ends within the text of '%s'." % task)
+            piece = decoder.decode(data)
+            pieces.append(piece)
+            count += len(piece)
+        yield task, u''.join(pieces)
+
+def run_fragments(arguments):
+    """Runs the tasks of a fragment stream (see read_fragments) with one Tasks instance, writing
+    each result as soon as it is found, in order.
+
+    Many selections, or matches, are thus handled by one process; a task failing gives an
+    ERROR result, with its message as the text, and the rest still run. A client writing to
+    stdin should read the results as it goes, or write to a file, so that neither pipe fills.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(prog='pyscripts.py --fragments')
+    parser.add_argument('--input', default='-', help="file with the fragment stream ('-' for stdin)")
+    parser.add_argument('--output', default='-', help="file for the results ('-' for stdout)")
+    options = parser.parse_args(arguments)
+    input_file = sys.stdin if options.input == '-' else open(options.input, 'rb')
+    output_file = sys.stdout if options.output == '-' else open(options.output, 'wb')
+    tasks = Tasks()
+    try:
+        for task, text in read_fragments(input_file):
+            try:
+                new_txt = tasks.run_task(task, text) or u''
+                status = u'OK'
+            except Exception, e:
+                new_txt = u"%s" % e
+                status = u'ERROR'
+            output_file.write((u"%d %s\n%s" % (len(new_txt), status, new_txt)).encode('utf-8'))
+            output_file.flush()
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+        if output_file is not sys.stdout:
+            output_file.close()
+
+#
+# Profiling Methods
+#
+
+class Profile(object):
+    """A profile of one invocation: phase timings, a cProfile of the dispatch and its memory use.
+
+    Memory is measured with tracemalloc when it is available (Python 3), giving the peak and the
+    top allocation sites; otherwise only the growth of the peak resident set size is recorded.
+    """
+
+    def __init__(self, directory, task):
+        self.directory = directory
+        self.task = task
+        self.phases = []
+        self.memory = {}
+        self.profiler = None
+
+    def phase(self, name):
+        return _ProfilePhase(self, name)
+
+    def run(self, name, function, *arguments):
+        import cProfile
+        try:
+            import tracemalloc
+        except ImportError:
+            tracemalloc = None
+        import resource
+        self.profiler = cProfile.Profile()
+        if tracemalloc:
+            tracemalloc.start(10)
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        try:
+            with self.phase(name):
+                return self.profiler.runcall(function, *arguments)
+        finally:
+            self.memory['peak_rss_growth'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_rss
+            if tracemalloc:
+                snapshot = tracemalloc.take_snapshot()
+                self.memory['peak'] = tracemalloc.get_traced_memory()[1]
+                self.memory['top_allocations'] = [[str(statistic.traceback[0]), statistic.size, statistic.count]
+                    for statistic in snapshot.statistics('lineno')[:10]]
+                tracemalloc.stop()
+
+    def save(self, parameter=None):
+        """Writes the profile as <name>.prof (cProfile statistics) and <name>.json (the rest)."""
+        import json
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # Created by another invocation
+                pass
+        task = re.sub(r'[^\w-]+', '_', self.task)[:40]
+        name = "%s-%d-%s" % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(), task)
+        count = 1
+        while os.path.exists(os.path.join(self.directory, name + '.json')):
+            count += 1
+            name = "%s-%d-%s-%d" % (time.strftime('%Y%m%d-%H%M%S'), os.getpid(), task, count)
+        path = os.path.join(self.directory, name)
+        if self.profiler:
+            self.profiler.dump_stats(path + '.prof')
+        record = {'task': self.task, 'time': time.time(), 'phases': self.phases, 'memory': self.memory,
+            'input_size': len(parameter) if parameter is not None else None}
+        with open(path + '.json', 'w') as f:
+            json.dump(record, f)
+
+
+class _ProfilePhase(object):
+    """Times a phase of an invocation, adding it to the profile's phases, and to a dictionary of
+    phase timings for the metrics log."""
+
+    def __init__(self, profile, name, phases=None):
+        self.profile = profile
+        self.name = name
+        self.phases = phases
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exception):
+        seconds = time.time() - self.start
+        if self.profile is not None:
+            self.profile.phases.append([self.name, seconds])
+        if self.phases is not None:
+            self.phases[self.name] = self.phases.get(self.name, 0) + seconds
+        return False
+
+def start_profile(task, parameter=None):
+    """Returns a Profile for an invocation if PYSCRIPTS_PROFILE is set, otherwise None."""
+    value = os.environ.get(PROFILE_ENVIRONMENT)
+    if not value or value == '0':
+        return None
+    directory = PROFILE_DIRECTORY if value == '1' else os.path.expanduser(value)
+    return Profile(directory, task if isinstance(task, basestring) else str(task))
+
+def profile_phase(profile, name, phases=None):
+    """Returns a context manager timing a phase for a profile, which may be None, and a dictionary
+    of phase timings, if given."""
+    return _ProfilePhase(profile, name, phases)
+
+def profile_report(arguments):
+    """Prints the hottest functions, and the mean phase timings per task, of saved profiles."""
+    import argparse
+    import glob
+    import json
+    import pstats
+    parser = argparse.ArgumentParser(prog='pyscripts.py --profile-report')
+    parser.add_argument('directory', nargs='?', default=PROFILE_DIRECTORY)
+    parser.add_argument('--task', help='only include profiles of this task')
+    parser.add_argument('--top', type=int, default=20, help='number of functions to show')
+    parser.add_argument('--sort', default='cumulative', help="pstats sort key (default: 'cumulative')")
+    options = parser.parse_args(arguments)
+
+    tasks = {}
+    stats = None
+    for path in sorted(glob.glob(os.path.join(options.directory, '*.json'))):
+        with open(path) as f:
+            record = json.load(f)
+        if options.task and record['task'] != options.task:
+            continue
+        summary = tasks.setdefault(record['task'], {'runs': 0, 'phases': {}, 'peak_rss_growth': 0})
+        summary['runs'] += 1
+        for name, seconds in record['phases']:
+            summary['phases'][name] = summary['phases'].get(name, 0) + seconds
+        summary['peak_rss_growth'] = max(summary['peak_rss_growth'], record['memory'].get('peak_rss_growth', 0))
+        prof_path = path[:-len('.json')] + '.prof'
+        if os.path.exists(prof_path):
+            if stats is None:
+                stats = pstats.Stats(prof_path)
+            else:
+                stats.add(prof_path)
+    if not tasks:
+        print "No profiles found in '%s'" % options.directory
+        return
+
+    print "%-30s %6s %12s %12s %12s %14s" % ('task', 'runs', 'decode ms', 'dispatch ms', 'encode ms', 'max rss +')
+    for task, summary in sorted(tasks.items()):
+        means = [summary['phases'].get(name, 0) * 1000 / summary['runs'] for name in ('decode', 'dispatch', 'encode')]
+        print "%-30s %6d %12.2f %12.2f %12.2f %14d" % tuple([task, summary['runs']] + means
+            + [summary['peak_rss_growth']])
+    if stats is not None:
+        print
+        stats.sort_stats(options.sort).print_stats(options.top)
+
+def write_atomic(path, data):
+    """Writes data to a file by renaming a completed temporary file over it."""
+    import tempfile
+    directory, name = os.path.split(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(prefix=".%s." % name, dir=directory)
+    try:
+        with os.fdopen(handle, 'wb') as f:
+            f.write(data)
+        if os.path.exists(path):
+            os.chmod(temp_path, os.stat(path).st_mode & 07777)
+        os.rename(temp_path, path)
+    except:
+        os.unlink(temp_path)
+        raise
+
+#
+# Cache Methods
+#
+
+# The digest of this module's source, part of each cache key
+_SOURCE_HASH = []
+
+def source_hash():
+    """Returns a digest of the source of this module, so that results cached by other versions
+    of it are not used."""
+    import hashlib
+    if not _SOURCE_HASH:
+        path = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        if not os.path.exists(path):
+            # Run from a zip archive built by build.py, whose digest serves as well
+            path = os.path.dirname(path)
+        try:
+            with open(path, 'rb') as f:
+                _SOURCE_HASH.append(hashlib.sha1(f.read()).hexdigest())
+        except IOError:
+            # Without its source, only VERSION tells versions apart
+            _SOURCE_HASH.append('')
+    return _SOURCE_HASH[0]
+
+
+class ResultCache(object):
+    """Results of tasks, kept in a directory with one file per result, named by a digest of the
+    task, the version of pyscripts and the text.
+
+    Results are written atomically, so processes can read them without locking. The counts of
+    hits and misses, and the total size of the results, are kept in a statistics file updated
+    under a lock. When the results outgrow max_bytes, those used least recently (each file's
+    modification time is updated when it is read) are removed until they fill three quarters
+    of it.
+    """
+
+    STATISTICS = '.statistics.json'
+    LOCK = '.lock'
+
+    def __init__(self, directory, max_bytes=CACHE_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Made by another process
+                if not os.path.isdir(directory):
+                    raise
+
+    def key(self, task, txt):
+        """Returns the key of the result of a task (or pipeline) on a text."""
+        import hashlib
+        digest = hashlib.sha1("%s\n%s\n%s\n" % (VERSION, source_hash(), task.encode('utf-8')))
+        digest.update(txt.encode('utf-8') if isinstance(txt, unicode) else txt)
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns a cached result, or None, counting a hit or a miss."""
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, 'rb') as f:
+                new_txt = f.read().decode('utf-8')
+            os.utime(path, None)
+        except (IOError, OSError):
+            # Missing, or removed while being read
+            new_txt = None
+        self.update_statistics('misses' if new_txt is None else 'hits')
+        return new_txt
+
+    def put(self, key, new_txt):
+        """Caches a result, removing the least recently used results if the cache is full."""
+        data = new_txt.encode('utf-8') if isinstance(new_txt, unicode) else new_txt
+        try:
+            write_atomic(os.path.join(self.directory, key), data)
+        except (IOError, OSError):
+            return
+        self.update_statistics('stores', len(data))
+
+    def update_statistics(self, counter, size=0):
+        import json
+        with self._locked():
+            statistics = self.statistics()
+            statistics[counter] += 1
+            statistics['bytes'] += size
+            if statistics['bytes'] > self.max_bytes:
+                self._evict(statistics)
+            write_atomic(os.path.join(self.directory, self.STATISTICS), json.dumps(statistics, sort_keys=True))
+
+    def statistics(self):
+        """Returns the hits, misses, stores, evictions and bytes of the cache."""
+        import json
+        statistics = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0, 'bytes': 0}
+        try:
+            with open(os.path.join(self.directory, self.STATISTICS)) as f:
+                statistics.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        return statistics
+
+    def _evict(self, statistics):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.startswith('.'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+        entries.sort()
+        # Recounted, in case processes raced to store the same result
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, name in entries:
+            if total <= self.max_bytes * 3 // 4:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+            statistics['evictions'] += 1
+        statistics['bytes'] = total
+
+    def _locked(self):
+        return _FileLock(os.path.join(self.directory, self.LOCK))
+
+
+class _FileLock(object):
+    """An exclusive lock on a file, shared between processes, held within a with statement."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        import fcntl
+        self.file = open(self.path, 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exception):
+        import fcntl
+        fcntl.flock(self.file, fcntl.LOCK_UN)
+        self.file.close()
+        return False
+
+def open_cache():
+    """Returns a ResultCache if PYSCRIPTS_CACHE is set, otherwise None."""
+    value = os.environ.get(CACHE_ENVIRONMENT)
+    if not value or value == '0':
+        return None
+    return ResultCache(CACHE_DIRECTORY if value == '1' else os.path.expanduser(value))
+
+def cache_report(arguments):
+    """Prints the statistics of a result cache."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='pyscripts.py --cache-report')
+    parser.add_argument('directory', nargs='?', default=CACHE_DIRECTORY)
+    options = parser.parse_args(arguments)
+    statistics = ResultCache(options.directory).statistics()
+    lookups = statistics['hits'] + statistics['misses']
+    print "Cache '%s'" % options.directory
+    print "  %d hits, %d misses (%.1f%% hit rate)" % (statistics['hits'], statistics['misses'],
+        100.0 * statistics['hits'] / lookups if lookups else 0)
+    print "  %d results stored, %d evicted, %.1f KB cached" % (statistics['stores'], statistics['evictions'],
+        statistics['bytes'] / 1024.0)
+
+#
+# Metrics Methods
+#
+# Each run of a task is appended to the metrics log as a fixed-size record (its time, input size
+# in bytes, the length of its task name, its kind and the seconds taken by each phase) followed by
+# the task name. A record is written by one call of write on a file opened for appending, so processes
+# can record at once without a lock. When the log outgrows METRICS_MAX_BYTES it is renamed with
+# the suffix '.1', replacing the log before it, so at most twice that is kept.
+#
+
+# The phases of an invocation: starting python and loading pyscripts (as CPU time), decoding
+# the text, running the task and encoding and writing the result
+METRICS_PHASES = ('startup', 'decode', 'task', 'encode')
+# The kinds of run: a command, timed from starting python; a request to the server, already
+# started; and a task run on its own, in a fragment stream or batch worker, timed without the
+# other phases. Each kind is reported on its own, as their timings are not comparable
+METRICS_KINDS = ('command', 'server', 'task')
+_METRICS_RECORD = '<dIHB4f'
+
+def process_time():
+    """Returns the CPU time this process has used, which, before any task runs, is mostly the time
+    taken to start python and load pyscripts."""
+    return time.clock()
+
+
+class MetricsLog(object):
+    """An append-only log of the timings of task runs, rotated when it outgrows max_bytes."""
+
+    def __init__(self, path, max_bytes=METRICS_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def record(self, task, size, phases, kind):
+        """Appends a run of a task, given its input size in bytes, a dictionary of the seconds
+        taken by its phases and its kind (one of METRICS_KINDS)."""
+        import struct
+        name = task.encode('utf-8') if isinstance(task, unicode) else task
+        name = name[:0xffff]
+        data = struct.pack(_METRICS_RECORD, time.time(), min(size, 0xffffffff), len(name),
+            METRICS_KINDS.index(kind), *[phases.get(phase, 0.0) for phase in METRICS_PHASES]) + name
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another invocation
+                pass
+        handle = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            os.write(handle, data)
+            stat = os.fstat(handle)
+            if stat.st_size > self.max_bytes:
+                try:
+                    # Unless another invocation has rotated it already
+                    if os.stat(self.path).st_ino == stat.st_ino:
+                        os.rename(self.path, self.path + '.1')
+                except OSError:
+                    pass
+        finally:
+            os.close(handle)
+
+    def records(self):
+        """Generates the (time, task, kind, size, phases) of the runs logged, oldest first; a record
+        cut short, as by a full disk, ends its file."""
+        import struct
+        header_size = struct.calcsize(_METRICS_RECORD)
+        for path in [self.path + '.1', self.path]:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except IOError:
+                continue
+            position = 0
+            while position + header_size <= len(data):
+                fields = struct.unpack_from(_METRICS_RECORD, data, position)
+                position += header_size
+                name = data[position:position + fields[2]]
+                if len(name) < fields[2]:
+                    break
+                position += fields[2]
+                kind = METRICS_KINDS[fields[3]] if fields[3] < len(METRICS_KINDS) else 'unknown'
+                yield (fields[0], name.decode('utf-8', 'replace'), kind, fields[1],
+                    dict(zip(METRICS_PHASES, fields[4:])))
+
+def open_metrics():
+    """Returns a MetricsLog if PYSCRIPTS_METRICS is set, otherwise None."""
+    value = os.environ.get(METRICS_ENVIRONMENT)
+    if not value or value == '0':
+        return None
+    return MetricsLog(METRICS_FILE if value == '1' else os.path.expanduser(value))
+
+def percentile(values, fraction):
+    """Returns the value of sorted values below which a fraction of them lie (nearest rank)."""
+    import math
+    return values[max(int(math.ceil(fraction * len(values))) - 1, 0)]
+
+def metrics_report(arguments):
+    """Prints the latency percentiles, mean phase timings and throughput of each task logged, for
+    each kind of run."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='pyscripts.py --metrics-report')
+    parser.add_argument('path', nargs='?', default=METRICS_FILE)
+    parser.add_argument('--task', help='only include runs of this task')
+    parser.add_argument('--kind', choices=METRICS_KINDS, help='only include runs of this kind')
+    parser.add_argument('--since', type=float, default=0, help='only include runs in the last so many days')
+    options = parser.parse_args(arguments)
+    since = time.time() - options.since * 86400 if options.since else 0
+    tasks = {}
+    for when, task, kind, size, phases in MetricsLog(options.path).records():
+        if when < since or options.task and task != options.task or options.kind and kind != options.kind:
+            continue
+        summary = tasks.setdefault((task, kind), {'latencies': [], 'phases': dict.fromkeys(METRICS_PHASES, 0.0), 'bytes': 0})
+        summary['latencies'].append(sum(phases.values()))
+        for phase, seconds in phases.iteritems():
+            summary['phases'][phase] += seconds
+        summary['bytes'] += size
+    if not tasks:
+        print "No runs found in '%s'" % options.path
+        return
+
+    print "%-30s %-7s %6s %9s %9s %9s %10s %9s %9s %9s %9s" % ('task', 'kind', 'runs', 'p50 ms', 'p95 ms', 'p99 ms',
+        'startup ms', 'decode ms', 'task ms', 'encode ms', 'task MB/s')
+    # The tasks taking the most time in all come first, as those where optimization pays off
+    for (task, kind), summary in sorted(tasks.items(), key=lambda item: -sum(item[1]['latencies'])):
+        latencies = sorted(summary['latencies'])
+        runs = len(latencies)
+        task_seconds = summary['phases']['task']
+        print "%-30s %-7s %6d %9.2f %9.2f %9.2f %10.2f %9.2f %9.2f %9.2f %9s" % tuple([task[:30], kind, runs]
+            + [percentile(latencies, fraction) * 1000 for fraction in (0.5, 0.95, 0.99)]
+            + [summary['phases'][phase] * 1000 / runs for phase in METRICS_PHASES]
+            + ["%.2f" % (summary['bytes'] / task_seconds / (1024 * 1024)) if task_seconds else '-'])
+
+#
+# Batch Methods
+#
+
+def batch_files(patterns, name_pattern='*'):
+    """Generates (path, output name) pairs for files, globs and directory trees.
+
+    The output name is the path relative to the directory given, or the file name.
+    """
+    import fnmatch
+    import glob
+    for pattern in patterns:
+        paths = glob.glob(pattern) if glob.has_magic(pattern) else [pattern]
+        for path in sorted(paths):
+            if os.path.isdir(path):
+                for directory, directories, names in os.walk(path):
+                    directories[:] = sorted(d for d in directories if not d.startswith('.'))
+                    for name in sorted(fnmatch.filter(names, name_pattern)):
+                        file_path = os.path.join(directory, name)
+                        yield file_path, os.path.relpath(file_path, path)
+            else:
+                yield path, os.path.basename(path)
+
+_batch_tasks = None
+
+def batch_file(job):
+    """Runs a task on a file for run_batch, returning the path, its size and the outcome."""
+    global _batch_tasks
+    task, path, output_path = job
+    try:
+        if _batch_tasks is None:
+            _batch_tasks = Tasks()
+        size = os.path.getsize(path)
+        parameter = read_input(path)
+        new_txt = _batch_tasks.run_task(task, parameter)
+        if output_path is None:
+            if new_txt == parameter:
+                return path, size, 'unchanged'
+            output_path = path
+        data = new_txt.encode('utf-8') if new_txt else ''
+        if output_path != path and os.path.exists(output_path) and os.path.getsize(output_path) == len(data):
+            with open(output_path, 'rb') as f:
+                if f.read() == data:
+                    return path, size, 'unchanged'
+        else:
+            output_directory = os.path.dirname(output_path)
+            if output_directory and not os.path.isdir(output_directory):
+                try:
+                    os.makedirs(output_directory)
+                except OSError:
+                    # Created by another worker
+                    pass
+        write_atomic(output_path, data)
+        return path, size, 'changed'
+    except Exception, e:
+        return path, 0, "error: %s" % e
+
+def run_batch(arguments):
+    """Runs a task on many files in parallel, writing the results in place or to a directory.
+
+    Workers read, and write, one file each at a time. Files whose result is the same as the
+    existing output are not written.
+    """
+    import argparse
+    import multiprocessing
+    parser = argparse.ArgumentParser(prog='pyscripts.py --batch')
+    parser.add_argument('--output-dir', help='directory for the results (default: replace the files)')
+    parser.add_argument('--jobs', type=int, default=multiprocessing.cpu_count(), help='number of worker processes')
+    parser.add_argument('--name', default='*', help="pattern for files found in directories (default: '*')")
+    parser.add_argument('task')
+    parser.add_argument('paths', nargs='+', help='files, globs or directories')
+    options = parser.parse_args(arguments)
+    task = options.task.decode('utf-8')
+    # Fail before starting any workers if any task of the pipeline doesn't exist
+    tasks = Tasks()
+    for name in task.split(u'|'):
+        tasks.get_task(name.strip())
+
+    jobs = ((task, path, os.path.join(options.output_dir, name) if options.output_dir else None)
+        for path, name in batch_files(options.paths, options.name))
+    start = time.time()
+    if options.jobs > 1:
+        pool = multiprocessing.Pool(options.jobs)
+        results = pool.imap_unordered(batch_file, jobs, chunksize=4)
+    else:
+        pool = None
+        results = (batch_file(job) for job in jobs)
+    counts = {'changed': 0, 'unchanged': 0, 'error': 0}
+    total_size = 0
+    try:
+        for path, size, outcome in results:
+            total_size += size
+            if outcome.startswith('error'):
+                counts['error'] += 1
+                sys.stderr.write("%s: %s\n" % (path, outcome))
+            else:
+                counts[outcome] += 1
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    elapsed = max(time.time() - start, 1e-6)
+    files = sum(counts.values())
+    print "%(files)d files (%(changed)d changed, %(unchanged)d unchanged, %(error)d errors) in %(elapsed).2fs: " \
+        "%(files_rate).1f files/s, %(mb_rate).2f MB/s" % dict(counts, files=files, elapsed=elapsed,
+            files_rate=files / elapsed, mb_rate=total_size / elapsed / (1024 * 1024))
+    if counts['error']:
+        sys.exit(1)
+
+#
+# Watch Methods
+#
+# Watched files are scanned every WATCH_INTERVAL seconds. A changed file is formatted once it has
+# gone WATCH_DEBOUNCE seconds without changing again, so a burst of saves is formatted once:
+# its lines are compared with those it had when last formatted, and only the tables and
+# headings touching the changed lines are formatted. Files are scanned, and formatted, in turn
+# by one thread, with the times files are due kept in a heap.
+#
+
+# Changed lines, after the common first and last lines, beyond which a change is not compared
+# line by line, but taken as a whole
+WATCH_DIFF_LIMIT = 2000
+
+def changed_ranges(old_lines, new_lines):
+    """Returns the (start, end) ranges of the lines of new_lines that replace, or are inserted
+    among, the lines of old_lines; where lines are deleted, the range is empty."""
+    import difflib
+    # Most saves change one place, so the lines before and after it are skipped first
+    limit = min(len(old_lines), len(new_lines))
+    prefix = 0
+    while prefix < limit and old_lines[prefix] == new_lines[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and old_lines[-1 - suffix] == new_lines[-1 - suffix]:
+        suffix += 1
+    old_end = len(old_lines) - suffix
+    new_end = len(new_lines) - suffix
+    if prefix == old_end and prefix == new_end:
+        return []
+    if max(old_end, new_end) - prefix > WATCH_DIFF_LIMIT:
+        return [(prefix, new_end)]
+    matcher = difflib.SequenceMatcher(None, old_lines[prefix:old_end], new_lines[prefix:new_end], autojunk=False)
+    return [(prefix + j1, prefix + j2) for tag, i1, i2, j1, j2 in matcher.get_opcodes() if tag != 'equal']
+
+def format_blocks(lines, ranges):
+    """Returns a copy of lines with the tables and headings touching any of the (start, end) line
+    ranges formatted, and the number of them changed.
+
+    Formatting keeps the number of lines of each table and heading, so their line numbers hold.
+    Headings including code fence lines are not formatted.
+    """
+    def touched(start, end):
+        for range_start, range_end in ranges:
+            if range_start <= end and start <= range_end:
+                return True
+        return False
+
+    new_lines = list(lines)
+    count = 0
+    for start, end, kind in table_blocks(lines):
+        if touched(start, end):
+            table_lines = format_table_block((kind, lines[start:end]))
+            if table_lines is not None and table_lines != lines[start:end]:
+                new_lines[start:end] = table_lines
+                count += 1
+    headings = Headings(lines)
+    for h, start in enumerate(headings.starts):
+        heading_lines = headings.heading_lines(h)
+        end = start + len(heading_lines)
+        # A file is written back unattended, so a heading including a line opening a code
+        # fence is left as it is, should it ever be taken for one
+        if headings.fenced(h):
+            continue
+        if touched(start, end) and heading_lines != lines[start:end]:
+            new_lines[start:end] = heading_lines
+            count += 1
+    return new_lines, count
+
+
+class Watcher(object):
+    """Formats the tables and headings changed in the files under some paths as they are saved.
+
+    The lines of each file when last formatted (or when the watcher was made) are kept, to find
+    what a save changed. Files appearing later are formatted whole. Tables are found, and
+    formatted, as by format_tables.
+    """
+
+    def __init__(self, paths, names=WATCH_NAMES, interval=WATCH_INTERVAL, debounce=WATCH_DEBOUNCE):
+        self.paths = paths
+        self.names = names
+        self.interval = interval
+        self.debounce = debounce
+        # The (mtime, size) and lines of each file when last formatted
+        self.snapshots = {}
+        # The (mtime, size) of each file when last scanned
+        self.seen = {}
+        # The time each changed file is due to be formatted, and a heap of (time, path)
+        self.due = {}
+        self.queue = []
+        self.scan(time.time(), initial=True)
+
+    def files(self):
+        """Generates the paths of the files watched."""
+        import fnmatch
+        for path in self.paths:
+            if not os.path.isdir(path):
+                yield path
+                continue
+            for directory, directories, names in os.walk(path):
+                directories[:] = [d for d in directories if not d.startswith('.')]
+                for name in names:
+                    if any(fnmatch.fnmatch(name, pattern) for pattern in self.names):
+                        yield os.path.join(directory, name)
+
+    def scan(self, now, initial=False):
+        """Notes the files changed since the last scan, putting off formatting each until it
+        has not changed for the debounce time."""
+        import heapq
+        seen = {}
+        for path in self.files():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            seen[path] = stat.st_mtime, stat.st_size
+            if initial:
+                self.snapshot(path, seen[path])
+            elif seen[path] != self.seen.get(path) and seen[path] != self.snapshots.get(path, (None,))[0]:
+                self.due[path] = now + self.debounce
+                heapq.heappush(self.queue, (self.due[path], path))
+        for path in set(self.seen) - set(seen):
+            # Deleted
+            self.snapshots.pop(path, None)
+            self.due.pop(path, None)
+        self.seen = seen
+
+    def snapshot(self, path, stat, lines=None):
+        if lines is None:
+            try:
+                lines = split_lines(read_input(path))
+            except (IOError, UnicodeDecodeError):
+                lines = []
+        self.snapshots[path] = stat, lines
+
+    def update(self, path):
+        """Formats the tables and headings changed in a file since its last snapshot, writing it
+        back if they change, and returns the number changed."""
+        stat = os.stat(path)
+        stat = stat.st_mtime, stat.st_size
+        txt = read_input(path)
+        lines = split_lines(txt)
+        snapshot = self.snapshots.get(path)
+        ranges = changed_ranges(snapshot[1], lines) if snapshot else [(0, len(lines))]
+        new_lines, count = format_blocks(lines, ranges) if ranges else (lines, 0)
+        if count:
+            new_stat = os.stat(path)
+            if (new_stat.st_mtime, new_stat.st_size) != stat:
+                # Saved again while being formatted; formatted when next due
+                return 0
+            write_atomic(path, join_lines(new_lines, txt).encode('utf-8'))
+            new_stat = os.stat(path)
+            stat = new_stat.st_mtime, new_stat.st_size
+            self.seen[path] = stat
+        self.snapshot(path, stat, new_lines)
+        return count
+
+    def run(self, until=None):
+        """Watches the files, until a time if given, printing each file formatted."""
+        import heapq
+        next_scan = time.time() + self.interval
+        while until is None or time.time() < until:
+            now = time.time()
+            if now >= next_scan:
+                self.scan(now)
+                next_scan = now + self.interval
+            while self.queue and self.queue[0][0] <= now:
+                due, path = heapq.heappop(self.queue)
+                if self.due.get(path) != due:
+                    # Put off by a later change
+                    continue
+                del self.due[path]
+                try:
+                    count = self.update(path)
+                except (IOError, OSError, UnicodeDecodeError), e:
+                    sys.stderr.write("%s: error: %s\n" % (path, e))
+                    continue
+                if count:
+                    print "%s: %d table%s or heading%s formatted" % (path, count, '' if count == 1 else 's',
+                        '' if count == 1 else 's')
+                    sys.stdout.flush()
+            wake = min(next_scan, self.queue[0][0]) if self.queue else next_scan
+            if until is not None:
+                wake = min(wake, until)
+            time.sleep(max(wake - time.time(), 0))
+
+def watch(arguments):
+    """Formats tables and headings in files under some paths as they change, until interrupted."""
+    import argparse
+    parser = argparse.ArgumentParser(prog='pyscripts.py --watch')
+    parser.add_argument('--interval', type=float, default=WATCH_INTERVAL, help='seconds between scans')
+    parser.add_argument('--debounce', type=float, default=WATCH_DEBOUNCE,
+        help='seconds a changed file must stay unchanged before it is formatted')
+    parser.add_argument('--name', action='append',
+        help="pattern for files found in directories (may be repeated; default: %s)" % ' '.join(WATCH_NAMES))
+    parser.add_argument('paths', nargs='+', help='files or directories')
+    options = parser.parse_args(arguments)
+    watcher = Watcher(options.paths, options.name or WATCH_NAMES, options.interval, options.debounce)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+
+#
+# Server Methods
+#
+
+def server_address(script_path=None):
+    """Returns the path of the Unix socket used by the server for a script.
+
+    The socket is named after the script (which includes its version when installed), so that
+    pyscripts_client.py can find it without importing this module. The script run, rather than
+    this module, names it, as the module is __main__.py when run from a zip archive.
+    """
+    name = os.path.splitext(os.path.basename(script_path or __file__))[0]
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'), "%s-%d.sock" % (name, os.getuid()))
+
+
+def serve(idle_timeout=SERVER_IDLE_TIMEOUT):
+    """Runs a server keeping a Tasks instance warm, shutting down after idle_timeout seconds."""
+    import socket
+    import SocketServer
+    import threading
+
+    class ScriptRequestHandler(SocketServer.StreamRequestHandler):
+
+        def handle(self):
+            # A request is the task name, a newline and then the selection; the client
+            # shuts down its side of the socket to mark the end of the selection.
+            data = self.rfile.read()
+            task, _, text = data.partition('\n')
+            tasks = self.server.tasks
+            phases = {}
+            try:
+                with profile_phase(None, 'decode', phases):
+                    parameter = text.decode('utf-8')
+                new_txt = tasks.run_task(task.decode('utf-8'), parameter, phases)
+                with profile_phase(None, 'encode', phases):
+                    result = render_result(new_txt, parameter).encode('utf-8')
+                self.wfile.write('OK\n' + result)
+            except Exception, e:
+                self.wfile.write('ERROR\n' + unicode(e).encode('utf-8'))
+                return
+            if tasks.metrics:
+                tasks.metrics.record(task, len(text), phases, 'server')
+
+        def setup(self):
+            try:
+                SocketServer.StreamRequestHandler.setup(self)
+            except:
+                # finish is not called when setup fails
+                self.server.request_finished()
+                raise
+
+        def finish(self):
+            try:
+                SocketServer.StreamRequestHandler.finish(self)
+            finally:
+                self.server.request_finished()
+
+    class ScriptServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+        daemon_threads = True
+
+        def __init__(self, address):
+            SocketServer.UnixStreamServer.__init__(self, address, ScriptRequestHandler)
+            self.tasks = Tasks()
+            self.counter_lock = threading.Lock()
+            self.active = 0
+            self.last_request = time.time()
+
+        def process_request(self, request, client_address):
+            # Counted before the thread handling it starts, so that the server can't be found
+            # idle between accepting a request and the thread getting to it
+            self.request_started()
+            try:
+                SocketServer.ThreadingMixIn.process_request(self, request, client_address)
+            except:
+                self.request_finished()
+                raise
+
+        def request_started(self):
+            with self.counter_lock:
+                self.active += 1
+
+        def request_finished(self):
+            with self.counter_lock:
+                self.active -= 1
+                self.last_request = time.time()
+
+        def idle(self):
+            with self.counter_lock:
+                return self.active == 0 and time.time() - self.last_request >= idle_timeout
+
+    address = server_address(sys.argv[0])
+    if os.path.exists(address):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(address)
+        except socket.error:
+            # Left behind by a server that did not shut down cleanly
+            os.unlink(address)
+        else:
+            raise Exception("Error: a server is already listening on '%s'." % address)
+        finally:
+            probe.close()
+
+    old_umask = os.umask(0077)
+    try:
+        server = ScriptServer(address)
+    finally:
+        os.umask(old_umask)
+    server.timeout = min(idle_timeout, 60)
+    try:
+        while not server.idle():
+            server.handle_request()
+    finally:
+        server.server_close()
+        if os.path.exists(address):
+            os.unlink(address)
+
+
 def main():
     if len(sys.argv) < 2:
         if len(sys.argv) == 1 and sys.argv[0].endswith('pyscript.py'):
             os.system("open \"%s\"" % sys.argv[0])
         else:
             raise Exception("Error: length of sys.argv: %s %s" % (len(sys.argv), sys.argv))
+    elif sys.argv[1] == '--serve':
+        # Optional second argument is the idle timeout in seconds
+        serve(float(sys.argv[2]) if len(sys.argv) > 2 else SERVER_IDLE_TIMEOUT)
+    elif sys.argv[1] == '--batch':
+        run_batch(sys.argv[2:])
+    elif sys.argv[1] == '--fragments':
+        run_fragments(sys.argv[2:])
+    elif sys.argv[1] == '--watch':
+        watch(sys.argv[2:])
+    elif sys.argv[1] == '--profile-report':
+        profile_report(sys.argv[2:])
+    elif sys.argv[1] == '--cache-report':
+        cache_report(sys.argv[2:])
+    elif sys.argv[1] == '--metrics-report':
+        metrics_report(sys.argv[2:])
+    elif sys.argv[1].startswith('--'):
+        run_with_options(sys.argv[1:])
     else:
-        parameter = sys.argv[2].decode('utf-8') if len(sys.argv) > 2 else ''
-        new_txt = Tasks().run_task(sys.argv[1].decode('utf-8'), parameter)
+        phases = {'startup': process_time()}
+        profile = start_profile(sys.argv[1])
+        with profile_phase(profile, 'decode', phases):
+            parameter = sys.argv[2].decode('utf-8') if len(sys.argv) > 2 else ''
+        tasks = Tasks(profile)
+        new_txt = tasks.run_task(sys.argv[1].decode('utf-8'), parameter, phases)
         if new_txt:
-            if parameter and parameter[-1].isspace():
-                print new_txt.encode('utf-8') + parameter[-1].encode('utf-8')
-            else:
-                print new_txt.encode('utf-8')
+            with profile_phase(profile, 'encode', phases):
+                result = render_result(new_txt, parameter).encode('utf-8')
+            print result
+        if profile:
+            profile.save(parameter)
+        if tasks.metrics:
+            tasks.metrics.record(sys.argv[1], len(sys.argv[2]) if len(sys.argv) > 2 else 0, phases, 'command')
 
 
 if __name__ == '__main__':
     main()
-
@@ -0,0 +1,68 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Client forwarding a task to a running pyscripts server (see "pyscripts.py --serve").
+#
+# Usage: python -S pyscripts_client.py <path to pyscripts> <task> [<text>]
+#
+# Only a handful of built-in modules are imported, so the client starts much faster than
+# pyscripts itself. If no server is listening, or it fails to answer, a server is started in the
+# background for the next command and this command is run by pyscripts directly.
+
+import os
+import socket
+import sys
+
+def server_address(script_path):
+    """Returns the path of the server's Unix socket; must match pyscripts.server_address."""
+    name = os.path.splitext(os.path.basename(script_path))[0]
+    return os.path.join(os.environ.get('TMPDIR', '/tmp'), "%s-%d.sock" % (name, os.getuid()))
+
+def forward(address, task, text):
+    """Sends a task and its text to the server, returning the status and the result."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(address)
+        sock.sendall("%s\n%s" % (task, text))
+        sock.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    status, _, result = ''.join(chunks).partition('\n')
+    return status, result
+
+def start_server(script_path):
+    """Starts a detached server, with its output discarded so the caller is not held open."""
+    import subprocess
+    devnull = open(os.devnull, 'r+')
+    subprocess.Popen([sys.executable, script_path, '--serve'], stdin=devnull, stdout=devnull,
+        stderr=devnull, close_fds=True, preexec_fn=os.setsid)
+
+def main():
+    if len(sys.argv) < 3:
+        sys.stderr.write("Error: usage: %s <pyscripts> <task> [<text>]\n" % sys.argv[0])
+        sys.exit(2)
+    script_path, task = sys.argv[1:3]
+    text = sys.argv[3] if len(sys.argv) > 3 else ''
+    try:
+        status, result = forward(server_address(script_path), task, text)
+    except socket.error:
+        status = result = ''
+    if not status:
+        # No server listening, or it went away before answering
+        start_server(script_path)
+        os.execv(sys.executable, [sys.executable, script_path] + sys.argv[2:])
+    if status != 'OK':
+        sys.stderr.write("%s\n" % result)
+        sys.exit(1)
+    if result:
+        print result
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#
+# Copyright © 2017 John Jackson
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+#
+# Tests of the pyscripts tasks; benchmark.py times them
+#
+# Usage: python -m unittest test_pyscripts
+#
+
+import unittest
+
+import pyscripts
+
+
+class TaskTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tasks = pyscripts.Tasks(cache=False, metrics=False)
+
+
+class CssTest(TaskTest):
+
+    def test_semicolon_in_unquoted_url(self):
+        # A semicolon in an unquoted url doesn't end the declaration
+        self.assertEqual(self.tasks.task_css(u'.a{background:url(data:image/png;base64,AAAA);color:red}'),
+            u'.a {\n    background:url(data:image/png;base64,AAAA);\n    color:red\n}')
+
+    def test_quoted_url(self):
+        self.assertEqual(self.tasks.task_css(u'.b{background:URL( "x;y" );x:url(a\\);b)}'),
+            u'.b {\n    background:URL( "x;y" );\n    x:url(a\\);b)\n}')
+
+
+class TableColumnsTest(TaskTest):
+
+    def test_short_rule(self):
+        self.assertEqual(self.tasks.get_task(u'sort_table')(u'|a|b|\n|:-:|-|\n|z|1|\n|y|2|'),
+            u'|  a  | b   |\n| :-: | --- |\n|  y  | 2   |\n|  z  | 1   |')
+
+    def test_blank_lines(self):
+        self.assertEqual(self.tasks.get_task(u'sort_table:2')(u'|a|b|\n|---|---|\n|z|2|\n\n|y|1|\n'),
+            u'| a   | b   |\n| --- | --- |\n| y   | 1   |\n| z   | 2   |\n')
+
+    def test_descending(self):
+        txt = u'| a   |\n| --- |\n| x   |\n| y   |'
+        for task in [u'sort_table:-1', u'sort_table: -1', u'sort_table_descending:1', u'sort_table_descending: 1']:
+            self.assertEqual(self.tasks.get_task(task)(txt), u'| a   |\n| --- |\n| y   |\n| x   |')
+        for task in [u'sort_table_descending:-1', u'sort_table_descending: -1']:
+            self.assertEqual(self.tasks.get_task(task)(txt), txt)
+
+    def test_empty_table(self):
+        for txt in [u'', u'|\n']:
+            self.assertRaisesRegexp(Exception, u'^Error: ', self.tasks.task_remove_duplicate_table_rows, txt)
+
+
+class WrapTest(TaskTest):
+
+    def test_indented_code(self):
+        for txt in [u'    x = 1\n    y = 2\n', u'\tx = 1\n\ty = 2\n', u'Intro\n\n    x = 1\n    y = 2\n\nEnd\n']:
+            self.assertEqual(self.tasks.task_wrap(txt), txt)
+
+    def test_block_quote(self):
+        self.assertEqual(self.tasks.task_wrap(u'> a\n> b\n'), u'> a\n> b\n')
+
+    def test_hard_line_break(self):
+        # The break, and the spaces making it, are kept
+        self.assertEqual(self.tasks.task_wrap(u'Line one  \nline two\n'), u'Line one  \nline two\n')
+        self.assertEqual(self.tasks.task_wrap(u'one\ntwo  \nthree\nfour\n'), u'one two  \nthree four\n')
+
+    def test_paragraph(self):
+        self.assertEqual(self.tasks.task_wrap(u'one\ntwo\n\n- item\n  more\n'), u'one two\n\n- item more\n')
+
+
+
+class HeadingsTest(TaskTest):
+
+    def test_code_fence_after_paragraph(self):
+        # A paragraph directly followed by a code fence is not a heading underlined by the fence
+        for txt in [u'Some text:\n```\ncode here\n```\n', u'Intro line\n~~~\ncode\n~~~\n',
+                u'# Title\n\nSome text:\n```\ncode here\n```\n']:
+            self.assertEqual(self.tasks.task_normalize_headings(txt), txt)
+
+    def test_adornments(self):
+        self.assertEqual(self.tasks.task_normalize_headings(u'Title\n===\n\nSubsection\n~~~~~~~~~~~~~~\n'),
+            u'Title\n=====\n\nSubsection\n~~~~~~~~~~\n')
+
+    def test_markdown_levels_may_skip(self):
+        self.assertEqual(self.tasks.task_normalize_headings(u'# A\n\n### C\n'), u'# A\n\n### C\n')
+
+    def test_rst_levels_may_not_skip(self):
+        self.assertRaisesRegexp(Exception, u'^Error: heading levels', self.tasks.task_normalize_headings,
+            u'A\n===\n\nB\n---\n\nC\n~~~\n\nD\n===\n\nE\n~~~\n')
+
+
+
+class ContentsTest(TaskTest):
+
+    def test_code_fence(self):
+        # Neither the line before a code fence nor the code in it is a heading
+        self.assertEqual(self.tasks.task_table_of_contents(u'# Title\n\nSee:\n```\ncode\n```\n\n## Later\n'),
+            u'# Title\n\nSee:\n```\ncode\n```\n\n<!-- toc -->\n\n- [Later](#later)\n\n<!-- tocstop -->\n\n## Later\n')
+
+
+if __name__ == '__main__':
+    unittest.main()